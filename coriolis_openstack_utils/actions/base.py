@@ -12,11 +12,21 @@ and they should be excuted in a "leaf-first"-type traversal.
 """
 
 import abc
+import functools
+
+from oslo_log import log as logging
 from six import with_metaclass
 
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
+from coriolis_openstack_utils.resource_utils import tags
+
+
+LOG = logging.getLogger(__name__)
 
 ACTION_TYPE_BATCH_MIGRATE = "create_batch_migration"
 ACTION_TYPE_BATCH_REPLICATE = "create_batch_replication"
+ACTION_TYPE_BATCH_REPLICATE_FLAVORS = "create_batch_flavor_replication"
 ACTION_TYPE_CHECK_CREATE_SOURCE_ENDPOINT = "create_source_endpoint"
 ACTION_TYPE_CHECK_CREATE_DESTINATION_ENDPOINT = "create_destination_endpoint"
 ACTION_TYPE_CHECK_CREATE_TENANT = "create_tenant"
@@ -32,6 +42,19 @@ ACTION_TYPE_CHECK_CREATE_KEYPAIR = "create_keypair"
 ACTION_TYPE_CHECK_CREATE_PORT = "create_port"
 
 
+def cached_check(func):
+    """ Decorator for `check_already_done` implementations which caches their
+    result on the action until `invalidate_check` is called on it. """
+
+    @functools.wraps(func)
+    def _check_already_done(self):
+        if self._check_result is None:
+            self._check_result = func(self)
+        return self._check_result
+
+    return _check_already_done
+
+
 class BaseAction(object, with_metaclass(abc.ABCMeta)):
     """ The ABC for all `Action`s offered by the utilities. """
 
@@ -61,6 +84,119 @@ class BaseAction(object, with_metaclass(abc.ABCMeta)):
         self._coriolis_client = coriolis_client
         self.payload = action_payload
         self.subactions = []
+        self._resolved_state = {}
+        self._check_result = None
+        self._journal = None
+        # NOTE: shared with all the subactions executed by the action:
+        self.created_resources = rollback.CreatedResources()
+
+    @property
+    def journal(self):
+        """ The `journal.ExecutionJournal` of the run (if any), which is
+        shared by all the subactions. """
+        return self._journal
+
+    @journal.setter
+    def journal(self, journal):
+        self._journal = journal
+        for action in self.subactions:
+            action.journal = journal
+
+    def check_subaction(self, action):
+        """ Returns the `check_already_done` result of the given subaction,
+        without performing the check if it was already journaled. """
+        action.journal = self.journal
+        if self.journal is not None:
+            found, result = self.journal.lookup(
+                self.journal.get_action_key(action))
+            if found:
+                return {"done": True, "result": result}
+        return action.check_already_done()
+
+    def execute_subaction(self, action, *args, **kwargs):
+        """ Executes the given subaction and records its result in the
+        journal (if any). Subactions which were already journaled are skipped
+        and their journaled result is returned instead. """
+        action.journal = self.journal
+        action.created_resources = self.created_resources
+        action_key = None
+        if self.journal is not None:
+            action_key = self.journal.get_action_key(action)
+            found, result = self.journal.lookup(action_key)
+            if found:
+                LOG.info(
+                    "Skipping journaled '%s' action with payload %s.",
+                    action.action_type, action.payload)
+                return result
+
+        result = action.execute_operations(*args, **kwargs)
+        if self.journal is not None:
+            self.journal.record(action_key, action, result)
+        return result
+
+    def record_created(self, resource_type, resource_id):
+        """ Records the given resource as created by the action so it may be
+        rolled back (see `rollback_created_resources`). """
+        self.created_resources.record(resource_type, resource_id)
+
+    def record_mapping(self, resource_type, source_id, destination_id,
+                       source_name=None, destination_name=None):
+        """ Records the destination resource the given source resource was
+        replicated to (or found equivalent to) in the ID mapping store, so
+        later lookups need not search the destination for it. """
+        conf.get_id_mapping_store().record(
+            resource_type, source_id, destination_id,
+            source_name=source_name, destination_name=destination_name)
+
+    def tag_destination_resource(self, resource_plural, resource_id,
+                                 source_id):
+        """ Stamps the given destination Neutron resource with the ownership
+        tag of the source resource (see `tags`), unless the check of the
+        action already found it through the tag. """
+        state_key = ('destination_tagged', resource_id)
+        if self.resolve_state(state_key, lambda: False):
+            return
+        tags.tag_resource(
+            self._destination_openstack_client, resource_plural, resource_id,
+            source_id)
+        self.set_state(state_key, True)
+
+    def rollback_created_resources(self):
+        """ Deletes all the resources recorded as created by the action and
+        its subactions in reverse dependency order.
+        Returns False if there were no recorded resources to delete.
+        """
+        if not len(self.created_resources):
+            return False
+
+        rollback.rollback(
+            self.created_resources,
+            destination_openstack_client=self._destination_openstack_client,
+            coriolis_client=self._coriolis_client)
+        self.invalidate_check()
+        return True
+
+    def resolve_state(self, key, resolver):
+        """ Returns the fact about the source/destination stored under the
+        given key, calling `resolver()` to look it up on first access only.
+        Facts stay resolved until dropped through `invalidate_state`.
+        """
+        if key not in self._resolved_state:
+            self._resolved_state[key] = resolver()
+        return self._resolved_state[key]
+
+    def set_state(self, key, value):
+        """ Stores an already known fact (ex: loaded in bulk) under the given
+        key, so that it does not get looked up by `resolve_state`. """
+        self._resolved_state[key] = value
+
+    def invalidate_state(self, *keys):
+        """ Drops the given resolved facts, or all of them if no keys are
+        given, so that they get looked up again on the next access. """
+        if not keys:
+            self._resolved_state.clear()
+        for key in keys:
+            self._resolved_state.pop(key, None)
 
     @abc.abstractmethod
     def equivalent_to(self, other_action):
@@ -76,9 +212,35 @@ class BaseAction(object, with_metaclass(abc.ABCMeta)):
             "done": True/False,    # whether the action needs doing
             "result": <res type>,  # whatever result would have come out
         }
+        Implementations should be decorated with `cached_check`.
         """
         pass
 
+    def invalidate_check(self):
+        """ Drops the cached result of `check_already_done`. Must be called
+        whenever the action (or an equivalent one) alters the resources the
+        check is based on.
+        """
+        self._check_result = None
+
+    def set_check_result(self, done):
+        """ Sets the result `check_already_done` should return without
+        performing the actual check (ex: when it was already determined by
+        an execution plan).
+        """
+        self._check_result = done
+
+    def add_to_plan(self, plan, depends_on=(), check=True):
+        """ Adds the operations of the action to the given
+        `plans.ExecutionPlan` and returns the keys of the added entries.
+        param depends_on: list: keys of plan entries which must be applied
+        before the ones of this action.
+        param check: bool: whether to check if the action is already done, or
+        to plan it as not done (ex: when depending on not yet created
+        resources).
+        """
+        return [plan.add_action(self, depends_on=depends_on, check=check)]
+
     @abc.abstractmethod
     def cleanup(self):
         """Deletes all results of an action execution"""
@@ -96,4 +258,4 @@ class BaseAction(object, with_metaclass(abc.ABCMeta)):
         Executes the needed operations and returns some status info.
         """
         for action in self.subactions:
-            action.execute_operations()
+            self.execute_subaction(action)
@@ -8,6 +8,7 @@ import copy
 from oslo_log import log as logging
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
 from coriolis_openstack_utils import utils
 from coriolis_openstack_utils.actions import base
 
@@ -22,6 +23,18 @@ DEFAULT_REGION_NAME = "NoRegion"
 DEFAULT_ENDPOINT_DESCRIPTION = "Created by the Coriolis OpenStack utils."
 
 
+def get_connection_info_fingerprint(endpoint):
+    """ Returns the fingerprint of the connection info of the given Coriolis
+    endpoint.
+    NOTE: the endpoints of captured inventories only hold the fingerprints
+    of their connection info, which gets redacted (see `inventory`).
+    """
+    endpoint_info = endpoint.to_dict()
+    if endpoint_info.get('connection_info_fingerprint'):
+        return endpoint_info['connection_info_fingerprint']
+    return utils.fingerprint(endpoint.connection_info.to_dict())
+
+
 class SourceEndpointCreationAction(base.BaseAction):
     """
     NOTE: should be instantiated with the OpenStackClient for source/dest.
@@ -83,6 +96,7 @@ class SourceEndpointCreationAction(base.BaseAction):
                 self.endpoint_type, endpoint_name,
                 tenant_name, host_auth_url))
 
+    @base.cached_check
     def check_already_done(self):
         super(SourceEndpointCreationAction, self).execute_operations()
         connection_info = copy.deepcopy(self.connection_info)
@@ -94,17 +108,19 @@ class SourceEndpointCreationAction(base.BaseAction):
         existing_endpoint = None
         done = {"done": False, "result": None}
         endpoint_name = None
+        connection_info_fingerprint = utils.fingerprint(connection_info)
         for endpoint in self._coriolis_client.endpoints.list():
-            existing_connection_info = endpoint.connection_info.to_dict()
-            conn_infos_equal = utils.check_dict_equals(
-                connection_info, existing_connection_info)
+            conn_infos_equal = get_connection_info_fingerprint(
+                endpoint) == connection_info_fingerprint
             if endpoint.name == endpoint_name:
                 if not conn_infos_equal:
                     raise Exception(
                         "Found existing %s endpoint named '%s' (ID '%s') with "
                         "conn info '%s' (expecting conn info '%s')" % (
                             self.endpoint_type, endpoint_name, endpoint.id,
-                            existing_connection_info, connection_info))
+                            utils.redact_secrets(
+                                endpoint.connection_info.to_dict()),
+                            utils.redact_secrets(connection_info)))
 
                 LOG.debug("Found existing %s endpoint named '%s'",
                           self.endpoint_type, endpoint_name)
@@ -113,7 +129,8 @@ class SourceEndpointCreationAction(base.BaseAction):
             elif conn_infos_equal:
                 LOG.debug(
                     "Found existing %s endpoint with conn info '%s': ID '%s'",
-                    self.endpoint_type, connection_info, endpoint.id)
+                    self.endpoint_type, utils.redact_secrets(connection_info),
+                    endpoint.id)
                 existing_endpoint = endpoint
                 break
 
@@ -137,6 +154,8 @@ class SourceEndpointCreationAction(base.BaseAction):
         endpoint = self._coriolis_client.endpoints.create(
             endpoint_name, ENDPOINT_TYPE_OPENSTACK,
             connection_info, DEFAULT_ENDPOINT_DESCRIPTION)
+        self.record_created(rollback.RESOURCE_TYPE_ENDPOINT, endpoint.id)
+        self.invalidate_check()
 
         return endpoint.id
 
@@ -145,12 +164,11 @@ class SourceEndpointCreationAction(base.BaseAction):
 
         connection_info = copy.deepcopy(self.connection_info)
         similar_endpoints = []
+        connection_info_fingerprint = utils.fingerprint(connection_info)
         for endpoint in self._coriolis_client.endpoints.list():
-            existing_connection_info = endpoint.connection_info.to_dict()
-            conn_infos_equal = utils.check_dict_equals(
-                connection_info, existing_connection_info)
             if endpoint.name == endpoint_name:
-                if conn_infos_equal:
+                if get_connection_info_fingerprint(endpoint) == (
+                        connection_info_fingerprint):
                     similar_endpoints.append(endpoint.id)
 
         endpoints_length = len(similar_endpoints)
@@ -158,11 +176,12 @@ class SourceEndpointCreationAction(base.BaseAction):
             LOG.info("Cannot delete endpoint '%s' with connection_info '%s',"
                      "not found.")
         if endpoints_length == 1:
-            self._coriolis_client.endpoints.delete(similar_endpoints[0].id)
+            self._coriolis_client.endpoints.delete(similar_endpoints[0])
+            self.invalidate_check()
         elif endpoints_length > 1:
             LOG.warn("Multiple endpoints with name '%s' and "
                      "connection_info '%s' found, skipping deletion."
-                     % (endpoint_name, connection_info))
+                     % (endpoint_name, utils.redact_secrets(connection_info)))
 
 
 class DestinationEndpointCreationAction(SourceEndpointCreationAction):
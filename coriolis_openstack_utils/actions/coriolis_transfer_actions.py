@@ -8,12 +8,14 @@ import abc
 from oslo_log import log as logging
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
 from coriolis_openstack_utils import utils
 from coriolis_openstack_utils.actions import base
 from coriolis_openstack_utils.actions import coriolis_endpoint_actions
 from coriolis_openstack_utils.actions import network_actions
 from coriolis_openstack_utils.resource_utils import instances
 from coriolis_openstack_utils.resource_utils import networks
+from coriolis_openstack_utils.resource_utils import ports
 
 
 CONF = conf.CONF
@@ -51,6 +53,7 @@ class TransferAction(base.BaseAction):
                 "Destination environment required to migrate.")
 
         self._destination_env = destination_env
+        self._pre_created_ports = None
 
         self.source_endpoint_create_action = (
             coriolis_endpoint_actions.SourceEndpointCreationAction(
@@ -66,6 +69,18 @@ class TransferAction(base.BaseAction):
             self.source_endpoint_create_action,
             self.dest_endpoint_create_action]
 
+    @property
+    def destination_env(self):
+        return self._destination_env
+
+    def get_endpoint_dependencies(self, planned_actions):
+        """ Returns the plan keys of the given (action, key) tuples whose
+        actions are equivalent to the endpoint actions of the transfer. """
+        return [
+            key for action, key in planned_actions
+            if action.equivalent_to(self.source_endpoint_create_action) or
+            action.equivalent_to(self.dest_endpoint_create_action)]
+
     def equivalent_to(self, other_action):
         if self.action_type == other_action.action_type:
             if utils.check_dict_equals(self.payload, other_action.payload):
@@ -93,6 +108,7 @@ class TransferAction(base.BaseAction):
         """ Create transfer action. """
         pass
 
+    @base.cached_check
     def check_already_done(self):
         done = {
             "done": False,
@@ -118,16 +134,20 @@ class TransferAction(base.BaseAction):
         destination_endpoint_id = destination_endpoint_done["result"]
 
         existing_transfer = None
+        destination_env_fingerprint = utils.fingerprint(self._destination_env)
         for transfer in self.get_transfers_list():
+            if (transfer.origin_endpoint_id != source_endpoint_id or
+                    transfer.destination_endpoint_id != (
+                        destination_endpoint_id)):
+                continue
+
             migration_dest_env = transfer.destination_environment
             if migration_dest_env is not None:
                 migration_dest_env = migration_dest_env.to_dict()
             else:
                 migration_dest_env = {}
-            if (transfer.origin_endpoint_id == source_endpoint_id and
-                    transfer.destination_endpoint_id == (
-                        destination_endpoint_id) and utils.check_dict_equals(
-                            migration_dest_env, self._destination_env)):
+            if utils.fingerprint(migration_dest_env) == (
+                    destination_env_fingerprint):
                 if set(transfer.instances) == set([instance_name]):
                     existing_transfer = transfer
                     break
@@ -142,6 +162,10 @@ class TransferAction(base.BaseAction):
             # NOTE: only calls super() when subtasks aren't executed
             super(TransferAction, self).print_operations()
 
+        # NOTE: the endpoints may have been created by equivalent actions
+        # of other transfers since they were last checked:
+        self.source_endpoint_create_action.invalidate_check()
+        self.dest_endpoint_create_action.invalidate_check()
         source_endpoint_done = (
             self.source_endpoint_create_action.check_already_done())
         if not source_endpoint_done["done"]:
@@ -159,6 +183,8 @@ class TransferAction(base.BaseAction):
         source_endpoint = source_endpoint_done['result']
         destination_endpoint = destination_endpoint_done['result']
         transfer = self.create_transfer(source_endpoint, destination_endpoint)
+        self.record_created(self.created_resource_type, transfer.id)
+        self.invalidate_check()
 
         return {
             "instance_name": self.payload['instance_name'],
@@ -208,6 +234,23 @@ class TransferAction(base.BaseAction):
                 self._coriolis_client.migrations.cancel(migration.id)
                 self.source_endpoint_create_action.cleanup()
                 self.dest_endpoint_create_action.cleanup()
+        self.invalidate_check()
+
+    def set_pre_created_ports(self, ports):
+        """ Marks the Neutron ports of the instance as already pre-created
+        (ex: by a batch-wide port pre-creation stage). """
+        LOG.info(
+            "Using pre-created ports %s for VM '%s', setting port reuse "
+            "policy to 'reuse_ports'",
+            [port['id'] for port in ports], self.payload['instance_name'])
+        self._destination_env['port_reuse_policy'] = 'reuse_ports'
+        self._pre_created_ports = ports
+
+    def _maybe_pre_create_neutron_ports(self):
+        if not CONF.destination.pre_create_neutron_ports:
+            return
+        if self._pre_created_ports is None:
+            self.pre_create_neutron_ports()
 
     def pre_create_neutron_ports(self):
         LOG.info(
@@ -215,23 +258,26 @@ class TransferAction(base.BaseAction):
             "setting port reuse policy to 'reuse_ports")
         self._destination_env['port_reuse_policy'] = 'reuse_ports'
 
-        instance_id = instances.get_instance_id(
-            self._source_openstack_client,
-            self.payload['instance_tenant_name'],
-            self.payload['instance_name'])
+        instance_id = self.payload.get('instance_id')
+        if not instance_id:
+            instance_id = instances.get_instance_id(
+                self._source_openstack_client,
+                self.payload['instance_tenant_name'],
+                self.payload['instance_name'])
         network_map = self._destination_env['network_map']
         src_ports = self._source_openstack_client.neutron.list_ports(
             device_id=instance_id)['ports']
+        subnet_lookups = {}
+        dest_client = self._destination_openstack_client
+        dest_tenant_id = ports.get_destination_tenant_ids(
+            dest_client, [self.payload['instance_tenant_name']])[
+                self.payload['instance_tenant_name']]
 
         for port in src_ports:
             src_port_network_id = port['network_id']
             src_neutron = self._source_openstack_client.neutron
             src_port_network_name = src_neutron.find_resource_by_id(
                 'network', src_port_network_id)['name']
-            dest_client = self._destination_openstack_client
-            dest_tenant_id = dest_client.get_project_id(
-                    CONF.destination.new_tenant_name_format %
-                    {'original': self.payload['instance_tenant_name']})
             dest_port_network = (network_map.get(src_port_network_id) or
                                  network_map.get(src_port_network_name))
             dest_network_id = dest_client.neutron.find_resource(
@@ -244,17 +290,21 @@ class TransferAction(base.BaseAction):
                 port_payload,
                 source_openstack_client=self._source_openstack_client,
                 destination_openstack_client=(
-                    self._destination_openstack_client))
+                    self._destination_openstack_client),
+                subnet_lookups=subnet_lookups)
             self.subactions.append(port_migration_action)
-            port_migration_action.execute_operations()
+            self.execute_subaction(port_migration_action)
 
 
 class MigrationCreationAction(TransferAction):
     """ (dict) action_payload must contain:
         - (string) instance_tenant_name
         - (string) instance_name
+    and may contain:
+        - (string) instance_id
     """
     action_type = base.ACTION_TYPE_CHECK_CREATE_MIGRATION
+    created_resource_type = rollback.RESOURCE_TYPE_MIGRATION
 
     def get_transfers_list(self):
         return reversed(self._coriolis_client.migrations.list())
@@ -304,9 +354,7 @@ class MigrationCreationAction(TransferAction):
 
     def create_transfer(self, source_endpoint, destination_endpoint):
         skip_os_morphing = CONF.destination.skip_os_morphing
-        pre_create_neutron_ports = CONF.destination.pre_create_neutron_ports
-        if pre_create_neutron_ports:
-            self.pre_create_neutron_ports()
+        self._maybe_pre_create_neutron_ports()
 
         return self._coriolis_client.migrations.create(
             source_endpoint, destination_endpoint, {},
@@ -319,8 +367,11 @@ class ReplicaCreationAction(TransferAction):
         - (string) instance_tenant_name
         - (string) instance_name
         - (boolean) execute_replica
+    and may contain:
+        - (string) instance_id
     """
     action_type = base.ACTION_TYPE_CHECK_CREATE_REPLICA
+    created_resource_type = rollback.RESOURCE_TYPE_REPLICA
 
     @staticmethod
     def last_execution_status(replica):
@@ -380,9 +431,7 @@ class ReplicaCreationAction(TransferAction):
         return done
 
     def create_transfer(self, source_endpoint, destination_endpoint):
-        pre_create_neutron_ports = CONF.destination.pre_create_neutron_ports
-        if pre_create_neutron_ports:
-            self.pre_create_neutron_ports()
+        self._maybe_pre_create_neutron_ports()
 
         replica = self._coriolis_client.replicas.create(
             source_endpoint, destination_endpoint, {},
@@ -403,6 +452,35 @@ class ReplicaCreationAction(TransferAction):
                 self.payload["instance_name"], self._destination_env))
 
 
+class BatchTransferContext(object):
+    """ Holds the information shared by all the batch transfer actions of a
+    batch which gets processed in chunks, so that it is only fetched once
+    per batch: the source instance name index, the transfer validation
+    context, and the IDs of the instances selected by the previous chunks.
+
+    param source_client: utils.OpenStackClient: client for source
+    param destination_client: utils.OpenStackClient: client for destination
+    param destination_env: dict: with "network_map" and "storage_map"
+    """
+
+    def __init__(self, source_client, destination_client, destination_env):
+        self._source_client = source_client
+        self._destination_client = destination_client
+        self._destination_env = destination_env
+        self._validation_context = None
+        self.instance_name_index = instances.SourceInstanceNameIndex(
+            source_client)
+        self.selected_instance_ids = set()
+
+    @property
+    def validation_context(self):
+        if self._validation_context is None:
+            self._validation_context = instances.TransferValidationContext(
+                self._source_client, self._destination_client,
+                self._destination_env)
+        return self._validation_context
+
+
 class BatchTransferAction(base.BaseAction):
     DEFAULT_BATCH_NAME = "CoriolisTransferBatch"
 
@@ -423,18 +501,23 @@ class BatchTransferAction(base.BaseAction):
     def __init__(
             self, action_payload, source_openstack_client=None,
             coriolis_client=None, destination_openstack_client=None,
-            destination_env=None):
+            destination_env=None, journal=None, batch_context=None):
         """
         param action_payload: dict(): dict of the form: {
-            "instances": ["vmname1", "vmname2", "vmname3", ...],
+            "instances": ["vmname1", "tenant/vmname2", "vmid3", ...],
             "batch_name": "string batch name",
             "create_tenants": True/False
         }
+        param journal: journal.ExecutionJournal: journal of previously
+        completed actions, whose checks will be skipped.
+        param batch_context: BatchTransferContext: context shared with the
+        actions of the other chunks of the same batch, if any.
         """
         super(BatchTransferAction, self).__init__(
             action_payload, source_openstack_client=source_openstack_client,
             coriolis_client=coriolis_client,
             destination_openstack_client=destination_openstack_client)
+        self.journal = journal
 
         if not self._source_openstack_client:
             raise ValueError(
@@ -455,27 +538,69 @@ class BatchTransferAction(base.BaseAction):
         self._destination_openstack_client = destination_openstack_client
         self._batch_name = self.payload.get(
             "batch_name", self.DEFAULT_BATCH_NAME)
+        self._pre_created_ports = []
+        if batch_context is None:
+            batch_context = BatchTransferContext(
+                source_openstack_client, destination_openstack_client,
+                destination_env)
+        self._batch_context = batch_context
+
+        vm_refs = action_payload.get("instances")
+        if not vm_refs:
+            raise ValueError("No VMs provided for batch: %s" % vm_refs)
+
+        # NOTE: duplicate or missing VMs are reported before gathering any
+        # further info on the VMs:
+        LOG.info("Resolving selected VMs.")
+        resolved_vms, missing = instances.resolve_source_instances(
+            self._source_openstack_client, vm_refs,
+            name_index=self._batch_context.instance_name_index)
+        duplicates = [
+            "VM: %s (tenants %s)" % (vm_ref, [
+                self._source_openstack_client.get_project_name(vm.tenant_id)
+                for vm in vms])
+            for vm_ref, vms in sorted(resolved_vms.items()) if len(vms) > 1]
+        if duplicates:
+            raise Exception(
+                "There are instances with identical names on the source. "
+                "They must either be renamed, or have %s started "
+                "manually for them. Duplicates: %s" %
+                (self.transfer_action_type + "s", duplicates))
+        if missing:
+            raise Exception(
+                "Could not locate the following VMs: %s" % missing)
 
-        vm_names = action_payload.get("instances")
-        if not vm_names:
-            raise ValueError("No VMs provided for batch: %s" % vm_names)
+        # NOTE: the same VM may have been referenced both by ID and name,
+        # possibly within previous chunks of the batch:
+        selected_vms = {}
+        for vm_ref, vms in sorted(resolved_vms.items()):
+            if vms[0].id in self._batch_context.selected_instance_ids:
+                LOG.info(
+                    "VM '%s' (ID '%s') was already selected in batch '%s', "
+                    "skipping.", vm_ref, vms[0].id, self._batch_name)
+                continue
+            selected_vms[vms[0].id] = vms[0]
+        self._batch_context.selected_instance_ids.update(selected_vms)
 
         LOG.info("Gathering info on selected VMs.")
-        vm_infos = instances.find_source_instances_by_name(
-            self._source_openstack_client, vm_names)
+        vm_infos = [
+            instances.get_source_instance_info(
+                self._source_openstack_client, vm)
+            for vm in selected_vms.values()]
+
+        # NOTE: the options of all the VMs are validated at once against
+        # the batch-wide network map and volume types:
+        instances.validate_batch_transfer_options(
+            self._source_openstack_client,
+            self._destination_openstack_client,
+            vm_infos, self._destination_env,
+            context=self._batch_context.validation_context)
 
         # instantiate all the transfer subactions:
         self._completed_transfers = []
         for vm_info in vm_infos:
-            instance_name = vm_info["instance_name"]
-            LOG.info(
-                "Validating configuration for VM: \"%s\"", instance_name)
-            instances.validate_transfer_options(
-                self._source_openstack_client,
-                self._destination_openstack_client,
-                vm_info, self._destination_env)
             subaction = self.create_transfer_subaction(vm_info)
-            done = subaction.check_already_done()
+            done = self.check_subaction(subaction)
             if done["done"]:
                 transfer_instance_name = subaction.payload["instance_name"]
                 LOG.info(
@@ -487,34 +612,11 @@ class BatchTransferAction(base.BaseAction):
                 continue
             self.subactions.append(subaction)
 
-        if len(vm_names) < len(vm_infos):
-            processed = []
-            duplicates = []
-            for vm_info in vm_infos:
-                vm_name = vm_info["instance_name"]
-                if vm_name in processed:
-                    duplicates.append("VM: %s (tenant %s)" % (
-                        vm_name, vm_info["instance_tenant_name"]))
-                processed.append(vm_name)
-            raise Exception(
-                "There are instances with identical names on the source. "
-                "They must either be renamed, or have %s started "
-                "manually for them. Duplicates: %s" %
-                (self.transfer_action_type + "s", duplicates))
-        elif len(vm_names) > len(vm_infos):
-            missing = []
-            found_ones = [vm["instance_name"] for vm in vm_infos]
-            for vm_name in vm_names:
-                if vm_name not in found_ones:
-                    missing.append(vm_name)
-            raise Exception(
-                "Could not locate the following VMs: %s", missing)
-
         self._transfer_prep_subactions = []
         for transfer_action in self.subactions:
             new_transfer_subactions = []
             for action in transfer_action.subactions:
-                action_done = action.check_already_done()
+                action_done = self.check_subaction(action)
                 if action_done["done"]:
                     LOG.info("Action already done: ")
                     action.print_operations()
@@ -552,6 +654,7 @@ class BatchTransferAction(base.BaseAction):
                 other_action.payload["instances"])
         return False
 
+    @base.cached_check
     def check_already_done(self):
         transfer_ids = []
         for migration_action in self.subactions:
@@ -568,31 +671,88 @@ class BatchTransferAction(base.BaseAction):
             "done": True,
             "result": self._completed_transfers + transfer_ids}
 
+    def add_to_plan(self, plan, depends_on=(), check=True):
+        planned_prep_actions = []
+        for action in self._transfer_prep_subactions:
+            key, = action.add_to_plan(
+                plan, depends_on=depends_on, check=check)
+            planned_prep_actions.append((action, key))
+
+        keys = [key for _, key in planned_prep_actions]
+        for transfer_action in self.subactions:
+            keys.extend(transfer_action.add_to_plan(
+                plan, depends_on=list(depends_on) + (
+                    transfer_action.get_endpoint_dependencies(
+                        planned_prep_actions)),
+                check=check))
+
+        return keys
+
+    def pre_create_neutron_ports(self):
+        """ Pre-creates the destination Neutron ports of all the VMs in the
+        batch in bulk, and hands them over to the transfer subactions. """
+        instance_infos = [
+            action.payload for action in self.subactions]
+        if not instance_infos:
+            return
+
+        LOG.info(
+            "Pre-creating destination ports for all VMs in batch '%s'.",
+            self._batch_name)
+
+        def _on_created(created):
+            # NOTE: the ports are recorded as soon as each bulk creation
+            # request succeeds, so they get cleaned up even if a later one
+            # fails:
+            self._pre_created_ports.extend(created)
+            for port in created:
+                self.record_created(rollback.RESOURCE_TYPE_PORT, port['id'])
+
+        instance_ports, _ = ports.replicate_instance_ports(
+            self._source_openstack_client, self._destination_openstack_client,
+            instance_infos, self._destination_env['network_map'],
+            on_created=_on_created)
+
+        for action in self.subactions:
+            action.set_pre_created_ports(
+                instance_ports[action.payload['instance_id']])
+
     def execute_operations(self):
         # perform all subactions:
         for action in self._transfer_prep_subactions:
-            action.execute_operations()
+            self.execute_subaction(action)
+
+        if CONF.destination.pre_create_neutron_ports:
+            self.pre_create_neutron_ports()
 
         # start migrations:
         transfers = []
         for transfer_action in self.subactions:
             # NOTE: we pre-executed the subtasks:
             transfers.append(
-                transfer_action.execute_operations(
-                    subtasks_pre_executed=True))
+                self.execute_subaction(
+                    transfer_action, subtasks_pre_executed=True))
 
         # LOG.info("### Existing migrations: %s", self._completed_migrations)
         # LOG.info("### New migration ids: %s" % migration_ids)
         # done_ids = [migr["existing_migration_id"]
         #             for migr in self._completed_migrations]
 
+        self.invalidate_check()
         return transfers
 
     def cleanup(self):
+        if self.rollback_created_resources():
+            return
         for action in self.subactions:
             action.cleanup()
         for action in self._transfer_prep_subactions:
             action.cleanup()
+        for port in self._pre_created_ports:
+            LOG.info("Deleting pre-created destination port '%s'", port['id'])
+            self._destination_openstack_client.neutron.delete_port(
+                port['id'])
+        self.invalidate_check()
 
 
 class BatchMigrationAction(BatchTransferAction):
@@ -6,7 +6,10 @@
 from oslo_log import log as logging
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
+from coriolis_openstack_utils import utils
 from coriolis_openstack_utils.actions import base
+from coriolis_openstack_utils.resource_utils import records
 
 import novaclient.exceptions
 import keystoneauth1.exceptions.http
@@ -14,6 +17,58 @@ import keystoneauth1.exceptions.http
 CONF = conf.CONF
 LOG = logging.getLogger(__name__)
 
+FLAVOR_RELEVANT_KEYS = ['ram', 'disk', 'vcpus', 'rxtx_factor']
+
+
+def get_destination_tenant_ids(source_client, destination_client,
+                               src_tenant_ids):
+    """ Returns a dict mapping the given source tenant IDs to the IDs of
+    their destination tenants, resolved through the recorded ID mappings or
+    else with a single project listing of each cloud. The tenants which
+    cannot be resolved are only logged and left out.
+    """
+    dest_tenant_ids = conf.get_id_mapping_store().get_destination_ids(
+        rollback.RESOURCE_TYPE_TENANT, src_tenant_ids,
+        validator=destination_client.get_project_names)
+    unmapped_tenant_ids = set(src_tenant_ids) - set(dest_tenant_ids)
+    if not unmapped_tenant_ids:
+        return dest_tenant_ids
+
+    src_tenant_names = {
+        project.id: project.name for project in source_client.list_projects()
+        if project.id in unmapped_tenant_ids}
+    # NOTE: the source listing may be restricted to the tenants of the user:
+    for tenant_id in unmapped_tenant_ids - set(src_tenant_names):
+        try:
+            src_tenant_names[tenant_id] = source_client.get_project_name(
+                tenant_id)
+        except keystoneauth1.exceptions.http.Forbidden:
+            LOG.warn("Cannot fetch source tenant \"%s\"'s name for "
+                     "destination mapping. " % tenant_id)
+        except keystoneauth1.exceptions.http.NotFound:
+            LOG.warn("Cannot find source tenant \"%s\" for destination "
+                     "mapping. " % tenant_id)
+
+    dest_projects = {}
+    for project in destination_client.list_projects():
+        dest_projects.setdefault(project.name, []).append(project.id)
+    for tenant_id, tenant_name in src_tenant_names.items():
+        dest_tenant_name = CONF.destination.new_tenant_name_format % {
+            'original': tenant_name}
+        project_ids = dest_projects.get(dest_tenant_name, [])
+        if len(project_ids) == 1:
+            dest_tenant_ids[tenant_id] = project_ids[0]
+        elif project_ids:
+            LOG.warn("Found multiple destination tenants named \"%s\". "
+                     "No flavor access will be added to them. "
+                     % dest_tenant_name)
+        else:
+            LOG.warn("Cannot find destination tenant named \"%s\". "
+                     "No flavor access will be added to this tenant. "
+                     % dest_tenant_name)
+
+    return dest_tenant_ids
+
 
 class FlavorCreationAction(base.BaseAction):
     """ Action for creating flavors on the destination.
@@ -31,38 +86,37 @@ class FlavorCreationAction(base.BaseAction):
         return CONF.destination.new_flavor_name_format
 
     def check_same_flavor(self, src_flavor, dest_flavor):
-        relevant_keys = ['ram', 'disk', 'vcpus', 'rxtx_factor']
-        dest_flavor_info = {k: v for k, v in dest_flavor.items()
-                            if k in relevant_keys}
-        src_flavor_info = {k: v for k, v in src_flavor.items()
-                           if k in relevant_keys}
-
-        if (src_flavor_info == dest_flavor_info and
+        if (utils.fingerprint(src_flavor, keys=FLAVOR_RELEVANT_KEYS) ==
+                utils.fingerprint(dest_flavor, keys=FLAVOR_RELEVANT_KEYS) and
                 dest_flavor['name'] == self.get_new_flavor_name()):
             return True
 
         return False
 
+    @base.cached_check
     def check_already_done(self):
-        dest_flavor_name = self.get_new_flavor_name()
-
         src_flavor_id = self.payload['src_flavor_id']
-        src_flavor = self._source_openstack_client.nova.flavors.get(
-            src_flavor_id)
+        src_flavor = self.get_source_flavor()
 
         dest_flavor_name = self.get_new_flavor_name()
         dest_flavor = None
         try:
             dest_flavor = self._destination_openstack_client.nova.flavors.find(
                 name=dest_flavor_name, is_public=None)
-            if self.check_same_flavor(src_flavor.to_dict(),
-                                      dest_flavor.to_dict()):
-                return {"done": True, "result": dest_flavor.to_dict()}
+            src_flavor_info = src_flavor.to_dict()
+            dest_flavor_info = dest_flavor.to_dict()
+            if self.check_same_flavor(src_flavor_info, dest_flavor_info):
+                return {"done": True, "result": dest_flavor_info}
             else:
+                differences = utils.structural_diff(
+                    utils.project(src_flavor_info, FLAVOR_RELEVANT_KEYS),
+                    utils.project(dest_flavor_info, FLAVOR_RELEVANT_KEYS))
                 raise Exception("Found destination flavor named \"%s\", but "
                                 "with different properties than source flavor "
-                                "\"%s\" !" %
-                                (dest_flavor_name, src_flavor_id))
+                                "\"%s\" (source, destination): %s" % (
+                                    dest_flavor_name, src_flavor_id, {
+                                        path[0]: (old, new) for
+                                        path, old, new in differences}))
 
         except novaclient.exceptions.NotFound:
             return {"done": False, "result": None}
@@ -81,14 +135,25 @@ class FlavorCreationAction(base.BaseAction):
             "Create new destination flavor named \"%s\" with sources' "
             "properties." % (dest_flavor_name))
 
+    def get_source_flavor(self):
+        return self.resolve_state(
+            'source_flavor',
+            lambda: records.flavor_record(
+                self._source_openstack_client.nova.flavors.get(
+                    self.payload['src_flavor_id'])))
+
     def get_new_flavor_name(self):
         return self.flavor_name_format % {
-            "original": self._source_openstack_client.nova.flavors.get(
-                self.payload['src_flavor_id']).name}
+            "original": self.get_source_flavor().name}
+
+    def record_flavor_mapping(self, dest_flavor_id):
+        self.record_mapping(
+            rollback.RESOURCE_TYPE_FLAVOR, self.payload['src_flavor_id'],
+            dest_flavor_id, source_name=self.get_source_flavor().name,
+            destination_name=self.get_new_flavor_name())
 
     def create_flavor_body(self):
-        src_flavor = self._source_openstack_client.nova.flavors.get(
-            self.payload['src_flavor_id'])
+        src_flavor = self.get_source_flavor()
         relevant_keys = ['ram', 'disk', 'vcpus', 'swap', 'rxtx_factor']
         src_flavor_info = src_flavor.to_dict()
         body = {k: v for k, v in src_flavor_info.items()
@@ -109,41 +174,31 @@ class FlavorCreationAction(base.BaseAction):
         body['name'] = self.get_new_flavor_name()
         return body
 
+    def get_source_access_tenant_ids(self):
+        return self.resolve_state(
+            'source_access_tenant_ids',
+            lambda: [
+                access.tenant_id for access in
+                self._source_openstack_client.nova.flavor_access.list(
+                    flavor=self.payload['src_flavor_id'])])
+
+    def get_destination_access_tenant_ids(self):
+        """ Returns a dict mapping the IDs of the source tenants with access
+        to the source flavor to the IDs of their destination tenants. """
+        return self.resolve_state(
+            'destination_access_tenant_ids',
+            lambda: get_destination_tenant_ids(
+                self._source_openstack_client,
+                self._destination_openstack_client,
+                self.get_source_access_tenant_ids()))
+
     def add_tenant_access_to_flavor(self, dest_flavor_id):
-        access_list = self._source_openstack_client.nova.flavor_access.list(
-            flavor=self.payload['src_flavor_id'])
-        src_tenant_ids = [access.tenant_id for access in access_list]
-        src_tenant_names = []
-        for tenant_id in src_tenant_ids:
-            try:
-                tenant_name = self._source_openstack_client.get_project_name(
-                    tenant_id)
-                src_tenant_names.append(tenant_name)
-            except keystoneauth1.exceptions.http.Forbidden:
-                LOG.warn("Cannot fetch source tenant \"%s\"'s name for "
-                         "destination mapping. " % tenant_id)
-            except keystoneauth1.exceptions.http.NotFound:
-                LOG.warn("Cannot find source tenant \"%s\" for destination "
-                         "mapping. ")
-        dest_tenant_names = [CONF.destination.new_tenant_name_format %
-                             {'original': tenant_name} for tenant_name in
-                             src_tenant_names]
         flavor_access = self._destination_openstack_client.nova.flavor_access
-        for tenant_name in dest_tenant_names:
-            try:
-                tenant_id = self._destination_openstack_client.get_project_id(
-                        tenant_name)
-                flavor_access.add_tenant_access(dest_flavor_id, tenant_id)
-                LOG.info("Adding access for tenant \"%s\" to flavor \"%s\""
-                         % (tenant_id, dest_flavor_id))
-            except keystoneauth1.exceptions.http.Forbidden:
-                LOG.warn("Cannot fetch id of destination tenant named \"%s\" "
-                         "due to lack of priviledges of current user. "
-                         "No flavor access will be added to this tenant. "
-                         % tenant_name)
-            except keystoneauth1.exceptions.http.NotFound:
-                LOG.warn("Cannot find destination tenant named \"%s\". "
-                         "No flavor access will be added to this tenant. ")
+        for tenant_id in sorted(
+                self.get_destination_access_tenant_ids().values()):
+            flavor_access.add_tenant_access(dest_flavor_id, tenant_id)
+            LOG.info("Adding access for tenant \"%s\" to flavor \"%s\""
+                     % (tenant_id, dest_flavor_id))
 
     def execute_operations(self):
         super(FlavorCreationAction, self).print_operations()
@@ -153,6 +208,7 @@ class FlavorCreationAction(base.BaseAction):
             LOG.info(
                 "Flavor named '%s' already exists.",
                 dest_flavor_name)
+            self.record_flavor_mapping(done["result"]['id'])
             return done["result"]
 
         LOG.info("Creating destination flavor with name '%s'" %
@@ -160,6 +216,9 @@ class FlavorCreationAction(base.BaseAction):
         body = self.create_flavor_body()
         dest_nova = self._destination_openstack_client.nova
         dest_flavor = dest_nova.flavors.create(**body)
+        self.record_created(rollback.RESOURCE_TYPE_FLAVOR, dest_flavor.id)
+        self.record_flavor_mapping(dest_flavor.id)
+        self.invalidate_check()
         if not dest_flavor.is_public:
             self.add_tenant_access_to_flavor(dest_flavor)
 
@@ -169,3 +228,184 @@ class FlavorCreationAction(base.BaseAction):
         dest_flavor = self._destination_openstack_client.nova.flavors.find(
             name=self.get_new_flavor_name(), is_public=None)
         self._destination_openstack_client.nova.flavors.delete(dest_flavor)
+        self.invalidate_check()
+
+
+class BatchFlavorReplicationAction(base.BaseAction):
+    """ Action for replicating the source flavors all at once.
+    The flavors of both clouds are listed only once and diffed by their
+    names and fingerprints, so that only the missing flavors get a
+    `FlavorCreationAction` subaction. The tenant access lists of the missing
+    private flavors are then resolved in a single pass.
+    param action_payload: dict(): payload (params) for the action
+    may contain 'src_flavor_ids' (default: all source flavors)
+    """
+
+    action_type = base.ACTION_TYPE_BATCH_REPLICATE_FLAVORS
+
+    @property
+    def flavor_name_format(self):
+        return CONF.destination.new_flavor_name_format
+
+    def get_flavor_diff(self):
+        """ Returns a dict of the form: {
+            "missing": [<source flavor>, ...],
+            "equivalent": [(<source flavor>, <destination flavor>), ...]
+        }
+        Raises if any destination flavor bears the name of a source flavor
+        but has different properties.
+        """
+        return self.resolve_state('flavor_diff', self._diff_flavors)
+
+    def _diff_flavors(self):
+        # NOTE: the flavors are held as compact records for the lifetime of
+        # the diff, instead of the novaclient objects:
+        src_flavors = [
+            records.flavor_record(flavor) for flavor in
+            self._source_openstack_client.nova.flavors.list(is_public=None)]
+        if self.payload.get('src_flavor_ids') is not None:
+            src_flavor_ids = set(self.payload['src_flavor_ids'])
+            src_flavors = [
+                flavor for flavor in src_flavors
+                if flavor.id in src_flavor_ids]
+        dest_flavors = [
+            records.flavor_record(flavor) for flavor in
+            self._destination_openstack_client.nova.flavors.list(
+                is_public=None)]
+
+        dest_by_key = {}
+        dest_by_name = {}
+        for dest_flavor in dest_flavors:
+            dest_by_key.setdefault((dest_flavor.name, utils.fingerprint(
+                dest_flavor, keys=FLAVOR_RELEVANT_KEYS)), dest_flavor)
+            dest_by_name.setdefault(dest_flavor.name, dest_flavor)
+
+        flavor_diff = {"missing": [], "equivalent": []}
+        conflicts = {}
+        for src_flavor in src_flavors:
+            dest_flavor_name = self.flavor_name_format % {
+                "original": src_flavor.name}
+            dest_flavor = dest_by_key.get((dest_flavor_name, utils.fingerprint(
+                src_flavor, keys=FLAVOR_RELEVANT_KEYS)))
+            if dest_flavor is not None:
+                flavor_diff["equivalent"].append((src_flavor, dest_flavor))
+            elif dest_flavor_name in dest_by_name:
+                conflicts[dest_flavor_name] = {
+                    path[0]: (old, new) for path, old, new in
+                    utils.structural_diff(
+                        utils.project(src_flavor, FLAVOR_RELEVANT_KEYS),
+                        utils.project(
+                            dest_by_name[dest_flavor_name],
+                            FLAVOR_RELEVANT_KEYS))}
+            else:
+                flavor_diff["missing"].append(src_flavor)
+
+        if conflicts:
+            raise Exception(
+                "Found destination flavors with the names of source flavors, "
+                "but with different properties (source, destination): %s" % (
+                    conflicts))
+
+        LOG.info(
+            "Found %d source flavor(s) missing on destination, %d already "
+            "replicated.", len(flavor_diff["missing"]),
+            len(flavor_diff["equivalent"]))
+        return flavor_diff
+
+    def prepare_subactions(self):
+        """ Instantiates the subactions for creating the missing flavors,
+        which need no further checks as they were already diffed. """
+        self.subactions = []
+        not_done = {"done": False, "result": None}
+        for src_flavor in self.get_flavor_diff()["missing"]:
+            flavor_creation_action = FlavorCreationAction(
+                {'src_flavor_id': src_flavor.id},
+                source_openstack_client=self._source_openstack_client,
+                destination_openstack_client=(
+                    self._destination_openstack_client))
+            flavor_creation_action.set_state('source_flavor', src_flavor)
+            flavor_creation_action.set_check_result(not_done)
+            self.subactions.append(flavor_creation_action)
+
+    def _resolve_flavors_access(self):
+        """ Resolves the destination tenants with access to all the missing
+        private flavors in one pass. """
+        private_flavor_actions = [
+            action for action in self.subactions
+            if not action.get_source_flavor().to_dict().get(
+                'os-flavor-access:is_public', True)]
+        if not private_flavor_actions:
+            return
+
+        access_lists = utils.run_concurrently(
+            FlavorCreationAction.get_source_access_tenant_ids,
+            [(action,) for action in private_flavor_actions],
+            max_workers=CONF.source.max_concurrent_requests)
+        dest_tenant_ids = get_destination_tenant_ids(
+            self._source_openstack_client, self._destination_openstack_client,
+            [tenant_id for access_list in access_lists
+             for tenant_id in access_list])
+        for action, access_list in zip(private_flavor_actions, access_lists):
+            action.set_state('destination_access_tenant_ids', {
+                tenant_id: dest_tenant_ids[tenant_id]
+                for tenant_id in access_list if tenant_id in dest_tenant_ids})
+
+    @base.cached_check
+    def check_already_done(self):
+        flavor_diff = self.get_flavor_diff()
+        if flavor_diff["missing"]:
+            return {"done": False, "result": None}
+        return {"done": True, "result": [
+            dest_flavor.to_dict()
+            for _, dest_flavor in flavor_diff["equivalent"]]}
+
+    def equivalent_to(self, other_action):
+        if other_action.action_type == self.action_type:
+            if self.payload.get('src_flavor_ids') == (
+                    other_action.payload.get('src_flavor_ids')):
+                return True
+        return False
+
+    def print_operations(self):
+        self.prepare_subactions()
+        super(BatchFlavorReplicationAction, self).print_operations()
+
+    def add_to_plan(self, plan, depends_on=(), check=True):
+        self.prepare_subactions()
+        keys = []
+        for action in self.subactions:
+            keys.extend(action.add_to_plan(
+                plan, depends_on=depends_on, check=False))
+        return keys
+
+    def execute_operations(self):
+        self.prepare_subactions()
+        flavors = []
+        for src_flavor, dest_flavor in self.get_flavor_diff()["equivalent"]:
+            self.record_mapping(
+                rollback.RESOURCE_TYPE_FLAVOR, src_flavor.id, dest_flavor.id,
+                source_name=src_flavor.name,
+                destination_name=dest_flavor.name)
+            flavors.append(dest_flavor.to_dict())
+
+        if self.subactions:
+            LOG.info(
+                "Creating %d missing destination flavor(s).",
+                len(self.subactions))
+            self._resolve_flavors_access()
+            flavors.extend(utils.run_concurrently(
+                self.execute_subaction,
+                [(action,) for action in self.subactions],
+                max_workers=CONF.destination.max_concurrent_requests))
+
+        self.invalidate_state('flavor_diff')
+        self.invalidate_check()
+        return flavors
+
+    def cleanup(self):
+        if self.rollback_created_resources():
+            return
+        for action in self.subactions:
+            action.cleanup()
+        self.invalidate_state('flavor_diff')
+        self.invalidate_check()
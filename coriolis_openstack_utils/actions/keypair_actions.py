@@ -8,6 +8,7 @@ import keystoneauth1.exceptions.http
 from oslo_log import log as logging
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
 from coriolis_openstack_utils.actions import base
 from coriolis_openstack_utils.resource_utils import users
 
@@ -34,6 +35,10 @@ class KeypairCreationAction(base.BaseAction):
         return CONF.destination.new_keypair_name_format
 
     def get_source_keypair(self):
+        return self.resolve_state(
+            'source_keypair', self._get_source_keypair)
+
+    def _get_source_keypair(self):
         src_nova = self._source_openstack_client.nova
         src_keypair_name = self.payload['src_keypair_name']
         src_user_id = self.payload.get('src_user_id', None)
@@ -46,6 +51,30 @@ class KeypairCreationAction(base.BaseAction):
 
         return src_keypair
 
+    def get_destination_user_id(self, src_user_id):
+        """ Returns the ID of the destination user the source user was
+        migrated to, or None if there is no such user. """
+        return self.resolve_state(
+            ('destination_user_id', src_user_id),
+            lambda: self._get_destination_user_id(src_user_id))
+
+    def _get_destination_user_id(self, src_user_id):
+        mapped_id = conf.get_id_mapping_store().get_destination_id(
+            rollback.RESOURCE_TYPE_USER, src_user_id,
+            validator=lambda user_ids: users.get_user_names(
+                self._destination_openstack_client, user_ids))
+        if mapped_id:
+            return mapped_id
+
+        src_user = users.get_user(self._source_openstack_client, src_user_id)
+        dest_user_name = CONF.destination.new_user_name_format % {
+            'original': src_user.name}
+        try:
+            dest_keystone = self._destination_openstack_client.keystone
+            return dest_keystone.users.find(name=dest_user_name).id
+        except keystoneauth1.exceptions.http.NotFound:
+            return None
+
     def get_destination_keypair(self, src_keypair):
         dest_nova = self._destination_openstack_client.nova
         dest_keypair_name = self.get_new_keypair_name()
@@ -54,19 +83,15 @@ class KeypairCreationAction(base.BaseAction):
                 dest_nova.api_version.get_string()) < 2.10:
             dest_keypair = dest_nova.keypairs.get(dest_keypair_name)
         else:
-            src_user = users.get_user(self._source_openstack_client,
-                                      src_user_id)
-            dest_user_name = CONF.destination.new_user_name_format % {
-                'original': src_user.name}
-            try:
-                dest_keystone = self._destination_openstack_client.keystone
-                dest_user = dest_keystone.users.find(name=dest_user_name)
+            dest_user_id = self.get_destination_user_id(src_user_id)
+            if dest_user_id:
                 dest_keypair = dest_nova.keypairs.get(
-                    dest_keypair_name, user_id=dest_user.id)
-            except keystoneauth1.exceptions.http.NotFound:
+                    dest_keypair_name, user_id=dest_user_id)
+            else:
                 dest_keypair = dest_nova.keypairs.get(dest_keypair_name)
         return dest_keypair
 
+    @base.cached_check
     def check_already_done(self):
         src_keypair = self.get_source_keypair()
         dest_keypair = None
@@ -126,24 +151,20 @@ class KeypairCreationAction(base.BaseAction):
         src_user_id = src_keypair.user_id
         src_public_keypair = src_keypair.public_key
 
-        src_user = users.get_user(self._source_openstack_client, src_user_id)
-        src_user_name = src_user.name
-        dest_user_name = (CONF.destination.new_user_name_format %
-                          {'original': src_user_name})
         dest_keypair_kwargs = {'public_key': src_public_keypair}
         if float(dest_nova.api_version.get_string()) >= 2.10:
-            try:
-                dest_keystone = self._destination_openstack_client.keystone
-                dest_user = dest_keystone.users.find(name=dest_user_name)
-                user_id = dest_user.id
-                dest_keypair_kwargs['user_id'] = user_id
-            except keystoneauth1.exceptions.http.NotFound:
-                pass
+            dest_user_id = self.get_destination_user_id(src_user_id)
+            if dest_user_id:
+                dest_keypair_kwargs['user_id'] = dest_user_id
 
         LOG.info("Creating destination keypair with name '%s' and kwargs"
                  "\"%s\" " % (dest_keypair_name, dest_keypair_kwargs))
         dest_keypair = dest_nova.keypairs.create(
             dest_keypair_name, **dest_keypair_kwargs)
+        self.record_created(
+            rollback.RESOURCE_TYPE_KEYPAIR,
+            (dest_keypair_name, dest_keypair_kwargs.get('user_id')))
+        self.invalidate_check()
         return dest_keypair.to_dict()
 
     def cleanup(self):
@@ -159,3 +180,4 @@ class KeypairCreationAction(base.BaseAction):
             dest_nova.keypairs(dest_keypair.name, user_id=dest_keypair.user_id)
         else:
             dest_keypair.delete()
+        self.invalidate_check()
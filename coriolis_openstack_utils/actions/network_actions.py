@@ -2,13 +2,16 @@
 # All Rights Reserved.
 
 """ Module defining OpenStack security-group-related actions. """
-import ipaddress
 
 from oslo_log import log as logging
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
 from coriolis_openstack_utils.actions import base
 from coriolis_openstack_utils.resource_utils import networks, subnets, routers
+from coriolis_openstack_utils.resource_utils import ports
+from coriolis_openstack_utils.resource_utils import records
+from coriolis_openstack_utils.resource_utils import tags
 
 CONF = conf.CONF
 LOG = logging.getLogger(__name__)
@@ -30,19 +33,31 @@ class SubnetCreationAction(base.BaseAction):
     def subnet_name_format(self):
         return CONF.destination.new_subnet_name_format
 
+    @base.cached_check
     def check_already_done(self):
-        src_tenant_id = self.get_source_tenant_id()
         src_subnet_name = self.payload['source_name']
 
         dest_network_id = self.payload['dest_network_id']
         dest_subnet_name = self.get_new_subnet_name()
 
+        src_subnet_id = self.get_source_subnet()['id']
+        tagged = tags.list_tagged_resources(
+            lambda filters, fields: subnets.list_subnets(
+                self._destination_openstack_client,
+                filters=dict(filters, network_id=dest_network_id),
+                fields=fields),
+            src_subnet_id)
+        if tagged:
+            LOG.info("Found destination subnet '%s' tagged with source subnet "
+                     "'%s'." % (tagged[0]['id'], src_subnet_id))
+            self.set_state(('destination_tagged', tagged[0]['id']), True)
+            return {"done": True, "result": tagged[0]['id']}
+
         conflicting = subnets.list_subnets(
             self._destination_openstack_client,
             filters={'network_id': dest_network_id, 'name': dest_subnet_name})
 
-        src_subnet = subnets.get_body(
-            self._source_openstack_client, src_tenant_id, src_subnet_name)
+        src_subnet = self.get_source_subnet_body()
 
         for subnet in conflicting:
             if subnets.check_subnet_similarity(subnet, src_subnet):
@@ -89,7 +104,11 @@ class SubnetCreationAction(base.BaseAction):
         return self.subnet_name_format % {
             "original": self.payload["source_name"]}
 
-    def get_source_tenant_id(self):
+    def get_source_subnet(self):
+        return self.resolve_state(
+            'source_subnet', self._get_source_subnet)
+
+    def _get_source_subnet(self):
         src_subnet_list = subnets.list_subnets(
             self._source_openstack_client,
             filters={'network_id': self.payload['src_network_id'],
@@ -100,27 +119,43 @@ class SubnetCreationAction(base.BaseAction):
                             % (self.payload['source_name'],
                                self.payload['src_network_id']))
 
-        src_subnet = src_subnet_list[0]
+        return src_subnet_list[0]
+
+    def get_source_tenant_id(self):
+        src_subnet = self.get_source_subnet()
 
         return (src_subnet.get('tenant_id') or
                 src_subnet.get('project_id'))
 
+    def record_subnet_mapping(self, dest_subnet_id):
+        self.record_mapping(
+            rollback.RESOURCE_TYPE_SUBNET, self.get_source_subnet()['id'],
+            dest_subnet_id, source_name=self.payload['source_name'],
+            destination_name=self.get_new_subnet_name())
+
+    def get_source_subnet_body(self):
+        return self.resolve_state(
+            'source_subnet_body', lambda: subnets.get_body(
+                self._source_openstack_client, self.get_source_tenant_id(),
+                self.payload['source_name']))
+
+    def get_destination_network(self):
+        return self.resolve_state(
+            'destination_network', lambda: networks.get_network(
+                self._destination_openstack_client,
+                self.payload['dest_network_id']))
+
     def get_destination_tenant_id(self):
-        dest_network = networks.get_network(
-            self._destination_openstack_client,
-            self.payload['dest_network_id'])
+        dest_network = self.get_destination_network()
 
         return (dest_network.get('tenant_id') or
                 dest_network.get('project_id'))
 
     def create_subnet_body(self, description):
-        src_subnet_name = self.payload['source_name']
-        src_tenant_id = self.get_source_tenant_id()
         dest_tenant_id = self.get_destination_tenant_id()
         dest_subnet_name = self.get_new_subnet_name()
         dest_network_id = self.payload['dest_network_id']
-        src_body = subnets.get_body(
-            self._source_openstack_client, src_tenant_id, src_subnet_name)
+        src_body = self.get_source_subnet_body()
         body = {'name': dest_subnet_name,
                 'tenant_id': dest_tenant_id,
                 'project_id': dest_tenant_id,
@@ -142,6 +177,9 @@ class SubnetCreationAction(base.BaseAction):
             LOG.info(
                 "Subnet named '%s' already exists.",
                 dest_subnet_name)
+            self.record_subnet_mapping(done["result"])
+            self.tag_destination_resource(
+                'subnets', done["result"], self.get_source_subnet()['id'])
             return done["result"]
 
         LOG.info("Creating destination Subnet with name '%s'" %
@@ -151,8 +189,12 @@ class SubnetCreationAction(base.BaseAction):
         body = self.create_subnet_body(description)
         dest_subnet_id = subnets.create_subnet(
             self._destination_openstack_client, body)
-        dest_network_name = networks.get_network(
-            self._destination_openstack_client, dest_network_id)['name']
+        self.record_created(rollback.RESOURCE_TYPE_SUBNET, dest_subnet_id)
+        self.record_subnet_mapping(dest_subnet_id)
+        self.tag_destination_resource(
+            'subnets', dest_subnet_id, self.get_source_subnet()['id'])
+        self.invalidate_check()
+        dest_network_name = self.get_destination_network()['name']
         dest_subnet = {
             'destination_name': dest_subnet_name,
             'destination_id': dest_subnet_id,
@@ -165,6 +207,7 @@ class SubnetCreationAction(base.BaseAction):
         subnets.delete_subnet(
             self._destination_openstack_client,
             self.payload['dest_network_id'], self.get_new_subnet_name())
+        self.invalidate_check()
 
 
 class NetworkCreationAction(base.BaseAction):
@@ -181,10 +224,22 @@ class NetworkCreationAction(base.BaseAction):
     def network_name_format(self):
         return CONF.destination.new_network_name_format
 
+    @base.cached_check
     def check_already_done(self):
-        src_network = networks.get_network(
-            self._source_openstack_client, self.payload['src_network_id'])
-
+        src_network_id = self.payload['src_network_id']
+        tagged = tags.list_tagged_resources(
+            lambda filters, fields: networks.list_networks(
+                self._destination_openstack_client,
+                self.payload['dest_tenant_id'], filters=filters,
+                fields=fields),
+            src_network_id)
+        if tagged:
+            LOG.info("Found destination network '%s' tagged with source "
+                     "network '%s'." % (tagged[0]['id'], src_network_id))
+            self.set_state(('destination_tagged', tagged[0]['id']), True)
+            return {"done": True, "result": tagged[0]['id']}
+
+        src_network = self.get_source_network()
         dest_network_name = self.get_new_network_name()
         conflicting = networks.list_networks(
             self._destination_openstack_client, self.payload['dest_tenant_id'],
@@ -226,15 +281,26 @@ class NetworkCreationAction(base.BaseAction):
         LOG.info(
             "Create new destination network named '%s'." % network_name)
 
+    def get_source_network(self):
+        return self.resolve_state(
+            'source_network', lambda: records.network_record(
+                networks.get_network(
+                    self._source_openstack_client,
+                    self.payload['src_network_id'])))
+
     def get_source_network_name(self):
-        return networks.get_network(
-            self._source_openstack_client,
-            self.payload['src_network_id'])['name']
+        return self.get_source_network()['name']
 
     def get_new_network_name(self):
         return self.network_name_format % {
             "original": self.get_source_network_name()}
 
+    def record_network_mapping(self, dest_network_id):
+        self.record_mapping(
+            rollback.RESOURCE_TYPE_NETWORK, self.payload['src_network_id'],
+            dest_network_id, source_name=self.get_source_network_name(),
+            destination_name=self.get_new_network_name())
+
     def execute_operations(self):
         super(NetworkCreationAction, self).print_operations()
         done = self.check_already_done()
@@ -243,6 +309,9 @@ class NetworkCreationAction(base.BaseAction):
             LOG.info(
                 "Network named '%s' already exists.",
                 dest_network_name)
+            self.record_network_mapping(done["result"])
+            self.tag_destination_resource(
+                'networks', done["result"], self.payload['src_network_id'])
             return done["result"]
 
         LOG.info("Creating destination Network with name '%s'" %
@@ -258,10 +327,13 @@ class NetworkCreationAction(base.BaseAction):
 
         dest_network_id = networks.create_network(
             self._destination_openstack_client, body)
+        self.record_created(rollback.RESOURCE_TYPE_NETWORK, dest_network_id)
+        self.record_network_mapping(dest_network_id)
+        self.tag_destination_resource(
+            'networks', dest_network_id, self.payload['src_network_id'])
+        self.invalidate_check()
 
-        src_subnet_ids = networks.get_network(
-            self._source_openstack_client,
-            self.payload['src_network_id'])['subnets']
+        src_subnet_ids = self.get_source_network()['subnets']
 
         src_subnet_names = [
             subnets.get_subnet(
@@ -279,7 +351,7 @@ class NetworkCreationAction(base.BaseAction):
                 destination_openstack_client=(
                     self._destination_openstack_client))
             self.subactions.append(subnet_migration_action)
-            subnet_migration_action.execute_operations()
+            self.execute_subaction(subnet_migration_action)
 
         dest_network = {
             'destination_name': dest_network_name,
@@ -292,9 +364,12 @@ class NetworkCreationAction(base.BaseAction):
         return dest_network
 
     def cleanup(self):
+        if self.rollback_created_resources():
+            return
         networks.delete_network(
             self._destination_openstack_client,
             self.payload['dest_tenant_id'], self.get_new_network_name())
+        self.invalidate_check()
 
 
 class RouterCreationAction(base.BaseAction):
@@ -309,9 +384,24 @@ class RouterCreationAction(base.BaseAction):
     NEW_ROUTER_DESCRIPTION_FORMAT = (
         "Created by the Coriolis OpenStack utilities for source router '%s'.")
 
+    @base.cached_check
     def check_already_done(self):
-        src_router = routers.get_router(
-            self._source_openstack_client, self.payload['src_router_id'])
+        src_router_id = self.payload['src_router_id']
+        dest_tenant_id = self.payload['dest_tenant_id']
+        tagged = tags.list_tagged_resources(
+            lambda filters, fields: routers.list_routers(
+                self._destination_openstack_client,
+                filters=dict(filters, project_id=dest_tenant_id,
+                             tenant_id=dest_tenant_id),
+                fields=fields),
+            src_router_id)
+        if tagged:
+            LOG.info("Found destination router '%s' tagged with source router "
+                     "'%s'." % (tagged[0]['id'], src_router_id))
+            self.set_state(('destination_tagged', tagged[0]['id']), True)
+            return {"done": True, "result": tagged[0]['id']}
+
+        src_router = self.get_source_router()
         dest_router_name = self.get_new_router_name()
         conflicting = routers.list_routers(
             self._destination_openstack_client, {'name': dest_router_name})
@@ -349,15 +439,32 @@ class RouterCreationAction(base.BaseAction):
         LOG.info(
             "Create new destination router named '%s'." % router_name)
 
+    def get_source_router(self):
+        return self.resolve_state(
+            'source_router', lambda: records.router_record(
+                routers.get_router(
+                    self._source_openstack_client,
+                    self.payload['src_router_id'])))
+
     def get_source_router_name(self):
-        return routers.get_router(
-            self._source_openstack_client,
-            self.payload['src_router_id'])['name']
+        return self.get_source_router()['name']
+
+    def get_destination_external_network_ids(self):
+        return self.resolve_state(
+            'destination_external_network_ids',
+            lambda: networks.get_external_network_ids(
+                self._destination_openstack_client))
 
     def get_new_router_name(self):
         return CONF.destination.new_router_name_format % {
             "original": self.get_source_router_name()}
 
+    def record_router_mapping(self, dest_router_id):
+        self.record_mapping(
+            rollback.RESOURCE_TYPE_ROUTER, self.payload['src_router_id'],
+            dest_router_id, source_name=self.get_source_router_name(),
+            destination_name=self.get_new_router_name())
+
     def execute_operations(self):
         super(RouterCreationAction, self).print_operations()
         done = self.check_already_done()
@@ -366,6 +473,9 @@ class RouterCreationAction(base.BaseAction):
             LOG.info(
                 "Router named '%s' already exists.",
                 dest_router_name)
+            self.record_router_mapping(done["result"])
+            self.tag_destination_resource(
+                'routers', done["result"], self.payload['src_router_id'])
             return done["result"]
 
         LOG.info("Creating destination Router with name '%s'" %
@@ -381,12 +491,21 @@ class RouterCreationAction(base.BaseAction):
             'dest_tenant_id']
         migr_info['migration_body']['tenant_id'] = self.payload[
             'dest_tenant_id']
+        external_network_ids = None
+        if migr_info['src_ext_net_names']:
+            external_network_ids = (
+                self.get_destination_external_network_ids())
         router_id = routers.create_router(
-            self._destination_openstack_client, migr_info)
+            self._destination_openstack_client, migr_info,
+            external_network_ids=external_network_ids)
+        self.record_created(rollback.RESOURCE_TYPE_ROUTER, router_id)
+        self.record_router_mapping(router_id)
+        self.tag_destination_resource(
+            'routers', router_id, self.payload['src_router_id'])
+        self.invalidate_check()
 
         if self.payload.get('copy_routes') or CONF.destination.copy_routes:
-            src_routes = routers.get_source_routes(
-                self._source_openstack_client, self.payload['src_router_id'])
+            src_routes = self.get_source_router()['routes']
             LOG.info(
                 "Adding routes '%s' to router '%s'" % (src_routes, router_id))
             routers.add_routes_to_dest(
@@ -398,8 +517,11 @@ class RouterCreationAction(base.BaseAction):
         return router
 
     def cleanup(self):
+        if self.rollback_created_resources():
+            return
         routers.delete_router(
             self._destination_openstack_client, self.get_new_router_name())
+        self.invalidate_check()
 
 
 class PortCreationAction(base.BaseAction):
@@ -410,38 +532,55 @@ class PortCreationAction(base.BaseAction):
     """
 
     action_type = base.ACTION_TYPE_CHECK_CREATE_PORT
-    NEW_PORT_DESCRIPTION_FORMAT = (
-        "Pre-created by the 'coriolis-openstack-utils' for source port with ID"
-        " '%s' for use on a Migrated/Replicated VM.")
+    NEW_PORT_DESCRIPTION_FORMAT = ports.NEW_PORT_DESCRIPTION_FORMAT
+
+    def __init__(
+            self, action_payload, source_openstack_client=None,
+            destination_openstack_client=None, coriolis_client=None,
+            subnet_lookups=None):
+        """
+        param subnet_lookups: dict: cache of `subnets.SubnetLookup`s by
+        destination network ID, which may be shared between actions.
+        """
+        super(PortCreationAction, self).__init__(
+            action_payload, source_openstack_client=source_openstack_client,
+            destination_openstack_client=destination_openstack_client,
+            coriolis_client=coriolis_client)
+        if subnet_lookups is None:
+            subnet_lookups = {}
+        self._subnet_lookups = subnet_lookups
 
     @property
     def relevant_keys(self):
-        relevant_keys = [
-            'allowed_address_pairs', 'extra_dhcp_opts',
-            'binding:profile', 'admin_state_up', 'mac_address']
-        return relevant_keys
+        return ports.PORT_RELEVANT_KEYS
 
     def check_port_similarity(self, src_port, dest_port):
-        src_port_info = {k: v for k, v in
-                         src_port.items() if k in self.relevant_keys}
-        dest_port_info = {k: v for k, v in
-                          dest_port.items() if k in self.relevant_keys}
-        src_port_ips = set([el['ip_address'] for el in src_port['fixed_ips']])
-        dest_port_ips = set(
-            [el['ip_address'] for el in dest_port['fixed_ips']])
-        return (src_port_info == dest_port_info and
-                src_port_ips == dest_port_ips)
+        return ports.check_port_similarity(src_port, dest_port)
+
+    def get_source_port(self):
+        return self.resolve_state(
+            'source_port', lambda: ports.get_port(
+                self._source_openstack_client, self.payload['src_port_id']))
+
+    def find_similar_ports(self):
+        """ Returns the destination ports similar to the source port.
+        NOTE: only the ports with the source port's MAC address are fetched.
+        """
+        src_port = self.get_source_port()
+        src_port_fingerprint = ports.get_port_fingerprint(src_port)
+        candidates = ports.list_ports_by_mac(
+            self._destination_openstack_client,
+            self.payload['dest_network_id'], src_port['mac_address'])
+        return [dest_port for dest_port in candidates
+                if ports.get_port_fingerprint(dest_port) ==
+                src_port_fingerprint]
 
+    @base.cached_check
     def check_already_done(self):
-        src_port = self._source_openstack_client.neutron.find_resource_by_id(
-            'port', self.payload['src_port_id'])
-        conflicting = self._destination_openstack_client.neutron.list_ports(
-            network_id=self.payload['dest_network_id'])['ports']
-        for dest_port in conflicting:
-            if self.check_port_similarity(src_port, dest_port):
-                LOG.info("Found destination port '%s' with same "
-                         "information as source port." % dest_port)
-                return {"done": True, "result": dest_port}
+        for dest_port in self.find_similar_ports():
+            LOG.info("Found destination port '%s' with same "
+                     "information as source port." % dest_port)
+            return {"done": True, "result": dest_port}
 
         return {"done": False, "result": None}
 
@@ -456,86 +595,48 @@ class PortCreationAction(base.BaseAction):
 
     def print_operations(self):
         super(PortCreationAction, self).print_operations()
-        src_port = self._source_openstack_client.neutron.find_resource_by_id(
-            'port', self.payload['src_port_id'])
+        src_port = self.get_source_port()
         LOG.info(
             "Create new destination port with info '%s'." % src_port)
 
     def execute_operations(self):
         super(PortCreationAction, self).print_operations()
         done = self.check_already_done()
-        src_port = self._source_openstack_client.neutron.find_resource_by_id(
-            'port', self.payload['src_port_id'])
-        src_port_info = {k: v for k, v in
-                         src_port.items() if k in self.relevant_keys}
-        src_port_info['network_id'] = self.payload['dest_network_id']
-        src_ip_addresses = [el['ip_address'] for el in src_port['fixed_ips']]
-        src_mac_address = src_port['mac_address']
-        if src_ip_addresses:
-            fixed_ips = []
-            dest_neutron = self._destination_openstack_client.neutron
-            net = dest_neutron.find_resource_by_id(
-                'network', self.payload['dest_network_id'])
-            subnets_id_map = {
-                sid: ipaddress.ip_network(
-                    subnets.get_subnet(
-                        self._destination_openstack_client, sid)['cidr'])
-                for sid in net['subnets']}
-
-            # iterate through all the IP addresses desired for this interface
-            # and find a suitable subnet for each:
-            for ip_address in src_ip_addresses:
-                target_subnet = None
-                try:
-                    addr = ipaddress.ip_address(ip_address)
-                    for subnet_id, subnet in subnets_id_map.items():
-                        if addr in subnet:
-                            target_subnet = subnet_id
-                            break
-                except ValueError:
-                    LOG.warning(
-                        "Improper IP address '%s', ignoring.", ip_address)
-                    continue
-
-                if not target_subnet:
-                    LOG.warning(
-                        "Could not find suitable subnet for IP address '%s'"
-                        "for NIC with MAC address '%s', ignoring.",
-                        ip_address, src_mac_address)
-                    continue
-
-                fixed_ips.append(
-                    {"ip_address": ip_address, "subnet_id": target_subnet})
-                src_port_info['fixed_ips'] = fixed_ips
-
-            src_port_info['project_id'] = (
-                net['project_id'] or net['tenant_id'])
-            src_port_info['tenant_id'] = (
-                net['project_id'] or net['tenant_id'])
-
-            dest_description = (self.NEW_PORT_DESCRIPTION_FORMAT %
-                                self.payload.get('src_port_id'))
-            src_port_info['description'] = dest_description
-
         if done["done"]:
             LOG.info(
-                "Port with info %s already exists" % src_port_info)
+                "Port with info %s already exists" % done["result"])
+            self.record_mapping(
+                rollback.RESOURCE_TYPE_PORT, self.payload['src_port_id'],
+                done["result"]['id'])
             return done["result"]
 
+        src_port = self.get_source_port()
+        dest_network = self.resolve_state(
+            'destination_network', lambda: networks.get_network(
+                self._destination_openstack_client,
+                self.payload['dest_network_id']))
+        subnet_lookup = subnets.get_subnet_lookup(
+            self._destination_openstack_client, dest_network['id'],
+            cache=self._subnet_lookups)
+        src_port_info = ports.get_destination_port_body(
+            src_port, dest_network, subnet_lookup)
+
         LOG.info("Creating destination port with info '%s'" %
                  src_port_info)
         dest_port = self._destination_openstack_client.neutron.create_port(
             body={'port': src_port_info})
+        self.record_created(
+            rollback.RESOURCE_TYPE_PORT, dest_port['port']['id'])
+        self.record_mapping(
+            rollback.RESOURCE_TYPE_PORT, self.payload['src_port_id'],
+            dest_port['port']['id'])
+        self.invalidate_check()
         return dest_port['port']
 
     def cleanup(self):
-        src_port = self._source_openstack_client.neutron.find_resource_by_id(
-            'port', self.payload['src_port_id'])
-        conflicting = self._destination_openstack_client.neutron.list_ports(
-            network_id=self.payload['dest_network_id'])['ports']
-        for dest_port in conflicting:
-            if self.check_port_similarity(src_port, dest_port):
-                LOG.info("Deleting destination port '%s' with same "
-                         "information as source port." % dest_port)
-                self._destination_openstack_client.neutron.delete_port(
-                    dest_port['id'])
+        for dest_port in self.find_similar_ports():
+            LOG.info("Deleting destination port '%s' with same "
+                     "information as source port." % dest_port)
+            self._destination_openstack_client.neutron.delete_port(
+                dest_port['id'])
+        self.invalidate_check()
@@ -6,8 +6,10 @@
 from oslo_log import log as logging
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
 from coriolis_openstack_utils.actions import base
 from coriolis_openstack_utils.resource_utils import security_groups
+from coriolis_openstack_utils.resource_utils import tags
 
 CONF = conf.CONF
 LOG = logging.getLogger(__name__)
@@ -31,30 +33,60 @@ class SecurityGroupCreationAction(base.BaseAction):
         return CONF.destination.new_secgroup_name_format
 
     def check_rules_added(self, src_rules, dest_rules):
-        conflicts = []
-        for src_rule in src_rules:
-            for dest_rule in dest_rules:
-                if security_groups.check_rule_similarity(
-                        src_rule, dest_rule):
-                    conflicts.append(src_rule)
-                    break
-        return len(src_rules) == len(conflicts)
+        dest_rule_fingerprints = set(
+            security_groups.get_rule_fingerprint(rule) for rule in dest_rules)
+        return all(
+            security_groups.get_rule_fingerprint(rule) in
+            dest_rule_fingerprints for rule in src_rules)
 
+    def get_source_secgroup(self):
+        return self.resolve_state(
+            'source_secgroup', self._get_source_secgroup)
+
+    def _get_source_secgroup(self):
+        src_secgroup_name = self.payload['source_name']
+        src_tenant_id = self.payload['src_tenant_id']
+
+        source_secgroup_list = security_groups.list_security_groups(
+            self._source_openstack_client, src_tenant_id,
+            filters={'name': src_secgroup_name})
+
+        if not source_secgroup_list:
+            raise Exception("Source security group named %s in tenant %s "
+                            "not found! " % (src_secgroup_name, src_tenant_id))
+        elif len(source_secgroup_list) > 1:
+            raise Exception("Multiple secgroups named %s on source in "
+                            "tenant %s " % (src_secgroup_name, src_tenant_id))
+
+        return source_secgroup_list[0]
+
+    @base.cached_check
     def check_already_done(self):
         dest_tenant_id = self.payload['dest_tenant_id']
         dest_secgroup_name = self.get_new_secgroup_name()
 
         src_tenant_id = self.payload['src_tenant_id']
         src_secgroup_name = self.payload['source_name']
+        src_secgroup = self.get_source_secgroup()
+
+        tagged = tags.list_tagged_resources(
+            lambda filters, fields: security_groups.list_security_groups(
+                self._destination_openstack_client, dest_tenant_id,
+                filters=filters, fields=fields),
+            src_secgroup['id'])
+        if tagged:
+            LOG.info("Found destination Security Group '%s' tagged with "
+                     "source Security Group '%s'."
+                     % (tagged[0]['id'], src_secgroup['id']))
+            self.set_state(('destination_tagged', tagged[0]['id']), True)
+            return {"done": True, "result": tagged[0]['id']}
 
         dest_secgroups = security_groups.list_security_groups(
             self._destination_openstack_client,
             dest_tenant_id,
             filters={'name': dest_secgroup_name})
 
-        src_rules = security_groups.get_security_group(
-            self._source_openstack_client, tenant_id=src_tenant_id,
-            name=src_secgroup_name)['security_group_rules']
+        src_rules = src_secgroup['security_group_rules']
 
         found_secgroup_id = None
         for secgroup in dest_secgroups:
@@ -118,6 +150,13 @@ class SecurityGroupCreationAction(base.BaseAction):
             LOG.info(
                 "Security Group named '%s' already exists.",
                 dest_secgroup_name)
+            source_secgroup = self.get_source_secgroup()
+            self.record_mapping(
+                rollback.RESOURCE_TYPE_SECGROUP, source_secgroup['id'],
+                done["result"], source_name=self.payload['source_name'],
+                destination_name=dest_secgroup_name)
+            self.tag_destination_resource(
+                'security_groups', done["result"], source_secgroup['id'])
             return done["result"]
 
         LOG.info("Creating destination security group with name '%s'" %
@@ -129,25 +168,19 @@ class SecurityGroupCreationAction(base.BaseAction):
         body = self.create_secgroup_body(description)
         dest_secgroup_id = security_groups.create_security_group(
             self._destination_openstack_client, dest_tenant_id, body)
+        self.record_created(rollback.RESOURCE_TYPE_SECGROUP, dest_secgroup_id)
+        self.invalidate_check()
 
         LOG.info("Adding source %s rules to destination security group '%s'" %
                  (self.payload['source_name'], dest_secgroup_name))
 
-        src_secgroup_name = self.payload.get('source_name')
-        src_tenant_id = self.payload['src_tenant_id']
-
-        source_secgroup_list = security_groups.list_security_groups(
-            self._source_openstack_client, src_tenant_id,
-            filters={'name': src_secgroup_name})
-
-        if not source_secgroup_list:
-            raise Exception("Source security group named %s in tenant %s "
-                            "not found! " % (src_secgroup_name, src_tenant_id))
-        elif len(source_secgroup_list) > 1:
-            raise Exception("Multiple secgroups named %s on source in "
-                            "tenant %s " % (src_secgroup_name, src_tenant_id))
-        else:
-            source_secgroup = source_secgroup_list[0]
+        source_secgroup = self.get_source_secgroup()
+        self.record_mapping(
+            rollback.RESOURCE_TYPE_SECGROUP, source_secgroup['id'],
+            dest_secgroup_id, source_name=self.payload['source_name'],
+            destination_name=dest_secgroup_name)
+        self.tag_destination_resource(
+            'security_groups', dest_secgroup_id, source_secgroup['id'])
 
         src_rules = source_secgroup['security_group_rules']
         new_dest_rules = (
@@ -158,20 +191,19 @@ class SecurityGroupCreationAction(base.BaseAction):
             self._destination_openstack_client, dest_tenant_id,
             dest_secgroup_name)['security_group_rules']
 
-        # Removing conflicting rules
+        # Removing conflicting and duplicate rules
         dest_rules = []
+        seen_rule_fingerprints = set(
+            security_groups.get_rule_fingerprint(rule)
+            for rule in prev_dest_rules)
         for new_rule in new_dest_rules:
-            if new_rule not in dest_rules:
-                skip_rule = False
-                for prev_rule in prev_dest_rules:
-                    if security_groups.check_rule_similarity(
-                            new_rule, prev_rule):
-                        skip_rule = True
-                if not skip_rule:
-                    dest_rules.append(new_rule)
-                else:
-                    LOG.debug("Skip adding already existing rule from "
-                              "source %s" % new_rule)
+            rule_fingerprint = security_groups.get_rule_fingerprint(new_rule)
+            if rule_fingerprint not in seen_rule_fingerprints:
+                seen_rule_fingerprints.add(rule_fingerprint)
+                dest_rules.append(new_rule)
+            else:
+                LOG.debug("Skip adding already existing rule from "
+                          "source %s" % new_rule)
 
         security_groups.add_rules_to_secgroup(
             dest_secgroup_name, dest_rules, self._destination_openstack_client)
@@ -190,3 +222,4 @@ class SecurityGroupCreationAction(base.BaseAction):
         security_groups.delete_secgroup(
             self._destination_openstack_client,
             self.payload['dest_tenant_id'], self.get_new_secgroup_name())
+        self.invalidate_check()
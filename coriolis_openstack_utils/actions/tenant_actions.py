@@ -4,12 +4,14 @@
 """ Module defining tenant and access-related actions. """
 
 import copy
-import time
 
 from oslo_log import log as logging
 
 from coriolis_openstack_utils import conf
 from coriolis_openstack_utils import openstack_client
+from coriolis_openstack_utils import reconcile
+from coriolis_openstack_utils import rollback
+from coriolis_openstack_utils import utils
 from coriolis_openstack_utils.actions import base
 from coriolis_openstack_utils.actions import coriolis_transfer_actions
 from coriolis_openstack_utils.actions import flavor_actions
@@ -17,6 +19,8 @@ from coriolis_openstack_utils.actions import network_actions
 from coriolis_openstack_utils.actions import secgroup_actions
 from coriolis_openstack_utils.resource_utils import instances
 from coriolis_openstack_utils.resource_utils import networks
+from coriolis_openstack_utils.resource_utils import quotas
+from coriolis_openstack_utils.resource_utils import records
 from coriolis_openstack_utils.resource_utils import routers
 from coriolis_openstack_utils.resource_utils import security_groups
 from coriolis_openstack_utils.resource_utils import users
@@ -40,6 +44,39 @@ class TenantCreationAction(base.BaseAction):
         return self.tenant_name_format % {
             "original": self.payload["tenant_name"]}
 
+    def get_source_tenant_id(self):
+        return self.resolve_state(
+            'source_tenant_id',
+            lambda: self._source_openstack_client.get_project_id(
+                self.payload["tenant_name"]))
+
+    def get_new_tenant_id(self):
+        return self.resolve_state(
+            'new_tenant_id', self._get_new_tenant_id)
+
+    def _get_new_tenant_id(self):
+        mapped_id = conf.get_id_mapping_store().get_destination_id_by_name(
+            rollback.RESOURCE_TYPE_TENANT, self.payload["tenant_name"],
+            validator=self._destination_openstack_client.get_project_names)
+        if mapped_id:
+            return mapped_id
+        return self._destination_openstack_client.get_project_id(
+            self.get_new_tenant_name())
+
+    def record_tenant_mapping(self, dest_tenant_id):
+        self.record_mapping(
+            rollback.RESOURCE_TYPE_TENANT, self.get_source_tenant_id(),
+            dest_tenant_id, source_name=self.payload["tenant_name"],
+            destination_name=self.get_new_tenant_name())
+
+    def forget_tenant_mapping(self):
+        id_mappings = conf.get_id_mapping_store()
+        mapped_id = id_mappings.get_destination_id_by_name(
+            rollback.RESOURCE_TYPE_TENANT, self.payload["tenant_name"])
+        if mapped_id:
+            id_mappings.forget_destination(
+                rollback.RESOURCE_TYPE_TENANT, mapped_id)
+
     def _update_tenant_quotas(self):
         """ Updates all tenant quotas necessary for the migration.
 
@@ -47,45 +84,18 @@ class TenantCreationAction(base.BaseAction):
             - neutron/security_group -- set to -1 (unlimited)
             - cinder/volumes -- set to -1 (unlimited)
             - nova/instances -- set to -1 (unlimited)
+
+        The services' quotas are updated concurrently, skipping the ones
+        which are already set.
         """
-        tenant_name = self.get_new_tenant_name()
-        tenant_id = self._destination_openstack_client.get_project_id(
-            tenant_name)
+        tenant_id = self.get_new_tenant_id()
 
-        # update Neutron quotas:
-        neutron_quotas = CONF.destination.new_tenant_neutron_quotas
-        updated_neutron_quotas = {
-            k: int(neutron_quotas[k]) for k in neutron_quotas}
-        LOG.info(
-            "Adding Neutron quotas for tenant '%s': %s",
-            tenant_name, updated_neutron_quotas)
-        self._destination_openstack_client.neutron.update_quota(
-            tenant_id, body={"quota": updated_neutron_quotas})
-
-        # update Cinder quotas:
-        cinder_quotas = CONF.destination.new_tenant_cinder_quotas
-        updated_cinder_quotas = {
-            k: int(cinder_quotas[k]) for k in cinder_quotas}
-        LOG.info(
-            "Adding Cinder quotas for tenant '%s': %s",
-            tenant_name, updated_cinder_quotas)
-        self._destination_openstack_client.cinder.quotas.update(
-            tenant_id, **updated_cinder_quotas)
-
-        # update Nova quotas:
-        nova_quotas = CONF.destination.new_tenant_nova_quotas
-        updated_nova_quotas = {
-            k: int(nova_quotas[k]) for k in nova_quotas}
-        LOG.info(
-            "Adding Nova quotas for tenant '%s': %s",
-            tenant_name, updated_nova_quotas)
-        self._destination_openstack_client.nova.quotas.update(
-            tenant_id, **updated_nova_quotas)
+        quotas.apply_tenants_quotas(
+            self._destination_openstack_client, [tenant_id])
 
     def _allow_secgroup_traffic(self):
         tenant_name = self.get_new_tenant_name()
-        tenant_id = self._destination_openstack_client.get_project_id(
-            tenant_name)
+        tenant_id = self.get_new_tenant_id()
 
         # NOTE: in order to see the new secgroup we must use the
         # right tenant name:
@@ -98,20 +108,21 @@ class TenantCreationAction(base.BaseAction):
         LOG.info(
             "Waiting for tenant '%s' default security group creation.",
             tenant_name)
-        while True:
-            secgroups = new_client.neutron.list_security_groups()[
-                "security_groups"]
+
+        def _probe():
+            secgroups = new_client.neutron.list_security_groups(
+                tenant_id=tenant_id, name="default")["security_groups"]
             secgroups = [s for s in secgroups if s["tenant_id"] == tenant_id]
             if len(secgroups) > 1:
                 raise Exception(
                     "Multiple 'default' secgroups found in destination tenant "
                     "'%s'. Please delete all but one, or rerun without the "
                     "tenant security group option." % tenant_name)
+            return secgroups or None
 
-            if not secgroups:
-                time.sleep(4)
-            else:
-                break
+        secgroups = utils.wait_for(
+            _probe, description=(
+                "default security group of tenant '%s'" % tenant_name))
 
         # NOTE: the 'default' secgroup should always be there:
         secgroup = secgroups[0]
@@ -144,6 +155,7 @@ class TenantCreationAction(base.BaseAction):
             "and set appropriate usage quotas. " % (
                 tenant_name))
 
+    @base.cached_check
     def check_already_done(self):
         tenant_name = self.get_new_tenant_name()
 
@@ -165,12 +177,18 @@ class TenantCreationAction(base.BaseAction):
                 "Tenant named '%s' already exists, updating quotas.",
                 tenant_name)
             self._update_tenant_quotas()
-            return done["result"]
+            dest_tenant_id = self.get_new_tenant_id()
+            self.record_tenant_mapping(dest_tenant_id)
+            return dest_tenant_id
 
         description = self.NEW_PROJECT_DESCRIPTION % original_tenant_name
         LOG.info("Creating destination tenant with name '%s'" % tenant_name)
         new_project_id = self._destination_openstack_client.create_project(
             tenant_name, description)
+        self.set_state('new_tenant_id', new_project_id)
+        self.record_created(rollback.RESOURCE_TYPE_TENANT, new_project_id)
+        self.record_tenant_mapping(new_project_id)
+        self.invalidate_check()
 
         LOG.info(
             "Waiting for creation of destination tenant '%s'.", tenant_name)
@@ -205,6 +223,9 @@ class TenantCreationAction(base.BaseAction):
 
         self._destination_openstack_client.delete_project_by_name(
             self.get_new_tenant_name())
+        self.forget_tenant_mapping()
+        self.invalidate_state('new_tenant_id')
+        self.invalidate_check()
 
 
 class UserCreationAction(base.BaseAction):
@@ -217,8 +238,10 @@ class UserCreationAction(base.BaseAction):
         return CONF.destination.new_user_name_format
 
     def get_source_user_name(self):
-        return users.get_user(
-            self._source_openstack_client, self.payload['src_user_id']).name
+        return self.resolve_state(
+            'source_user_name', lambda: users.get_user(
+                self._source_openstack_client,
+                self.payload['src_user_id']).name)
 
     def get_new_user_name(self):
         return self.user_name_format % {
@@ -239,6 +262,7 @@ class UserCreationAction(base.BaseAction):
 
         return False
 
+    @base.cached_check
     def check_already_done(self):
         user_name = self.get_new_user_name()
 
@@ -259,6 +283,10 @@ class UserCreationAction(base.BaseAction):
             LOG.info(
                 "User named '%s' already exists.",
                 user_name)
+            self.record_mapping(
+                rollback.RESOURCE_TYPE_USER, self.payload['src_user_id'],
+                done["result"], source_name=self.get_source_user_name(),
+                destination_name=user_name)
             return done["result"]
 
         LOG.info("Creating destination user with name '%s'" % user_name)
@@ -267,6 +295,12 @@ class UserCreationAction(base.BaseAction):
         src_body['name'] = user_name
         user_id = users.create_user(
             self._destination_openstack_client, src_body)
+        self.record_created(rollback.RESOURCE_TYPE_USER, user_id)
+        self.record_mapping(
+            rollback.RESOURCE_TYPE_USER, self.payload['src_user_id'], user_id,
+            source_name=self.get_source_user_name(),
+            destination_name=user_name)
+        self.invalidate_check()
         LOG.info("Created user with id '%s'" % user_id)
         dest_admin_tenants = self.payload.get('admin_role_tenants', False)
         if not dest_admin_tenants:
@@ -293,6 +327,7 @@ class UserCreationAction(base.BaseAction):
         if user_list_length == 1:
             self._destination_openstack_client.keystone.users.delete(
                 user_list[0].id)
+            self.invalidate_check()
             LOG.info("Successfully deleted user '%s' on destination"
                      % self.get_new_user_name())
 
@@ -325,73 +360,166 @@ class WholeTenantCreationAction(TenantCreationAction):
                  "alongside its security_groups, networks and routers."
                  % self.get_new_tenant_name())
 
-    def execute_operations(self):
-        dest_tenant_id = super(
-            WholeTenantCreationAction, self).execute_operations()
-        src_tenant_id = self._source_openstack_client.get_project_id(
-            self.payload['tenant_name'])
+    def get_destination_external_network_ids(self):
+        return self.resolve_state(
+            'destination_external_network_ids',
+            lambda: networks.get_external_network_ids(
+                self._destination_openstack_client))
+
+    def reconcile_tenant_resources(self, src_tenant_id, dest_tenant_id,
+                                   reconcile_flavors=None):
+        """ Returns the `reconcile.ReconcileResult` of the resources of the
+        source tenant (and of the flavors, if replicated) against the ones of
+        the existing destination tenant.
+        param reconcile_flavors: bool: whether to also reconcile the flavors.
+        Defaults to whether they are replicated.
+        """
+        if reconcile_flavors is None:
+            reconcile_flavors = self.payload['replicate_flavors']
+        src_flavors = None
+        dest_flavors = None
+        if reconcile_flavors:
+            src_flavors = [
+                records.flavor_record(flavor) for flavor in
+                self._source_openstack_client.nova.flavors.list(
+                    is_public=None)]
+            dest_flavors = [
+                records.flavor_record(flavor) for flavor in
+                self._destination_openstack_client.nova.flavors.list(
+                    is_public=None)]
+
+        return reconcile.reconcile_tenant(
+            self._source_openstack_client, self._destination_openstack_client,
+            src_tenant_id, dest_tenant_id, src_flavors=src_flavors,
+            dest_flavors=dest_flavors)
+
+    def _get_source_resources_to_create(self, src_tenant_id, dest_tenant_id,
+                                        reconcile_resources):
+        """ Returns a dict mapping the resource types to the lists of source
+        resources which need recreating.
+        If `reconcile_resources` is set, the resources with equivalents in
+        the destination tenant are left out, and any conflicts are raised.
+        Otherwise, all the source resources are returned.
+        NOTE: flavors are not tenant-scoped, so they are diffed separately
+        (see `flavor_actions.BatchFlavorReplicationAction`).
+        """
+        if reconcile_resources:
+            result = self.reconcile_tenant_resources(
+                src_tenant_id, dest_tenant_id, reconcile_flavors=False)
+            result.raise_on_conflicts()
+            for entry in result.get_entries(status=reconcile.STATUS_SKIP):
+                LOG.info(
+                    "Destination %s '%s' (ID '%s') already equivalent to "
+                    "source %s '%s', skipping.", entry["resource_type"],
+                    entry["destination_name"], entry["destination_id"],
+                    entry["resource_type"], entry["source_name"])
+            return {
+                resource_type: [
+                    entry["source"] for entry in result.get_entries(
+                        resource_type=resource_type,
+                        status=reconcile.STATUS_CREATE)]
+                for resource_type in [
+                    rollback.RESOURCE_TYPE_NETWORK,
+                    rollback.RESOURCE_TYPE_ROUTER,
+                    rollback.RESOURCE_TYPE_SECGROUP]}
+
+        return {
+            rollback.RESOURCE_TYPE_NETWORK: [
+                records.network_record(network)
+                for network in networks.iter_networks(
+                    self._source_openstack_client, src_tenant_id)],
+            rollback.RESOURCE_TYPE_ROUTER: [
+                records.router_record(router)
+                for router in routers.iter_routers(
+                    self._source_openstack_client, filters={
+                        'project_id': src_tenant_id,
+                        'tenant_id': src_tenant_id})],
+            rollback.RESOURCE_TYPE_SECGROUP: [
+                {'name': secgroup['name']} for secgroup in
+                security_groups.iter_security_groups(
+                    self._source_openstack_client, src_tenant_id,
+                    fields=['name'])]}
+
+    def prepare_subactions(self, dest_tenant_id, reconcile_resources=True):
+        """ Instantiates the subactions for recreating the resources of the
+        source tenant within the destination tenant, keeping only one of each
+        set of equivalent migration preparation subactions (endpoints) which
+        are not already done.
+        param dest_tenant_id: ID of the destination tenant, or a plan
+        reference to it if it is not yet created.
+        param reconcile_resources: bool: whether to reconcile the resources
+        of the tenants in bulk (see `reconcile`), only instantiating the
+        subactions for the resources which need creating. Must be unset when
+        the destination tenant is not yet created.
+        """
+        self.subactions = []
+        self._migration_prep_subactions = []
+        src_tenant_id = self.get_source_tenant_id()
+
+        to_create = self._get_source_resources_to_create(
+            src_tenant_id, dest_tenant_id, reconcile_resources)
+        # NOTE: the resource subactions were either already checked in bulk
+        # or are known not to be done, so they need no further checks:
+        not_done = {"done": False, "result": None}
+        dest_client = self._destination_openstack_client
 
-        src_tenant_networks = [
-            network['id'] for network in
-            networks.list_networks(self._source_openstack_client,
-                                   src_tenant_id)]
         if self.payload['replicate_flavors']:
-            src_flavors = [flavor.id for flavor in
-                           self._source_openstack_client.nova.flavors.list(
-                               is_public=None)]
-            for src_flavor_id in src_flavors:
-                dest_client = self._destination_openstack_client
-                flavor_migration_action = flavor_actions.FlavorCreationAction(
-                    {'src_flavor_id': src_flavor_id},
-                    source_openstack_client=self._source_openstack_client,
-                    destination_openstack_client=dest_client)
-
-                self.subactions.append(flavor_migration_action)
-
-        for net_id in src_tenant_networks:
+            self.subactions.append(
+                flavor_actions.BatchFlavorReplicationAction(
+                    {}, source_openstack_client=self._source_openstack_client,
+                    destination_openstack_client=dest_client))
+
+        for src_network in to_create[rollback.RESOURCE_TYPE_NETWORK]:
             network_migration_action = network_actions.NetworkCreationAction(
-                {'src_network_id': net_id, 'dest_tenant_id': dest_tenant_id},
+                {'src_network_id': src_network['id'],
+                 'dest_tenant_id': dest_tenant_id},
                 source_openstack_client=self._source_openstack_client,
-                destination_openstack_client=self._destination_openstack_client
-                )
+                destination_openstack_client=dest_client)
+            network_migration_action.set_state('source_network', src_network)
+            network_migration_action.set_check_result(not_done)
             self.subactions.append(network_migration_action)
-        src_tenant_routers = [
-            router['id'] for router in routers.list_routers(
-                self._source_openstack_client, filters={
-                    'project_id': src_tenant_id, 'tenant_id': src_tenant_id})]
 
-        for router_id in src_tenant_routers:
+        # NOTE: the destination external networks are listed only once for
+        # all the routers (or seeded for all tenants, see `MigrateTenants`):
+        external_network_ids = None
+        if any(src_router.get('external_gateway_info')
+               for src_router in to_create[rollback.RESOURCE_TYPE_ROUTER]):
+            external_network_ids = self.get_destination_external_network_ids()
+
+        for src_router in to_create[rollback.RESOURCE_TYPE_ROUTER]:
             router_migration_action = network_actions.RouterCreationAction(
-                {'src_router_id': router_id,
+                {'src_router_id': src_router['id'],
                  'dest_tenant_id': dest_tenant_id},
                 source_openstack_client=self._source_openstack_client,
-                destination_openstack_client=self._destination_openstack_client
-                )
+                destination_openstack_client=dest_client)
+            router_migration_action.set_state('source_router', src_router)
+            if external_network_ids is not None:
+                router_migration_action.set_state(
+                    'destination_external_network_ids', external_network_ids)
+            router_migration_action.set_check_result(not_done)
             self.subactions.append(router_migration_action)
 
-        src_secgroup_names = [
-            secgroup['name'] for secgroup in
-            security_groups.list_security_groups(
-                self._source_openstack_client, src_tenant_id)]
-
-        for secgroup_name in src_secgroup_names:
+        for src_secgroup in to_create[rollback.RESOURCE_TYPE_SECGROUP]:
             secgroup_action = secgroup_actions.SecurityGroupCreationAction(
                 {'src_tenant_id': src_tenant_id,
                  'dest_tenant_id': dest_tenant_id,
-                 'source_name': secgroup_name},
+                 'source_name': src_secgroup['name']},
                 source_openstack_client=self._source_openstack_client,
-                destination_openstack_client=self._destination_openstack_client
-                )
+                destination_openstack_client=dest_client)
+            secgroup_action.set_check_result(not_done)
             self.subactions.append(secgroup_action)
         # if payload['instances'] is None, no VMs are migrated.
         instance_list = []
         if self.payload['instances'] == []:
-            instance_list = [instance for instance in instances.list_instances(
-                self._source_openstack_client,
-                filters={'tenant_id': src_tenant_id})]
+            instance_list = [
+                records.instance_record(instance)
+                for instance in instances.iter_instances(
+                    self._source_openstack_client,
+                    filters={'tenant_id': src_tenant_id})]
         elif self.payload['instances'] is not None:
             instance_list = [
-                instance for instance in instances.list_instances(
+                records.instance_record(instance)
+                for instance in instances.iter_instances(
                     self._source_openstack_client,
                     filters={'tenant_id': src_tenant_id})
                 if instance.name in self.payload['instances']]
@@ -403,8 +531,7 @@ class WholeTenantCreationAction(TenantCreationAction):
                     "Instances not found from list %s" % not_found_instances)
 
         for instance in instance_list:
-            src_secgroups = [secgroup['name'] for secgroup in
-                             getattr(instance, 'security_groups', [])]
+            src_secgroups = list(instance.security_groups)
             dest_secgroups = [CONF.destination.new_secgroup_name_format %
                               {'original': secgroup_name} for
                               secgroup_name in src_secgroups]
@@ -446,7 +573,7 @@ class WholeTenantCreationAction(TenantCreationAction):
         for migration_action in self.subactions:
             new_migration_subactions = []
             for action in migration_action.subactions:
-                action_done = action.check_already_done()
+                action_done = self.check_subaction(action)
                 if action_done["done"]:
                     LOG.info("Action already done: ")
                     action.print_operations()
@@ -463,17 +590,76 @@ class WholeTenantCreationAction(TenantCreationAction):
             # NOTE: we eliminate the unneeded action:
             migration_action.subactions = new_migration_subactions
 
+    def add_to_plan(self, plan, depends_on=(), check=True):
+        done = {"done": False, "result": None}
+        if check:
+            done = self.check_already_done()
+
+        dest_tenant_id = None
+        if done["done"]:
+            dest_tenant_id = self.get_new_tenant_id()
+        tenant_key = plan.add_entry(
+            self.action_type, self.payload, depends_on=depends_on,
+            done=done["done"], result=dest_tenant_id)
+
+        # NOTE: if the tenant does not exist yet, none of its resources do,
+        # so there is nothing to check for the subactions:
+        check = done["done"]
+        if not check:
+            dest_tenant_id = plan.get_reference(tenant_key)
+        self.prepare_subactions(dest_tenant_id, reconcile_resources=check)
+
+        keys = [tenant_key]
+        planned_prep_actions = []
+        for action in self._migration_prep_subactions:
+            key, = action.add_to_plan(
+                plan, depends_on=[tenant_key], check=check)
+            planned_prep_actions.append((action, key))
+            keys.append(key)
+
+        network_keys = []
+        for action in self.subactions:
+            if action.action_type == base.ACTION_TYPE_CHECK_CREATE_ROUTER:
+                # NOTE: routers get attached to the recreated subnets:
+                action_depends_on = [tenant_key] + network_keys
+            elif isinstance(
+                    action, coriolis_transfer_actions.TransferAction):
+                # NOTE: instances require all the other resources:
+                action_depends_on = keys + (
+                    action.get_endpoint_dependencies(planned_prep_actions))
+            else:
+                action_depends_on = [tenant_key]
+
+            action_keys = action.add_to_plan(
+                plan, depends_on=action_depends_on, check=check)
+            if action.action_type == base.ACTION_TYPE_CHECK_CREATE_NETWORK:
+                network_keys.extend(action_keys)
+            keys.extend(action_keys)
+
+        return keys
+
+    def execute_operations(self):
+        dest_tenant_id = super(
+            WholeTenantCreationAction, self).execute_operations()
+        self.prepare_subactions(dest_tenant_id)
+
         for action in self._migration_prep_subactions:
-            action.execute_operations()
+            self.execute_subaction(action)
 
         for action in self.subactions:
-            action.execute_operations()
+            self.execute_subaction(action)
 
         return {'name': self.get_new_tenant_name(),
                 'id': dest_tenant_id}
 
     def cleanup(self):
+        if self.rollback_created_resources():
+            self.invalidate_state('new_tenant_id')
+            return
         for action in self.subactions:
             action.cleanup()
         self._destination_openstack_client.delete_project_by_name(
             self.get_new_tenant_name())
+        self.forget_tenant_mapping()
+        self.invalidate_state('new_tenant_id')
+        self.invalidate_check()
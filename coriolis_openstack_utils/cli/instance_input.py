@@ -0,0 +1,205 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" Helpers for reading the instances to be transferred by the batch commands
+from positional arguments or from streamed input files. """
+
+import csv
+import json
+import sys
+
+from oslo_log import log as logging
+
+from coriolis_openstack_utils.resource_utils import instances
+
+
+LOG = logging.getLogger(__name__)
+
+STDIN_INPUT_PATH = "-"
+
+INPUT_FORMAT_AUTO = "auto"
+INPUT_FORMAT_TEXT = "text"
+INPUT_FORMAT_CSV = "csv"
+INPUT_FORMAT_JSONL = "jsonl"
+INPUT_FORMATS = [
+    INPUT_FORMAT_AUTO, INPUT_FORMAT_TEXT, INPUT_FORMAT_CSV, INPUT_FORMAT_JSONL]
+INPUT_FORMAT_EXTENSIONS = {
+    ".csv": INPUT_FORMAT_CSV,
+    ".jsonl": INPUT_FORMAT_JSONL,
+    ".json": INPUT_FORMAT_JSONL}
+
+DEFAULT_INSTANCES_CHUNK_SIZE = 100
+
+# NOTE: keys of CSV columns/JSON fields which may hold instance references:
+INSTANCE_ID_KEYS = ["instance_id", "id"]
+INSTANCE_NAME_KEYS = ["instance_name", "name", "instance"]
+INSTANCE_TENANT_KEYS = ["instance_tenant_name", "tenant_name", "tenant"]
+
+
+def add_instance_input_arguments(parser, transfer_action_type):
+    """ Adds the arguments for selecting the instances to the given parser.
+    param transfer_action_type: str: "migrate" or "replicate"
+    """
+    parser.add_argument(
+        "--instances-from", dest="instances_from", metavar="FILE",
+        help="File to read the instances to %s from, or '-' for the "
+             "standard input. The instances are read and processed in "
+             "chunks as the input arrives." % transfer_action_type)
+    parser.add_argument(
+        "--instances-format", dest="instances_format",
+        choices=INPUT_FORMATS, default=INPUT_FORMAT_AUTO,
+        help="Format of the '--instances-from' input: 'text' for one "
+             "instance per line, 'csv' for the first column or the "
+             "'instance_id'/'instance_name'/'tenant_name' columns, or "
+             "'jsonl' for one JSON string or object per line. 'auto' "
+             "(default) detects it from the extension of the file.")
+    parser.add_argument(
+        "--instances-chunk-size", dest="instances_chunk_size", type=int,
+        default=DEFAULT_INSTANCES_CHUNK_SIZE,
+        help="Number of instances to process at once when reading them "
+             "using '--instances-from'.")
+    parser.add_argument(
+        "instances", metavar="INSTANCE", nargs="*",
+        help="Instances to %s, referenced either by ID, by name "
+             "qualified with the name of their tenant (of the form "
+             "'TENANT_NAME/INSTANCE_NAME') or by plain name. IDs and "
+             "qualified names are resolved faster on large clouds." % (
+                 transfer_action_type))
+
+
+def _get_reference_from_record(record):
+    """ Returns the instance reference from a dict parsed from a CSV row or
+    JSON object. """
+    record = {
+        str(k).strip().lower(): v for k, v in record.items()
+        if v not in (None, "")}
+    for key in INSTANCE_ID_KEYS:
+        if key in record:
+            return str(record[key]).strip()
+
+    for key in INSTANCE_NAME_KEYS:
+        if key in record:
+            name = str(record[key]).strip()
+            for tenant_key in INSTANCE_TENANT_KEYS:
+                if tenant_key in record:
+                    return "%s%s%s" % (
+                        str(record[tenant_key]).strip(),
+                        instances.INSTANCE_REFERENCE_TENANT_SEPARATOR, name)
+            return name
+
+    raise ValueError(
+        "Could not find any instance reference in input record: %s" % (
+            record))
+
+
+def _iter_text_references(lines):
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def _iter_csv_references(lines):
+    reader = csv.reader(lines)
+    header = None
+    for row in reader:
+        row = [cell.strip() for cell in row]
+        if not any(row) or row[0].startswith("#"):
+            continue
+
+        if header is None and any(
+                cell.lower() in INSTANCE_ID_KEYS + INSTANCE_NAME_KEYS
+                for cell in row):
+            header = row
+            continue
+
+        if header is not None:
+            yield _get_reference_from_record(dict(zip(header, row)))
+        else:
+            yield row[0]
+
+
+def _iter_jsonl_references(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        record = json.loads(line)
+        if isinstance(record, dict):
+            yield _get_reference_from_record(record)
+        else:
+            yield str(record).strip()
+
+
+INPUT_FORMAT_PARSERS = {
+    INPUT_FORMAT_TEXT: _iter_text_references,
+    INPUT_FORMAT_CSV: _iter_csv_references,
+    INPUT_FORMAT_JSONL: _iter_jsonl_references}
+
+
+def _detect_input_format(path):
+    for extension, input_format in INPUT_FORMAT_EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return input_format
+    return INPUT_FORMAT_TEXT
+
+
+def iter_instance_references(path, input_format=INPUT_FORMAT_AUTO):
+    """ Lazily yields the instance references from the given file (or the
+    standard input for '-') as they are read. """
+    if input_format == INPUT_FORMAT_AUTO:
+        input_format = _detect_input_format(path)
+    parse = INPUT_FORMAT_PARSERS[input_format]
+
+    if path == STDIN_INPUT_PATH:
+        for instance_ref in parse(sys.stdin):
+            yield instance_ref
+    else:
+        with open(path, 'r') as fd:
+            for instance_ref in parse(fd):
+                yield instance_ref
+
+
+def iter_instance_chunks(args):
+    """ Yields lists of at most '--instances-chunk-size' unique instance
+    references from the positional arguments and the '--instances-from'
+    input (if any), only reading the input as the chunks are consumed.
+    NOTE: instances only given as positional arguments form a single chunk.
+    """
+    if not args.instances and not args.instances_from:
+        raise ValueError(
+            "No instances provided. Please provide them as arguments or "
+            "using '--instances-from'.")
+    if args.instances_chunk_size < 1:
+        raise ValueError(
+            "Invalid instances chunk size: %s" % args.instances_chunk_size)
+
+    def _iter_references():
+        for instance_ref in args.instances:
+            yield instance_ref
+        if args.instances_from:
+            for instance_ref in iter_instance_references(
+                    args.instances_from, input_format=args.instances_format):
+                yield instance_ref
+
+    chunk_size = args.instances_chunk_size
+    if not args.instances_from:
+        chunk_size = len(args.instances)
+
+    seen = set()
+    chunk = []
+    for instance_ref in _iter_references():
+        if instance_ref in seen:
+            LOG.warn("Ignoring duplicate instance '%s' in input.",
+                     instance_ref)
+            continue
+        seen.add(instance_ref)
+
+        chunk.append(instance_ref)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
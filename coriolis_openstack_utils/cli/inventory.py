@@ -0,0 +1,62 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+from oslo_log import log as logging
+
+from cliff import lister
+
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import inventory
+from coriolis_openstack_utils.cli import formatter
+
+CONF = conf.CONF
+
+LOG = logging.getLogger(__name__)
+
+
+class InventoryCountFormatter(formatter.EntityFormatter):
+    columns = (
+        "Section",
+        "Resource Type",
+        "Count")
+
+    def _get_formatted_data(self, obj):
+        data = (
+            obj["section"],
+            obj["resource_type"],
+            obj["count"])
+
+        return data
+
+
+class CaptureInventory(lister.Lister):
+    def get_parser(self, prog_name):
+        parser = super(CaptureInventory, self).get_parser(prog_name)
+        parser.add_argument(
+            "inventory_file", metavar="INVENTORY_FILE",
+            help="Path to write the inventory of the source and destination "
+                 "clouds and of Coriolis to. The inventory can then be "
+                 "passed to any command using the global '--inventory-file' "
+                 "option to plan operations offline.")
+        return parser
+
+    def take_action(self, args):
+        if conf.get_inventory() is not None:
+            raise Exception(
+                "Cannot capture an inventory while working offline from "
+                "inventory file '%s'." % CONF.inventory_file)
+
+        captured = inventory.capture_inventory(
+            conf.get_source_openstack_client(),
+            conf.get_destination_openstack_client(),
+            conf.get_coriolis_client(),
+            max_workers=min(
+                CONF.source.max_concurrent_requests,
+                CONF.destination.max_concurrent_requests))
+        captured.write(args.inventory_file)
+
+        counts = [
+            {"section": section, "resource_type": resource_type,
+             "count": count}
+            for section, resource_type, count in captured.get_counts()]
+        return InventoryCountFormatter().list_objects(counts)
@@ -0,0 +1,79 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+from oslo_log import log as logging
+
+from cliff import lister
+
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import journal
+from coriolis_openstack_utils import plans
+from coriolis_openstack_utils.cli import formatter
+
+
+LOG = logging.getLogger(__name__)
+
+
+class PlanEntryFormatter(formatter.EntityFormatter):
+    columns = (
+        "Key",
+        "Action Type",
+        "Status",
+        "Result")
+
+    def _get_formatted_data(self, obj):
+        data = (
+            obj["key"],
+            obj["action_type"],
+            obj["status"],
+            obj["result"])
+
+        return data
+
+
+class ApplyPlan(lister.Lister):
+    def get_parser(self, prog_name):
+        parser = super(ApplyPlan, self).get_parser(prog_name)
+        parser.add_argument(
+            "--max-age", dest="max_age", type=int,
+            default=plans.DEFAULT_PLAN_MAX_AGE,
+            help="Maximum age (in seconds) of the plan to be applied. "
+                 "Set to 0 to apply plans of any age.")
+        parser.add_argument(
+            "--not-a-drill", dest="not_drill", action="store_true",
+            default=False,
+            help="If unset, tooling will only print the planned operations.")
+        parser.add_argument(
+            "--journal-file", dest="journal_file",
+            help="Path to a local journal file in which all completed "
+                 "operations get recorded. Rerunning the command with the "
+                 "same journal file skips the recorded operations, and "
+                 "failed runs are not rolled back so they can be resumed.")
+        parser.add_argument(
+            "plan_file", metavar="PLAN_FILE",
+            help="Path to a plan file written using the '--plan-file' "
+                 "option of the 'migrate tenant', 'migrate batch' or "
+                 "'replicate batch' commands.")
+        return parser
+
+    def take_action(self, args):
+        plan = plans.ExecutionPlan.load(args.plan_file)
+        plan.check_staleness(max_age=args.max_age)
+
+        action_journal = None
+        if args.journal_file:
+            action_journal = journal.ExecutionJournal(args.journal_file)
+
+        entries = []
+        if args.not_drill:
+            entries = plans.apply_plan(
+                plan,
+                source_openstack_client=conf.get_source_openstack_client(),
+                destination_openstack_client=(
+                    conf.get_destination_openstack_client()),
+                coriolis_client=conf.get_coriolis_client(),
+                journal=action_journal)
+        else:
+            plan.print_operations()
+
+        return PlanEntryFormatter().list_objects(entries)
@@ -0,0 +1,73 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+from oslo_log import log as logging
+
+from cliff import lister
+
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils.actions import tenant_actions
+from coriolis_openstack_utils.cli import formatter
+
+CONF = conf.CONF
+
+LOG = logging.getLogger(__name__)
+
+
+class ReconcileEntryFormatter(formatter.EntityFormatter):
+    columns = (
+        "Resource Type",
+        "Source Name",
+        "Destination Name",
+        "Status",
+        "Destination ID",
+        "Reason")
+
+    def _get_formatted_data(self, obj):
+        data = (
+            obj["resource_type"],
+            obj["source_name"],
+            obj["destination_name"],
+            obj["status"],
+            obj["destination_id"],
+            obj["reason"])
+
+        return data
+
+
+class ReconcileTenant(lister.Lister):
+    def get_parser(self, prog_name):
+        parser = super(ReconcileTenant, self).get_parser(prog_name)
+        parser.add_argument(
+            "src_tenant_name", metavar="SRC_TENANT_NAME",
+            help="Name of the source tenant to reconcile.")
+        parser.add_argument(
+            "--dest-tenant-name", dest="dest_tenant_name",
+            help="Name of the destination tenant to reconcile against. "
+                 "Defaults to the source tenant name formatted with "
+                 "'new_tenant_name_format'.")
+        parser.add_argument(
+            "--replicate-flavors", dest='replicate_flavors',
+            action='store_true',
+            help='If set, all source flavors will also be reconciled.')
+        return parser
+
+    def take_action(self, args):
+        source_client = conf.get_source_openstack_client()
+        destination_client = conf.get_destination_openstack_client()
+
+        dest_tenant_name = args.dest_tenant_name
+        if not dest_tenant_name:
+            dest_tenant_name = CONF.destination.new_tenant_name_format % {
+                "original": args.src_tenant_name}
+
+        tenant_creation_action = tenant_actions.WholeTenantCreationAction(
+            {"tenant_name": args.src_tenant_name,
+             "replicate_flavors": args.replicate_flavors},
+            source_openstack_client=source_client,
+            destination_openstack_client=destination_client)
+        result = tenant_creation_action.reconcile_tenant_resources(
+            source_client.get_project_id(args.src_tenant_name),
+            destination_client.get_project_id(dest_tenant_name))
+
+        return ReconcileEntryFormatter().list_objects(result.entries)
@@ -7,7 +7,10 @@ from cliff import lister
 
 from coriolis_openstack_utils.actions import coriolis_transfer_actions
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import journal
+from coriolis_openstack_utils import plans
 from coriolis_openstack_utils.cli import formatter
+from coriolis_openstack_utils.cli import instance_input
 
 
 LOG = logging.getLogger(__name__)
@@ -52,28 +55,38 @@ class CreateReplicas(lister.Lister):
             default=False,
             help="If unset, tooling will only print the indented operations.")
         parser.add_argument(
-            "instances", metavar="INSTANCE_NAME", nargs="+")
+            "--plan-file", dest="plan_file",
+            help="If set without '--not-a-drill', the execution plan will "
+                 "also be written to the given file, to be later executed "
+                 "with the 'apply plan' command.")
+        parser.add_argument(
+            "--journal-file", dest="journal_file",
+            help="Path to a local journal file in which all completed "
+                 "operations get recorded. Rerunning the command with the "
+                 "same journal file skips the recorded operations, and "
+                 "failed runs are not rolled back so they can be resumed.")
+        instance_input.add_instance_input_arguments(parser, "replicate")
         return parser
 
-    def take_action(self, args):
-        # instantiate all clients:
-        coriolis = conf.get_coriolis_client()
-        source_client = conf.get_source_openstack_client()
-        destination_client = conf.get_destination_openstack_client()
-        dest_env = conf.get_destination_openstack_environment()
-
-        source_vms = args.instances
-        batch_name = args.batch_name
-        execute_replica = args.execute_replica
+    def _replicate_instances(
+            self, args, source_vms, source_client, destination_client,
+            coriolis, dest_env, action_journal, plan, batch_context,
+            executed_actions):
+        """ Processes a chunk of the batch.
+        param executed_actions: list: the batch actions of the chunks
+        executed so far, which are all rolled back on failures when not
+        journaling, and to which the action of this chunk gets added.
+        """
         replica_payload = {
             "instances": source_vms,
-            "batch_name": batch_name,
-            "execute_replica": execute_replica}
+            "batch_name": args.batch_name,
+            "execute_replica": args.execute_replica}
         batch_replica_action = (
             coriolis_transfer_actions.BatchReplicaAction(
                 replica_payload, source_openstack_client=source_client,
                 destination_openstack_client=destination_client,
-                coriolis_client=coriolis, destination_env=dest_env))
+                coriolis_client=coriolis, destination_env=dest_env,
+                journal=action_journal, batch_context=batch_context))
 
         replicas = []
         done = batch_replica_action.check_already_done()
@@ -83,16 +96,69 @@ class CreateReplicas(lister.Lister):
                 "batch which has equivalent endpoint details was found)")
         else:
             if args.not_drill:
+                executed_actions.append(batch_replica_action)
                 try:
                     replicas = batch_replica_action.execute_operations()
                 except (Exception, KeyboardInterrupt):
+                    if action_journal:
+                        LOG.warn("Error occured while creating replicas for "
+                                 "instances '%s'. Rerun with the same "
+                                 "journal file to resume.", source_vms)
+                        raise
                     LOG.warn("Error occured while creating replicas for "
-                             "instances '%s'. Rolling back all changes",
-                             source_vms)
-                    batch_replica_action.cleanup()
+                             "instances '%s'. Rolling back all the "
+                             "changes of the %d chunk(s) processed so far.",
+                             source_vms, len(executed_actions))
+                    for action in reversed(executed_actions):
+                        try:
+                            action.cleanup()
+                        except Exception:
+                            LOG.exception(
+                                "Failed to roll back replicas for instances "
+                                "'%s'.", action.payload["instances"])
                     raise
 
             else:
                 batch_replica_action.print_operations()
 
+        if plan is not None:
+            batch_replica_action.add_to_plan(plan)
+
+        return replicas
+
+    def take_action(self, args):
+        # instantiate all clients:
+        coriolis = conf.get_coriolis_client()
+        source_client = conf.get_source_openstack_client()
+        destination_client = conf.get_destination_openstack_client()
+        dest_env = conf.get_destination_openstack_environment()
+
+        plan = None
+        if args.plan_file and not args.not_drill:
+            plan = plans.ExecutionPlan("replicate_batch")
+
+        action_journal = None
+        if args.journal_file:
+            action_journal = journal.ExecutionJournal(args.journal_file)
+
+        # NOTE: the instances are processed in chunks as they are read, with
+        # the source instances only being listed and the transfer options
+        # validation info only being fetched once for all the chunks:
+        batch_context = coriolis_transfer_actions.BatchTransferContext(
+            source_client, destination_client, dest_env)
+        replicas = []
+        executed_actions = []
+        for chunk_number, source_vms in enumerate(
+                instance_input.iter_instance_chunks(args)):
+            LOG.info(
+                "Processing chunk %d of %d instance(s) of batch '%s'.",
+                chunk_number + 1, len(source_vms), args.batch_name)
+            replicas.extend(self._replicate_instances(
+                args, source_vms, source_client, destination_client,
+                coriolis, dest_env, action_journal, plan, batch_context,
+                executed_actions))
+
+        if plan is not None:
+            plan.write(args.plan_file)
+
         return ReplicaFormatter().list_objects(replicas)
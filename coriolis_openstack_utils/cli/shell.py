@@ -41,6 +41,12 @@ class CoriolisOpenStackUtilsApp(app.App):
         parser.add_argument(
             "--config-file", metavar="CONF_FILE", dest="conf_file",
             help="Path to the config file.")
+        parser.add_argument(
+            "--inventory-file", metavar="INVENTORY_FILE",
+            dest="inventory_file",
+            help="Path to an inventory file written by the 'capture "
+                 "inventory' command. If set, commands are run offline "
+                 "against the inventory, and only as drills.")
 
         parser.epilog = (
             "See 'coriolis-openstack-util help COMMAND' for help on individual"
@@ -59,6 +65,14 @@ class CoriolisOpenStackUtilsApp(app.App):
                 project=constants.PROJECT_NAME,
                 version=constants.PROJECT_VERSION)
 
+        if known_args.inventory_file is not None:
+            CONF.set_override("inventory_file", known_args.inventory_file)
+        if CONF.inventory_file and "--not-a-drill" in remainder:
+            self.stderr.write(
+                "Cannot run commands with '--not-a-drill' offline from an "
+                "inventory file.\n")
+            return 1
+
         # show full traceback unless -q/--quiet passed
         if known_args.verbose_level != 0:
             remainder.append("--debug")
@@ -1,14 +1,23 @@
 # Copyright 2018 Cloudbase Solutions Srl
 # All Rights Reserved.
 
+import re
+
 from oslo_log import log as logging
 
 from cliff import lister
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import journal
+from coriolis_openstack_utils import plans
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.actions import flavor_actions
 from coriolis_openstack_utils.actions import tenant_actions
 from coriolis_openstack_utils.cli import formatter
+from coriolis_openstack_utils.resource_utils import instances
+from coriolis_openstack_utils.resource_utils import networks
 
+CONF = conf.CONF
 
 LOG = logging.getLogger(__name__)
 
@@ -26,6 +35,71 @@ class TenantMigrationFormatter(formatter.EntityFormatter):
         return data
 
 
+def _add_tenant_migration_arguments(parser):
+    """ Adds the arguments shared by the tenant migration commands. """
+    instance_options = parser.add_mutually_exclusive_group(required=True)
+    instance_options.add_argument(
+        "--all-instances", dest="all_instances", action="store_true",
+        help="Migrate all instances from source to destination tenant.")
+    instance_options.add_argument(
+        "--no-instances", dest="no_instances", action="store_true",
+        help="Do not migrate any source instances to the destination "
+             "tenant.")
+    instance_options.add_argument(
+        "--instances", dest="instances", nargs='+',
+        help="List of instance names to be migrated. When migrating "
+             "multiple tenants, the names must be qualified with the name "
+             "of their source tenant as 'TENANT_NAME/INSTANCE_NAME'.")
+    parser.add_argument(
+        "--not-a-drill", dest="not_drill", action="store_true",
+        default=False,
+        help="If unset, tooling will only print the indented operations.")
+    replica_group = parser.add_argument_group(
+        'Replica Options', 'options related to replicas.')
+    replica_group.add_argument(
+        "--use-replicas", dest="use_replicas", action="store_true",
+        help="If set, tooling will create replicas for selected "
+             "instances.")
+    replica_group.add_argument(
+        "--execute-replicas", dest='execute_replicas',
+        action='store_true',
+        help='If set, replicas will be executed.')
+    parser.add_argument(
+        "--replicate-flavors", dest='replicate_flavors',
+        action='store_true',
+        help='If set, all source flavors will be recreated on '
+             'destination.')
+    parser.add_argument(
+        "--journal-file", dest="journal_file",
+        help="Path to a local journal file in which all completed "
+             "operations get recorded. Rerunning the command with the "
+             "same journal file skips the recorded operations, and "
+             "failed runs are not rolled back so they can be resumed.")
+
+
+def _get_tenant_creation_payload(args, src_tenant_name,
+                                 instance_names=None):
+    """ param instance_names: list: names of the instances of the tenant to be
+    migrated, overriding '--instances'. """
+    tenant_creation_payload = {
+        "tenant_name": src_tenant_name,
+        "use_replicas": args.use_replicas,
+        "execute_replicas": args.execute_replicas,
+        "replicate_flavors": args.replicate_flavors
+        }
+    if args.no_instances:
+        tenant_creation_payload['instances'] = None
+    elif args.all_instances:
+        tenant_creation_payload['instances'] = []
+    elif instance_names is not None:
+        # NOTE: an empty list would select all the instances of the tenant:
+        tenant_creation_payload['instances'] = instance_names or None
+    elif args.instances:
+        tenant_creation_payload['instances'] = args.instances
+
+    return tenant_creation_payload
+
+
 class MigrateTenant(lister.Lister):
     def get_parser(self, prog_name):
         parser = super(MigrateTenant, self).get_parser(prog_name)
@@ -38,36 +112,12 @@ class MigrateTenant(lister.Lister):
             "--src-tenant-name", dest="src_tenant_name",
             help="The tenant name of the security group that is being "
                  "migrated.")
-        instance_options = parser.add_mutually_exclusive_group(required=True)
-        instance_options.add_argument(
-            "--all-instances", dest="all_instances", action="store_true",
-            help="Migrate all instances from source to destination tenant.")
-        instance_options.add_argument(
-            "--no-instances", dest="no_instances", action="store_true",
-            help="Do not migrate any source instances to the destination "
-                 "tenant.")
-        instance_options.add_argument(
-            "--instances", dest="instances", nargs='+',
-            help="List of instance names to be migrated.")
+        _add_tenant_migration_arguments(parser)
         parser.add_argument(
-            "--not-a-drill", dest="not_drill", action="store_true",
-            default=False,
-            help="If unset, tooling will only print the indented operations.")
-        replica_group = parser.add_argument_group(
-            'Replica Options', 'options related to replicas.')
-        replica_group.add_argument(
-            "--use-replicas", dest="use_replicas", action="store_true",
-            help="If set, tooling will create replicas for selected "
-                 "instances.")
-        replica_group.add_argument(
-            "--execute-replicas", dest='execute_replicas',
-            action='store_true',
-            help='If set, replicas will be executed.')
-        parser.add_argument(
-            "--replicate-flavors", dest='replicate_flavors',
-            action='store_true',
-            help='If set, all source flavors will be recreated on '
-                 'destination.')
+            "--plan-file", dest="plan_file",
+            help="If set without '--not-a-drill', the execution plan will "
+                 "also be written to the given file, to be later executed "
+                 "with the 'apply plan' command.")
 
         return parser
 
@@ -83,29 +133,22 @@ class MigrateTenant(lister.Lister):
         elif args.src_tenant_name:
             src_tenant_name = args.src_tenant_name
 
-        tenant_creation_payload = {
-            "tenant_name": src_tenant_name,
-            "use_replicas": args.use_replicas,
-            "execute_replicas": args.execute_replicas,
-            "replicate_flavors": args.replicate_flavors
-            }
-        if args.no_instances:
-            tenant_creation_payload['instances'] = None
-        elif args.all_instances:
-            tenant_creation_payload['instances'] = []
-        elif args.instances:
-            tenant_creation_payload['instances'] = args.instances
-
         tenant_creation_action = (
             tenant_actions.WholeTenantCreationAction(
-                tenant_creation_payload,
+                _get_tenant_creation_payload(args, src_tenant_name),
                 source_openstack_client=source_client,
                 destination_openstack_client=destination_client,
                 coriolis_client=coriolis_client))
+        if args.journal_file:
+            tenant_creation_action.journal = journal.ExecutionJournal(
+                args.journal_file)
 
         done = tenant_creation_action.check_already_done()
+        # NOTE: a journaled run may have failed after creating the tenant,
+        # so it is always executed to resume the remaining operations:
+        resume = bool(tenant_creation_action.journal) and args.not_drill
         tenant = None
-        if done["done"]:
+        if done["done"] and not resume:
             LOG.info(
                 "Tenant %s Creation seemingly done."
                 % done["result"])
@@ -117,6 +160,11 @@ class MigrateTenant(lister.Lister):
                 try:
                     tenant = tenant_creation_action.execute_operations()
                 except (Exception, KeyboardInterrupt):
+                    if tenant_creation_action.journal:
+                        LOG.warn("Error occured while recreating source "
+                                 "tenant '%s'. Rerun with the same journal "
+                                 "file to resume.", src_tenant_name)
+                        raise
                     LOG.warn("Error occured while recreating source tenant "
                              "'%s'. Rolling back changes", src_tenant_name)
                     tenant_creation_action.cleanup()
@@ -127,4 +175,301 @@ class MigrateTenant(lister.Lister):
                     'id': 'NOT DONE',
                     'name': 'NOT DONE'}
 
+        if args.plan_file and not args.not_drill:
+            plan = plans.ExecutionPlan("migrate_tenant")
+            tenant_creation_action.add_to_plan(plan)
+            plan.print_operations()
+            plan.write(args.plan_file)
+
         return TenantMigrationFormatter().list_objects([tenant])
+
+
+class TenantsMigrationFormatter(formatter.EntityFormatter):
+    columns = (
+        "Source Tenant Name",
+        "Tenant Name",
+        "Tenant ID",
+        "Status",
+        "Error")
+
+    def _get_formatted_data(self, obj):
+        data = (
+            obj["source_name"],
+            obj["name"],
+            obj["id"],
+            obj["status"],
+            obj.get("error", ""))
+
+        return data
+
+
+class MigrateTenants(lister.Lister):
+    """ Migrates many tenants concurrently, sharing the clients and the
+    discovery of the resources common to all of them (tenant listings,
+    destination external networks and flavors). """
+
+    STATUS_MIGRATED = "migrated"
+    STATUS_EXISTS = "exists"
+    STATUS_FAILED = "failed"
+    STATUS_PLANNED = "planned"
+
+    def get_parser(self, prog_name):
+        parser = super(MigrateTenants, self).get_parser(prog_name)
+        parser.add_argument(
+            "src_tenant_names", metavar="SRC_TENANT_NAME", nargs='*',
+            help="Names of the source tenants to migrate.")
+        parser.add_argument(
+            "--all-tenants", dest="all_tenants", action="store_true",
+            help="Migrate all the source tenants (matching '--name-regex', "
+                 "if set).")
+        parser.add_argument(
+            "--name-regex", dest="name_regex",
+            help="Only migrate the source tenants whose names match the "
+                 "given regular expression.")
+        parser.add_argument(
+            "--max-concurrent-tenants", dest="max_concurrent_tenants",
+            type=int,
+            help="Maximum number of tenants to migrate concurrently. "
+                 "Defaults to the lowest 'max_concurrent_requests' of the "
+                 "source and destination, which also caps the number of "
+                 "concurrent API requests against each cloud.")
+        _add_tenant_migration_arguments(parser)
+
+        return parser
+
+    def _get_source_tenant_ids(self, source_client, args):
+        """ Returns a dict mapping the names of the selected source tenants
+        to their IDs, resolved with a single listing. """
+        if args.src_tenant_names:
+            tenant_ids = source_client.get_project_ids(args.src_tenant_names)
+        elif args.all_tenants or args.name_regex:
+            tenant_ids = source_client.get_project_ids(
+                source_client.list_project_names())
+        else:
+            raise Exception(
+                "Either source tenant names, '--all-tenants' or "
+                "'--name-regex' must be provided.")
+
+        if args.name_regex:
+            name_regex = re.compile(args.name_regex)
+            tenant_ids = {
+                name: tenant_id for name, tenant_id in tenant_ids.items()
+                if name_regex.search(name)}
+
+        return tenant_ids
+
+    def _get_tenants_instances(self, args, src_tenant_names):
+        """ Returns a dict mapping each of the given source tenant names to
+        the list of the names of its instances selected with the
+        tenant-qualified '--instances' references, or None if unset. """
+        if not args.instances:
+            return None
+
+        tenants_instances = {name: [] for name in src_tenant_names}
+        invalid_refs = []
+        for instance_ref in args.instances:
+            tenant_name, separator, instance_name = instance_ref.partition(
+                instances.INSTANCE_REFERENCE_TENANT_SEPARATOR)
+            if not separator or tenant_name not in tenants_instances:
+                invalid_refs.append(instance_ref)
+                continue
+            tenants_instances[tenant_name].append(instance_name)
+        if invalid_refs:
+            raise Exception(
+                "The '--instances' of multiple tenants must be qualified "
+                "with the name of one of the selected source tenants as "
+                "'TENANT_NAME/INSTANCE_NAME'. Invalid references: %s" % (
+                    invalid_refs))
+
+        return tenants_instances
+
+    def take_action(self, args):
+        # NOTE: all tenants share the same clients, whose requests are capped
+        # by the 'max_concurrent_requests' of the respective clouds:
+        source_client = conf.get_source_openstack_client()
+        destination_client = conf.get_destination_openstack_client()
+        coriolis_client = conf.get_coriolis_client()
+
+        src_tenant_ids = self._get_source_tenant_ids(source_client, args)
+        if not src_tenant_ids:
+            raise Exception("No source tenants selected for migration.")
+        LOG.info(
+            "Selected %d source tenant(s) for migration.", len(src_tenant_ids))
+        tenants_instances = self._get_tenants_instances(args, src_tenant_ids)
+
+        tenant_journal = None
+        if args.journal_file:
+            tenant_journal = journal.ExecutionJournal(args.journal_file)
+
+        # NOTE: the destination tenants and external networks are listed once
+        # for all the tenants:
+        dest_tenant_names = set(destination_client.list_project_names())
+        dest_tenant_ids = {}
+        external_network_ids = networks.get_external_network_ids(
+            destination_client)
+
+        tenant_creation_actions = []
+        for src_tenant_name in sorted(src_tenant_ids):
+            # NOTE: flavors are replicated only once for all tenants, below:
+            payload = _get_tenant_creation_payload(
+                args, src_tenant_name, instance_names=(
+                    tenants_instances or {}).get(src_tenant_name))
+            payload["replicate_flavors"] = False
+            action = tenant_actions.WholeTenantCreationAction(
+                payload, source_openstack_client=source_client,
+                destination_openstack_client=destination_client,
+                coriolis_client=coriolis_client)
+            action.journal = tenant_journal
+            action.set_state(
+                'source_tenant_id', src_tenant_ids[src_tenant_name])
+            action.set_state(
+                'destination_external_network_ids', external_network_ids)
+            dest_tenant_name = action.get_new_tenant_name()
+            action.set_check_result({
+                "done": dest_tenant_name in dest_tenant_names,
+                "result": dest_tenant_name})
+            if dest_tenant_name in dest_tenant_names:
+                dest_tenant_ids[dest_tenant_name] = None
+            tenant_creation_actions.append(action)
+
+        if dest_tenant_ids:
+            dest_tenant_ids = destination_client.get_project_ids(
+                list(dest_tenant_ids))
+
+        # NOTE: with a journal, the existing tenants are migrated again so
+        # that failed runs get resumed, the journal skipping what was done:
+        resume = tenant_journal is not None and args.not_drill
+        results = {}
+        pending = []
+        for action in tenant_creation_actions:
+            if action.check_already_done()["done"] and resume:
+                action.set_state(
+                    'new_tenant_id',
+                    dest_tenant_ids[action.get_new_tenant_name()])
+                pending.append(action)
+            elif action.check_already_done()["done"]:
+                LOG.info(
+                    "Tenant %s Creation seemingly done.",
+                    action.get_new_tenant_name())
+                results[action.payload["tenant_name"]] = {
+                    "status": self.STATUS_EXISTS,
+                    "id": dest_tenant_ids[action.get_new_tenant_name()]}
+            else:
+                pending.append(action)
+
+        if not args.not_drill:
+            for action in pending:
+                action.print_operations()
+                results[action.payload["tenant_name"]] = {
+                    "status": self.STATUS_PLANNED, "id": 'NOT DONE'}
+            if args.replicate_flavors:
+                flavor_actions.BatchFlavorReplicationAction(
+                    {}, source_openstack_client=source_client,
+                    destination_openstack_client=(
+                        destination_client)).print_operations()
+            return self._format_results(tenant_creation_actions, results)
+
+        def _rollback(action):
+            if tenant_journal is not None:
+                LOG.warn("Error occured while recreating source tenant "
+                         "'%s'. Rerun with the same journal file to "
+                         "resume.", action.payload["tenant_name"])
+                return
+            LOG.warn("Error occured while recreating source tenant '%s'. "
+                     "Rolling back changes", action.payload["tenant_name"])
+            try:
+                action.cleanup()
+            except Exception:
+                LOG.exception(
+                    "Failed to roll back source tenant '%s'.",
+                    action.payload["tenant_name"])
+
+        # NOTE: as the private flavors get access to the destination tenants,
+        # those are created before replicating the flavors. The creation is
+        # recorded on the tenant actions, so rolling them back removes them:
+        if args.replicate_flavors:
+            def _create_tenant(action):
+                tenant_action = tenant_actions.TenantCreationAction(
+                    {"tenant_name": action.payload["tenant_name"]},
+                    source_openstack_client=source_client,
+                    destination_openstack_client=destination_client)
+                tenant_action.set_state(
+                    'source_tenant_id', action.get_source_tenant_id())
+                tenant_action.set_check_result(action.check_already_done())
+                try:
+                    dest_tenant_id = action.execute_subaction(tenant_action)
+                except Exception as ex:
+                    LOG.exception(
+                        "Failed to create destination tenant for source "
+                        "tenant '%s'.", action.payload["tenant_name"])
+                    _rollback(action)
+                    return ex
+                action.set_state('new_tenant_id', dest_tenant_id)
+                action.set_check_result({
+                    "done": True, "result": action.get_new_tenant_name()})
+
+            errors = utils.run_concurrently(
+                _create_tenant, [(action,) for action in pending],
+                max_workers=self._get_max_concurrent_tenants(args))
+            for action, error in zip(list(pending), errors):
+                if error is not None:
+                    results[action.payload["tenant_name"]] = {
+                        "status": self.STATUS_FAILED, "id": None,
+                        "error": str(error)}
+                    pending.remove(action)
+
+            flavor_replication_action = (
+                flavor_actions.BatchFlavorReplicationAction(
+                    {}, source_openstack_client=source_client,
+                    destination_openstack_client=destination_client))
+            flavor_replication_action.journal = tenant_journal
+            try:
+                flavor_replication_action.execute_operations()
+            except (Exception, KeyboardInterrupt):
+                if tenant_journal is None:
+                    LOG.warn("Error occured while recreating flavors. "
+                             "Rolling back all changes")
+                    flavor_replication_action.cleanup()
+                for action in pending:
+                    _rollback(action)
+                raise
+
+        def _migrate_tenant(action):
+            src_tenant_name = action.payload["tenant_name"]
+            try:
+                tenant = action.execute_operations()
+            except Exception as ex:
+                LOG.exception(
+                    "Failed to migrate source tenant '%s'.", src_tenant_name)
+                _rollback(action)
+                results[src_tenant_name] = {
+                    "status": self.STATUS_FAILED, "id": None,
+                    "error": str(ex)}
+                return
+            results[src_tenant_name] = {
+                "status": self.STATUS_MIGRATED, "id": tenant["id"]}
+
+        utils.run_concurrently(
+            _migrate_tenant, [(action,) for action in pending],
+            max_workers=self._get_max_concurrent_tenants(args))
+
+        return self._format_results(tenant_creation_actions, results)
+
+    def _get_max_concurrent_tenants(self, args):
+        if args.max_concurrent_tenants:
+            return args.max_concurrent_tenants
+        return min(
+            CONF.source.max_concurrent_requests,
+            CONF.destination.max_concurrent_requests)
+
+    def _format_results(self, tenant_creation_actions, results):
+        tenants = []
+        for action in tenant_creation_actions:
+            result = results[action.payload["tenant_name"]]
+            tenants.append({
+                "source_name": action.payload["tenant_name"],
+                "name": action.get_new_tenant_name(),
+                "id": result["id"],
+                "status": result["status"],
+                "error": result.get("error", "")})
+        return TenantsMigrationFormatter().list_objects(tenants)
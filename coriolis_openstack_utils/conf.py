@@ -1,11 +1,17 @@
 # Copyright 2018 Cloudbase Solutions Srl
 # All Rights Reserved.
 
+import os
+
 from coriolisclient import client as coriolis_client
 from oslo_config import cfg as conf
 
 from coriolis_openstack_utils import constants
+from coriolis_openstack_utils import id_mapping
+from coriolis_openstack_utils import inventory
 from coriolis_openstack_utils import openstack_client
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.resource_utils import pagination
 
 
 CONF = conf.CONF
@@ -48,11 +54,22 @@ REGION_CONFIG_OPT = conf.StrOpt(
 DB_CONNECTION_OPT = conf.StrOpt(
     "cinder_database_connection",
     help="Connection string for Cinder DB.")
+MAX_CONCURRENT_REQUESTS_OPT = conf.IntOpt(
+    "max_concurrent_requests", min=1,
+    default=utils.DEFAULT_MAX_CONCURRENT_REQUESTS,
+    help="Maximum number of API requests to perform concurrently against "
+         "the cloud.")
+
+PAGE_SIZE_OPT = conf.IntOpt(
+    "page_size", min=1, default=pagination.DEFAULT_PAGE_SIZE,
+    help="Number of resources to fetch per API request when listing "
+         "resources page by page.")
 
 
 # Register source conf options:
 SOURCE_OPTS = OPENSTACK_CONNECTION_OPTS + [
-    REGION_CONFIG_OPT, DB_CONNECTION_OPT, ENDPOINT_NAME_FORMAT_OPT]
+    REGION_CONFIG_OPT, DB_CONNECTION_OPT, ENDPOINT_NAME_FORMAT_OPT,
+    MAX_CONCURRENT_REQUESTS_OPT, PAGE_SIZE_OPT]
 CONF.register_opts(
     SOURCE_OPTS, constants.SOURCE_OPT_GROUP_NAME)
 
@@ -166,10 +183,25 @@ DESTINATION_OPTS = OPENSTACK_CONNECTION_OPTS + [
     NEW_PHYSICAL_NETWORK_OPT, NEW_ROUTER_NAME_OPT, EXTERNAL_NETWORK_MAP_OPT,
     NEW_USER_NAME_OPT, NEW_USERS_PASSWORD_OPT, SHUTDOWN_INSTANCES_OPT,
     NEW_FLAVOR_NAME_OPT, NEW_KEYPAIR_NAME_OPT, COPY_ROUTES_OPT,
-    CARRY_PORT_INFO_OPT]
+    CARRY_PORT_INFO_OPT, MAX_CONCURRENT_REQUESTS_OPT, PAGE_SIZE_OPT]
 CONF.register_opts(
     DESTINATION_OPTS, constants.DESTINATION_OPT_GROUP_NAME)
 
+INVENTORY_FILE_OPT = conf.StrOpt(
+    "inventory_file",
+    help="Path to an inventory file written by the 'capture inventory' "
+         "command. If set, all the commands work offline, answering all "
+         "queries from the inventory, and can only be run as drills.")
+ID_MAPPING_FILE_OPT = conf.StrOpt(
+    "id_mapping_file",
+    default=os.path.join("~", ".coriolis-openstack-utils", "id_mappings.db"),
+    help="Path to the local SQLite file recording the ID of the destination "
+         "resource each source resource was replicated to, which is "
+         "consulted before searching the destination for the resources. "
+         "Set to an empty value to only keep the mappings for the duration "
+         "of each run.")
+CONF.register_opts([INVENTORY_FILE_OPT, ID_MAPPING_FILE_OPT])
+
 
 def get_conn_info_for_group(group_name):
     """ Returns the connection info dict for the specified option group.
@@ -214,20 +246,64 @@ def get_conn_info_for_group(group_name):
     return conn_info
 
 
+def get_inventory():
+    """ Returns the `inventory.Inventory` loaded from the configured
+    'inventory_file', or None when working against the live clouds. """
+    if not CONF.inventory_file:
+        return None
+    return inventory.load_inventory(CONF.inventory_file)
+
+
+_ID_MAPPING_STORES = {}
+
+
+def get_id_mapping_store():
+    """ Returns the `id_mapping.IDMappingStore` for the configured source
+    and destination clouds, which is shared by the whole run.
+    NOTE: when working offline, the mappings are never persisted.
+    """
+    path = None
+    if CONF.id_mapping_file:
+        path = os.path.expanduser(CONF.id_mapping_file)
+    scope = id_mapping.get_mapping_scope(
+        get_conn_info_for_group(constants.SOURCE_OPT_GROUP_NAME),
+        get_conn_info_for_group(constants.DESTINATION_OPT_GROUP_NAME))
+    if (path, scope) not in _ID_MAPPING_STORES:
+        _ID_MAPPING_STORES[(path, scope)] = id_mapping.IDMappingStore(
+            scope, path=path, read_only=get_inventory() is not None)
+    return _ID_MAPPING_STORES[(path, scope)]
+
+
 def get_source_openstack_client():
     conn_info = get_conn_info_for_group(
         constants.SOURCE_OPT_GROUP_NAME)
-    return openstack_client.OpenStackClient(conn_info)
+    offline_inventory = get_inventory()
+    if offline_inventory is not None:
+        return offline_inventory.get_openstack_client(
+            inventory.INVENTORY_SECTION_SOURCE, conn_info,
+            page_size=CONF.source.page_size)
+    return openstack_client.OpenStackClient(
+        conn_info, page_size=CONF.source.page_size,
+        max_concurrent_requests=CONF.source.max_concurrent_requests)
 
 
 def get_destination_openstack_client():
     conn_info = get_conn_info_for_group(
         constants.DESTINATION_OPT_GROUP_NAME)
+    offline_inventory = get_inventory()
+    if offline_inventory is not None:
+        return offline_inventory.get_openstack_client(
+            inventory.INVENTORY_SECTION_DESTINATION, conn_info,
+            page_size=CONF.destination.page_size)
     return openstack_client.OpenStackClient(
-        conn_info)
+        conn_info, page_size=CONF.destination.page_size,
+        max_concurrent_requests=CONF.destination.max_concurrent_requests)
 
 
 def get_coriolis_client():
+    offline_inventory = get_inventory()
+    if offline_inventory is not None:
+        return offline_inventory.get_coriolis_client()
     conn_info = get_conn_info_for_group(
         constants.CORIOLIS_OPT_GROUP_NAME)
     session = openstack_client.create_keystone_session(conn_info)
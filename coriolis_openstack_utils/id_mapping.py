@@ -0,0 +1,241 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" This module defines the ID mapping store, a local SQLite database
+recording the ID of the destination resource each source resource was
+replicated to (or found equivalent to), so that later runs may look up the
+destination resources by ID instead of searching for them by their formatted
+names.
+Mappings are scoped by the source and destination clouds, so a single store
+may be shared between several pairs of clouds.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+ID_MAPPING_TABLE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS id_mappings ("
+    "scope TEXT NOT NULL, "
+    "resource_type TEXT NOT NULL, "
+    "source_id TEXT NOT NULL, "
+    "source_name TEXT, "
+    "destination_id TEXT NOT NULL, "
+    "destination_name TEXT, "
+    "recorded_at REAL NOT NULL, "
+    "PRIMARY KEY (scope, resource_type, source_id))")
+
+
+def get_mapping_scope(source_connection_info, destination_connection_info):
+    """ Returns the scope of the mappings between the given clouds. """
+    return "%s (%s) -> %s (%s)" % (
+        source_connection_info["auth_url"],
+        source_connection_info.get("region_name", ""),
+        destination_connection_info["auth_url"],
+        destination_connection_info.get("region_name", ""))
+
+
+class IDMappingStore(object):
+    """ Store of source to destination resource ID mappings, backed by a
+    SQLite file.
+    All the mappings of the scope are loaded on opening, so lookups require
+    no queries. The file (and its directory) are only created on the first
+    recorded mapping, so runs which create nothing leave no trace.
+    param path: str: path of the SQLite file, or None to only keep the
+    mappings in memory for the duration of the run.
+    param read_only: bool: if set, mappings are recorded in memory only.
+    NOTE: the destination resources may have been deleted or replaced since
+    their mappings got recorded, so lookups may be given a `validator`,
+    called with a list of mapped destination IDs and returning a dict
+    mapping the ones which still exist to their current names. The mappings
+    to missing or renamed destination resources are then forgotten.
+    """
+
+    def __init__(self, scope, path=None, read_only=False):
+        self._scope = scope
+        self._path = path
+        self._read_only = read_only
+        self._lock = threading.Lock()
+        self._connection = None
+
+        # (resource_type, source_id) -> (
+        #     destination_id, source_name, destination_name):
+        self._mappings = {}
+        if path and os.path.exists(path):
+            for (resource_type, source_id, source_name, destination_id,
+                    destination_name) in self._connect().execute(
+                        "SELECT resource_type, source_id, source_name, "
+                        "destination_id, destination_name FROM id_mappings "
+                        "WHERE scope = ?", (scope,)):
+                self._mappings[(resource_type, source_id)] = (
+                    destination_id, source_name, destination_name)
+            LOG.info(
+                "Loaded %d resource ID mapping(s) from '%s'.",
+                len(self._mappings), path)
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self._path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            # NOTE: the store may be written to from multiple threads:
+            self._connection = sqlite3.connect(
+                self._path, check_same_thread=False)
+            self._connection.execute(ID_MAPPING_TABLE_SCHEMA)
+            self._connection.commit()
+        return self._connection
+
+    def validate_destination_ids(
+            self, resource_type, destination_ids, validator):
+        """ Returns the set of the given mapped destination IDs which the
+        `validator` found to still exist with their recorded names, and
+        forgets the mappings to the other ones. """
+        destination_ids = set(destination_ids)
+        if validator is None or not destination_ids:
+            return destination_ids
+
+        existing = validator(sorted(destination_ids))
+        recorded_names = {
+            destination_id: destination_name
+            for (mapped_type, _), (
+                destination_id, _, destination_name) in list(
+                    self._mappings.items())
+            if mapped_type == resource_type}
+        valid = set()
+        for destination_id in destination_ids:
+            recorded_name = recorded_names.get(destination_id)
+            if destination_id in existing and (
+                    not recorded_name or
+                    existing[destination_id] == recorded_name):
+                valid.add(destination_id)
+                continue
+            LOG.warn(
+                "Destination %s '%s' (recorded name '%s') no longer exists "
+                "as mapped, forgetting its mapping.", resource_type,
+                destination_id, recorded_name)
+            self.forget_destination(resource_type, destination_id)
+        return valid
+
+    def get_destination_id(self, resource_type, source_id, validator=None):
+        """ Returns the ID of the destination resource the given source
+        resource is mapped to, or None. """
+        return self.get_destination_ids(
+            resource_type, [source_id], validator=validator).get(source_id)
+
+    def get_destination_ids(self, resource_type, source_ids, validator=None):
+        """ Returns a dict mapping those of the given source IDs which are
+        mapped to the IDs of their destination resources, validating all the
+        mappings at once. """
+        destination_ids = {}
+        for source_id in set(source_ids):
+            mapping = self._mappings.get((resource_type, source_id))
+            if mapping:
+                destination_ids[source_id] = mapping[0]
+
+        valid = self.validate_destination_ids(
+            resource_type, destination_ids.values(), validator)
+        return {
+            source_id: destination_id
+            for source_id, destination_id in destination_ids.items()
+            if destination_id in valid}
+
+    def _get_mapped_destination_id_by_name(self, resource_type, source_name):
+        destination_ids = set(
+            destination_id for (mapped_type, _), (
+                destination_id, mapped_name, _) in list(
+                    self._mappings.items())
+            if mapped_type == resource_type and mapped_name == source_name)
+        if len(destination_ids) == 1:
+            return destination_ids.pop()
+        return None
+
+    def get_destination_id_by_name(self, resource_type, source_name,
+                                   validator=None):
+        """ Returns the ID of the destination resource the source resource
+        with the given name is mapped to, or None if there is no such
+        mapping or the name is ambiguous. """
+        return self.get_destination_ids_by_names(
+            resource_type, [source_name], lambda _: {},
+            validator=validator).get(source_name)
+
+    def get_destination_ids_by_names(
+            self, resource_type, source_names, resolver, validator=None):
+        """ Returns a dict mapping the given source names to the IDs of
+        their destination resources, calling `resolver(source_names)` (which
+        must return such a dict) only for the names without a (valid)
+        mapping. All the mappings are validated at once. """
+        destination_ids = {}
+        unmapped = []
+        for source_name in set(source_names):
+            destination_id = self._get_mapped_destination_id_by_name(
+                resource_type, source_name)
+            if destination_id:
+                destination_ids[source_name] = destination_id
+            else:
+                unmapped.append(source_name)
+
+        valid = self.validate_destination_ids(
+            resource_type, destination_ids.values(), validator)
+        for source_name, destination_id in list(destination_ids.items()):
+            if destination_id not in valid:
+                destination_ids.pop(source_name)
+                unmapped.append(source_name)
+
+        if unmapped:
+            destination_ids.update(resolver(unmapped))
+        return destination_ids
+
+    def record(self, resource_type, source_id, destination_id,
+               source_name=None, destination_name=None):
+        """ Records the mapping of the source resource to the destination
+        resource, replacing any previous mapping of the source resource. """
+        key = (resource_type, source_id)
+        with self._lock:
+            mapping = (destination_id, source_name, destination_name)
+            if self._mappings.get(key) == mapping:
+                return
+            self._mappings[key] = mapping
+            if not self._path or self._read_only:
+                return
+
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO id_mappings (scope, resource_type, "
+                "source_id, source_name, destination_id, destination_name, "
+                "recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                    self._scope, resource_type, source_id, source_name,
+                    destination_id, destination_name, time.time()))
+            connection.commit()
+
+    def forget_destination(self, resource_type, destination_id):
+        """ Drops all the mappings to the given destination resource (ex:
+        when it gets deleted). """
+        with self._lock:
+            keys = [
+                key for key, (mapped_id, _, _) in self._mappings.items()
+                if key[0] == resource_type and mapped_id == destination_id]
+            if not keys:
+                return
+            for key in keys:
+                self._mappings.pop(key)
+            if not self._path or self._read_only:
+                return
+
+            connection = self._connect()
+            connection.execute(
+                "DELETE FROM id_mappings WHERE scope = ? AND "
+                "resource_type = ? AND destination_id = ?", (
+                    self._scope, resource_type, destination_id))
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,787 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" This module defines inventory files, which hold a snapshot of all the
+resources of the source and destination clouds (and of the Coriolis
+deployment) which are looked up when planning operations.
+Offline clients answer the read-only queries of the actions and resource
+utilities from an inventory in memory, so that drill runs may be performed
+without any network access. Any operation which would alter a cloud raises
+an `OfflineInventoryError` instead.
+"""
+
+import copy
+import json
+import os
+import re
+import time
+
+from cinderclient import exceptions as cinder_exceptions
+from glanceclient.common import exceptions as glance_exceptions
+from keystoneauth1.exceptions import http as keystone_exceptions
+from neutronclient.common import exceptions as neutron_exceptions
+from novaclient import exceptions as nova_exceptions
+from oslo_log import log as logging
+
+from coriolis_openstack_utils import openstack_client
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.resource_utils import pagination
+
+LOG = logging.getLogger(__name__)
+
+INVENTORY_FORMAT_VERSION = 1
+
+INVENTORY_SECTION_SOURCE = "source"
+INVENTORY_SECTION_DESTINATION = "destination"
+INVENTORY_SECTION_CORIOLIS = "coriolis"
+
+NEUTRON_RESOURCE_TYPES = [
+    "networks", "subnets", "routers", "ports", "security_groups"]
+CORIOLIS_RESOURCE_TYPES = ["endpoints", "migrations", "replicas"]
+NEUTRON_TAG_FILTERS = ['tags', 'tags-any', 'not-tags', 'not-tags-any']
+
+# NOTE: keypairs of other users can only be listed from this microversion:
+NOVA_USER_KEYPAIRS_MIN_VERSION = (2, 10)
+
+
+class OfflineInventoryError(Exception):
+    """ Raised on any operation which cannot be performed offline. """
+    pass
+
+
+class InventoryResource(dict):
+    """ Dict holding a captured resource, whose items may also be accessed
+    as attributes like the ones of the clients' resource objects. """
+
+    def __getattr__(self, name):
+        try:
+            return _wrap(self[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def to_dict(self):
+        return copy.deepcopy(dict(self))
+
+
+def _wrap(value):
+    if isinstance(value, dict) and not isinstance(value, InventoryResource):
+        return InventoryResource(value)
+    elif isinstance(value, list):
+        return [_wrap(v) for v in value]
+    return value
+
+
+def _matches_tags(resource_tags, tag_filter, value):
+    """ Checks the resource tags against the Neutron tag filters, whose
+    values are lists (or comma-separated strings) of tags. """
+    if isinstance(value, str):
+        value = value.split(',')
+    matching = [tag in resource_tags for tag in value]
+    if tag_filter == 'tags':
+        return all(matching)
+    elif tag_filter == 'tags-any':
+        return any(matching)
+    elif tag_filter == 'not-tags':
+        return not all(matching)
+    return not any(matching)
+
+
+def _matches(resource, filters):
+    """ Checks whether the resource matches all the given filters, whose
+    values may also be lists of accepted values. Filters on keys which the
+    resource lacks are ignored, just like the APIs ignore unknown filters.
+    """
+    for key, value in filters.items():
+        if key in NEUTRON_TAG_FILTERS and value is not None:
+            if not _matches_tags(resource.get('tags') or [], key, value):
+                return False
+            continue
+        if key not in resource or value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            if resource[key] not in value:
+                return False
+        elif resource[key] != value:
+            return False
+    return True
+
+
+class _OfflineOperation(object):
+    """ Stands in for any method (or manager) of the clients which cannot be
+    used offline, raising when called. """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _OfflineOperation("%s.%s" % (self._name, name))
+
+    def __call__(self, *args, **kwargs):
+        raise OfflineInventoryError(
+            "Cannot call '%s' while working offline from an inventory "
+            "file." % self._name)
+
+
+class _OfflineService(object):
+    """ Base for the offline service clients, on which any attribute which
+    is not explicitly defined is an operation which cannot be performed
+    offline. """
+
+    service_name = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return _OfflineOperation("%s %s" % (self.service_name, name))
+
+
+class _OfflineManager(_OfflineService):
+    """ Read-only resource manager over a list of captured resources. """
+
+    def __init__(self, service_name, resources, not_found):
+        """
+        param not_found: callable: returns the exception to raise when a
+        resource is not found, given the error message.
+        """
+        self.service_name = service_name
+        self._resources = [_wrap(r) for r in resources]
+        self._not_found = not_found
+
+    def _filter(self, **filters):
+        return [r for r in self._resources if _matches(r, filters)]
+
+    def list(self, **filters):
+        return self._filter(**filters)
+
+    def findall(self, **filters):
+        return self._filter(**filters)
+
+    def find(self, **filters):
+        found = self.findall(**filters)
+        if not found:
+            raise self._not_found(
+                "No %s matching %s found in inventory." % (
+                    self.service_name, filters))
+        elif len(found) > 1:
+            raise self._not_found(
+                "Multiple %s matching %s found in inventory." % (
+                    self.service_name, filters))
+        return found[0]
+
+    def get(self, resource_id):
+        resource_id = getattr(resource_id, 'id', resource_id)
+        for resource in self._resources:
+            if resource.get('id') == resource_id:
+                return resource
+        raise self._not_found(
+            "No %s with ID '%s' found in inventory." % (
+                self.service_name, resource_id))
+
+
+def _nova_not_found(message):
+    return nova_exceptions.NotFound(404, message=message)
+
+
+def _keystone_not_found(message):
+    return keystone_exceptions.NotFound(message=message)
+
+
+def _neutron_not_found(message):
+    return neutron_exceptions.NotFound(message=message)
+
+
+def _cinder_not_found(message):
+    return cinder_exceptions.NotFound(404, message=message)
+
+
+def _glance_not_found(message):
+    return glance_exceptions.NotFound(message)
+
+
+def _coriolis_not_found(message):
+    return OfflineInventoryError(message)
+
+
+class _APIVersion(object):
+
+    def __init__(self, version):
+        self._version = version
+
+    def get_string(self):
+        return self._version
+
+
+class _OfflineServerManager(_OfflineManager):
+
+    def __init__(self, servers, ports):
+        super(_OfflineServerManager, self).__init__(
+            "nova servers", servers, _nova_not_found)
+        self._ports = ports
+
+    def list(self, detailed=True, search_opts=None, limit=None,
+             marker=None):
+        """ NOTE: the 'name' search option is a regex, just like in Nova. """
+        search_opts = dict(search_opts or {})
+        search_opts.pop('all_tenants', None)
+        name = search_opts.pop('name', None)
+        # NOTE: servers only hold the ID of their project as 'tenant_id':
+        project_id = search_opts.pop('project_id', None)
+        if project_id is not None:
+            search_opts.setdefault('tenant_id', project_id)
+
+        servers = self._filter(**search_opts)
+        if name is not None:
+            servers = [s for s in servers if re.search(name, s['name'])]
+        if marker is not None:
+            ids = [s['id'] for s in servers]
+            servers = servers[ids.index(marker) + 1:]
+        if limit is not None:
+            servers = servers[:limit]
+        return servers
+
+    def interface_list(self, server):
+        server_id = getattr(server, 'id', server)
+        return [
+            InventoryResource({
+                'port_id': port['id'],
+                'net_id': port['network_id'],
+                'mac_addr': port['mac_address'],
+                'port_state': port.get('status'),
+                'fixed_ips': port['fixed_ips']})
+            for port in self._ports if port['device_id'] == server_id]
+
+
+class _OfflineFlavorManager(_OfflineManager):
+
+    def __init__(self, flavors):
+        super(_OfflineFlavorManager, self).__init__(
+            "nova flavors", flavors, _nova_not_found)
+
+    def list(self, is_public=True, **filters):
+        """ NOTE: `is_public=None` lists both public and private flavors. """
+        flavors = self._filter(**filters)
+        if is_public is not None:
+            flavors = [
+                f for f in flavors
+                if f.get('os-flavor-access:is_public', True) == is_public]
+        return flavors
+
+    def findall(self, **filters):
+        is_public = filters.pop('is_public', True)
+        return self.list(is_public=is_public, **filters)
+
+
+class _OfflineFlavorAccessManager(_OfflineManager):
+
+    def __init__(self, flavor_access):
+        super(_OfflineFlavorAccessManager, self).__init__(
+            "nova flavor access", flavor_access, _nova_not_found)
+
+    def list(self, flavor=None):
+        return self._filter(flavor_id=getattr(flavor, 'id', flavor))
+
+
+class _OfflineKeypairManager(_OfflineManager):
+
+    def __init__(self, keypairs, current_user_id):
+        super(_OfflineKeypairManager, self).__init__(
+            "nova keypairs", keypairs, _nova_not_found)
+        self._current_user_id = current_user_id
+
+    def list(self, user_id=None):
+        return self._filter(user_id=user_id or self._current_user_id)
+
+    def get(self, keypair, user_id=None):
+        return self.find(
+            name=getattr(keypair, 'name', keypair),
+            user_id=user_id or self._current_user_id)
+
+
+class _OfflineServerVolumeManager(_OfflineService):
+    """ Lists the volumes attached to servers based on the attachments of
+    the captured Cinder volumes. """
+
+    service_name = "nova volumes"
+
+    def __init__(self, volumes):
+        self._volumes = volumes
+
+    def get_server_volumes(self, server):
+        server_id = getattr(server, 'id', server)
+        return [
+            InventoryResource({
+                'id': volume['id'],
+                'volumeId': volume['id'],
+                'serverId': server_id,
+                'device': attachment.get('device')})
+            for volume in self._volumes
+            for attachment in volume.get('attachments', [])
+            if attachment.get('server_id') == server_id]
+
+
+class _OfflineNovaVersionManager(_OfflineService):
+
+    service_name = "nova versions"
+
+    def get_current(self):
+        # NOTE: the offline client already is at the captured microversion:
+        return InventoryResource({'version': None})
+
+
+class OfflineNovaClient(_OfflineService):
+
+    service_name = "nova"
+
+    def __init__(self, inventory):
+        self.api_version = _APIVersion(inventory['nova_api_version'])
+        self.versions = _OfflineNovaVersionManager()
+        self.servers = _OfflineServerManager(
+            inventory['servers'], inventory['ports'])
+        self.flavors = _OfflineFlavorManager(inventory['flavors'])
+        self.flavor_access = _OfflineFlavorAccessManager(
+            inventory['flavor_access'])
+        self.keypairs = _OfflineKeypairManager(
+            inventory['keypairs'], inventory['user_id'])
+        self.volumes = _OfflineServerVolumeManager(inventory['volumes'])
+
+
+class _OfflineRoleAssignmentManager(_OfflineManager):
+
+    def __init__(self, role_assignments):
+        super(_OfflineRoleAssignmentManager, self).__init__(
+            "keystone role assignments", role_assignments,
+            _keystone_not_found)
+
+    def list(self, user=None, project=None, role=None):
+        def _get_id(resource, *keys):
+            for key in keys:
+                resource = (resource or {}).get(key)
+            return resource
+
+        return [
+            assignment for assignment in self._resources
+            if user is None or _get_id(assignment, 'user', 'id') == (
+                getattr(user, 'id', user))
+            if project is None or _get_id(
+                assignment, 'scope', 'project', 'id') == (
+                    getattr(project, 'id', project))
+            if role is None or _get_id(assignment, 'role', 'id') == (
+                getattr(role, 'id', role))]
+
+
+class OfflineKeystoneClient(_OfflineService):
+
+    service_name = "keystone"
+
+    def __init__(self, inventory):
+        # NOTE: both the v2 tenants and v3 projects are captured as projects:
+        self.projects = _OfflineManager(
+            "keystone projects", inventory['projects'], _keystone_not_found)
+        self.tenants = self.projects
+        self.users = _OfflineManager(
+            "keystone users", inventory['users'], _keystone_not_found)
+        self.roles = _OfflineManager(
+            "keystone roles", inventory['roles'], _keystone_not_found)
+        self.domains = _OfflineManager(
+            "keystone domains", inventory['domains'], _keystone_not_found)
+        self.role_assignments = _OfflineRoleAssignmentManager(
+            inventory['role_assignments'])
+
+
+class OfflineNeutronClient(_OfflineService):
+    """ Answers the Neutron listings (including paginated ones) and lookups
+    from the captured resources, supporting lists of accepted values in
+    filters as well as the 'fields' filter. """
+
+    service_name = "neutron"
+
+    def __init__(self, inventory):
+        self._resources = {
+            resource_type: [_wrap(r) for r in inventory[resource_type]]
+            for resource_type in NEUTRON_RESOURCE_TYPES}
+
+    def _list(self, resource_plural, retrieve_all=True, **filters):
+        limit = filters.pop('limit', None)
+        filters.pop('marker', None)
+        fields = filters.pop('fields', None)
+        if isinstance(fields, str):
+            fields = [fields]
+
+        resources = [
+            r for r in self._resources[resource_plural]
+            if _matches(r, filters)]
+        if fields:
+            resources = [
+                InventoryResource(
+                    {k: v for k, v in r.items() if k in fields})
+                for r in resources]
+
+        if retrieve_all:
+            return {resource_plural: resources}
+
+        def _iter_pages():
+            page_size = limit or len(resources) or 1
+            for i in range(0, max(len(resources), 1), page_size):
+                yield {resource_plural: resources[i:i + page_size]}
+        return _iter_pages()
+
+    def list_networks(self, retrieve_all=True, **filters):
+        return self._list('networks', retrieve_all=retrieve_all, **filters)
+
+    def list_subnets(self, retrieve_all=True, **filters):
+        return self._list('subnets', retrieve_all=retrieve_all, **filters)
+
+    def list_routers(self, retrieve_all=True, **filters):
+        return self._list('routers', retrieve_all=retrieve_all, **filters)
+
+    def list_ports(self, retrieve_all=True, **filters):
+        return self._list('ports', retrieve_all=retrieve_all, **filters)
+
+    def list_security_groups(self, retrieve_all=True, **filters):
+        return self._list(
+            'security_groups', retrieve_all=retrieve_all, **filters)
+
+    def find_resource_by_id(self, resource, resource_id, cmd_resource=None,
+                            parent_id=None, fields=None):
+        found = self._list(
+            '%ss' % resource, id=resource_id, fields=fields)['%ss' % resource]
+        if not found:
+            raise _neutron_not_found(
+                "Unable to find %s with id '%s'" % (resource, resource_id))
+        return found[0]
+
+    def find_resource(self, resource, name_or_id, project_id=None,
+                      cmd_resource=None, parent_id=None, fields=None):
+        """ Looks up the resource by ID, and then by name. """
+        try:
+            return self.find_resource_by_id(
+                resource, name_or_id, fields=fields)
+        except neutron_exceptions.NotFound:
+            pass
+
+        filters = {'name': name_or_id, 'fields': fields}
+        if project_id:
+            filters['tenant_id'] = project_id
+        found = self._list('%ss' % resource, **filters)['%ss' % resource]
+        if not found:
+            raise _neutron_not_found(
+                "Unable to find %s with name '%s'" % (resource, name_or_id))
+        elif len(found) > 1:
+            raise neutron_exceptions.NeutronClientNoUniqueMatch(
+                resource=resource, name=name_or_id)
+        return found[0]
+
+
+class OfflineCinderClient(_OfflineService):
+
+    service_name = "cinder"
+
+    def __init__(self, inventory):
+        self.volumes = _OfflineManager(
+            "cinder volumes", inventory['volumes'], _cinder_not_found)
+        self.volume_types = _OfflineManager(
+            "cinder volume types", inventory['volume_types'],
+            _cinder_not_found)
+
+
+class OfflineGlanceClient(_OfflineService):
+
+    service_name = "glance"
+
+    def __init__(self, inventory):
+        self.images = _OfflineManager(
+            "glance images", inventory['images'], _glance_not_found)
+
+
+class OfflineSwiftClient(_OfflineService):
+
+    service_name = "swift"
+
+
+class _OfflineSession(object):
+
+    def __init__(self, user_id):
+        self._user_id = user_id
+
+    def get_user_id(self):
+        return self._user_id
+
+
+class OfflineOpenStackClient(openstack_client.OpenStackClient):
+    """ OpenStackClient answering all queries from a captured inventory. """
+
+    def __init__(self, connection_info, cloud_inventory, page_size=None):
+        # NOTE: the parent constructor is deliberately not called, as it
+        # authenticates against the cloud:
+        self.connection_info = connection_info
+        self.page_size = page_size
+        self.session = _OfflineSession(cloud_inventory['user_id'])
+        self.keystone = OfflineKeystoneClient(cloud_inventory)
+        self.nova = OfflineNovaClient(cloud_inventory)
+        self.neutron = OfflineNeutronClient(cloud_inventory)
+        self.cinder = OfflineCinderClient(cloud_inventory)
+        self.glance = OfflineGlanceClient(cloud_inventory)
+        self.swift = OfflineSwiftClient()
+
+
+class OfflineCoriolisClient(_OfflineService):
+    """ Coriolis client answering all queries from a captured inventory. """
+
+    service_name = "coriolis"
+
+    def __init__(self, coriolis_inventory):
+        for resource_type in CORIOLIS_RESOURCE_TYPES:
+            setattr(self, resource_type, _OfflineManager(
+                "coriolis %s" % resource_type,
+                coriolis_inventory[resource_type], _coriolis_not_found))
+
+
+def _to_dict(resource):
+    if hasattr(resource, 'to_dict'):
+        return resource.to_dict()
+    return dict(resource)
+
+
+def capture_openstack_inventory(client, max_workers=None):
+    """ Returns a dict with all the resources of the cloud which may be
+    looked up when planning operations.
+    param client: openstack_client.OpenStackClient: the client to capture
+    the resources visible to (should be an admin).
+    """
+    if max_workers is None:
+        max_workers = utils.DEFAULT_MAX_CONCURRENT_REQUESTS
+    identity_api_version = int(
+        client.connection_info["identity_api_version"])
+    nova_api_version = client.nova.api_version.get_string()
+    cloud_inventory = {
+        "user_id": client.session.get_user_id(),
+        "identity_api_version": identity_api_version,
+        "nova_api_version": nova_api_version}
+
+    LOG.info("Capturing Keystone resources.")
+    if identity_api_version == 2:
+        cloud_inventory["projects"] = [
+            _to_dict(p) for p in client.get_tenants_list()]
+        cloud_inventory["domains"] = []
+        cloud_inventory["role_assignments"] = []
+    else:
+        cloud_inventory["projects"] = [
+            _to_dict(p) for p in client.get_projects_list()]
+        cloud_inventory["domains"] = [
+            _to_dict(d) for d in client.keystone.domains.list()]
+        cloud_inventory["role_assignments"] = [
+            _to_dict(a) for a in client.keystone.role_assignments.list()]
+    cloud_inventory["users"] = [
+        _to_dict(u) for u in client.keystone.users.list()]
+    cloud_inventory["roles"] = [
+        _to_dict(r) for r in client.keystone.roles.list()]
+
+    LOG.info("Capturing Neutron resources.")
+    for resource_type in NEUTRON_RESOURCE_TYPES:
+        cloud_inventory[resource_type] = list(
+            pagination.iter_neutron_resources(client, resource_type))
+
+    LOG.info("Capturing Nova resources.")
+    servers = []
+    for server in pagination.iter_servers(
+            client, search_opts={'all_tenants': True}):
+        server_info = _to_dict(server)
+        # NOTE: the networks of servers are computed from their addresses
+        # by the client, so they are captured explicitly:
+        server_info['networks'] = dict(server.networks)
+        servers.append(server_info)
+    cloud_inventory["servers"] = servers
+
+    cloud_inventory["flavors"] = [
+        _to_dict(f) for f in client.nova.flavors.list(is_public=None)]
+    private_flavor_ids = [
+        f["id"] for f in cloud_inventory["flavors"]
+        if not f.get('os-flavor-access:is_public', True)]
+    flavor_access_lists = utils.run_concurrently(
+        lambda flavor_id: client.nova.flavor_access.list(flavor=flavor_id),
+        [(flavor_id,) for flavor_id in private_flavor_ids],
+        max_workers=max_workers)
+    cloud_inventory["flavor_access"] = [
+        {"flavor_id": access.flavor_id, "tenant_id": access.tenant_id}
+        for access_list in flavor_access_lists for access in access_list]
+
+    def _list_keypairs(user_id):
+        if user_id is None:
+            keypairs = client.nova.keypairs.list()
+        else:
+            keypairs = client.nova.keypairs.list(user_id=user_id)
+        # NOTE: the keypairs' details are nested within their raw dicts:
+        return [{
+            "id": k.name,
+            "name": k.name,
+            "public_key": k.public_key,
+            "fingerprint": getattr(k, 'fingerprint', None),
+            "type": getattr(k, 'type', None),
+            "user_id": user_id or cloud_inventory["user_id"]}
+            for k in keypairs]
+
+    if tuple(int(v) for v in nova_api_version.split('.')) >= (
+            NOVA_USER_KEYPAIRS_MIN_VERSION):
+        keypair_owners = [(u["id"],) for u in cloud_inventory["users"]]
+    else:
+        keypair_owners = [(None,)]
+    cloud_inventory["keypairs"] = [
+        keypair for keypairs in utils.run_concurrently(
+            _list_keypairs, keypair_owners, max_workers=max_workers)
+        for keypair in keypairs]
+
+    LOG.info("Capturing Cinder and Glance resources.")
+    cloud_inventory["volumes"] = [
+        _to_dict(v) for v in client.cinder.volumes.list(
+            search_opts={'all_tenants': True})]
+    cloud_inventory["volume_types"] = [
+        _to_dict(t) for t in client.cinder.volume_types.list()]
+
+    def _get_image(image_id):
+        try:
+            return _to_dict(client.glance.images.get(image_id))
+        except glance_exceptions.NotFound:
+            return None
+
+    # NOTE: only the images of the servers are ever looked up:
+    image_ids = set(
+        (s.get('image') or {}).get('id') for s in servers) - set([None])
+    cloud_inventory["images"] = [
+        image for image in utils.run_concurrently(
+            _get_image, [(image_id,) for image_id in image_ids],
+            max_workers=max_workers)
+        if image is not None]
+
+    return cloud_inventory
+
+
+def _capture_endpoint(endpoint):
+    """ Returns the dict of the given Coriolis endpoint, whose connection
+    info (which holds credentials) is only captured redacted, alongside the
+    fingerprint it is compared by (see `coriolis_endpoint_actions`). """
+    endpoint_info = _to_dict(endpoint)
+    connection_info = _to_dict(endpoint_info.get('connection_info') or {})
+    endpoint_info['connection_info'] = utils.redact_secrets(connection_info)
+    endpoint_info['connection_info_fingerprint'] = utils.fingerprint(
+        connection_info)
+    return endpoint_info
+
+
+def capture_coriolis_inventory(coriolis_client):
+    """ Returns a dict with all the Coriolis endpoints and transfers. """
+    LOG.info("Capturing Coriolis resources.")
+    coriolis_inventory = {}
+    for resource_type in CORIOLIS_RESOURCE_TYPES:
+        resources = getattr(coriolis_client, resource_type).list()
+        if resource_type == "endpoints":
+            coriolis_inventory[resource_type] = [
+                _capture_endpoint(r) for r in resources]
+        else:
+            coriolis_inventory[resource_type] = [
+                _to_dict(r) for r in resources]
+    return coriolis_inventory
+
+
+class Inventory(object):
+    """ Snapshot of the source and destination clouds and of Coriolis, of
+    the form:
+    {
+        "version": 1,
+        "captured_at": 1530000000.0,
+        "source": {...},            # see `capture_openstack_inventory`
+        "destination": {...},       # see `capture_openstack_inventory`
+        "coriolis": {...},          # see `capture_coriolis_inventory`
+    }
+    """
+
+    def __init__(self, sections, captured_at=None):
+        self.sections = sections
+        self.captured_at = captured_at or time.time()
+
+    def get_openstack_client(self, section, connection_info, page_size=None):
+        """ Returns an `OfflineOpenStackClient` for the given section. """
+        return OfflineOpenStackClient(
+            connection_info, self.sections[section], page_size=page_size)
+
+    def get_coriolis_client(self):
+        return OfflineCoriolisClient(
+            self.sections[INVENTORY_SECTION_CORIOLIS])
+
+    def get_counts(self):
+        """ Returns a list of (section, resource type, count) tuples for all
+        the lists of resources of the inventory. """
+        return [
+            (section, resource_type, len(resources))
+            for section, section_inventory in sorted(self.sections.items())
+            for resource_type, resources in sorted(
+                section_inventory.items())
+            if isinstance(resources, list)]
+
+    def to_dict(self):
+        inventory = {
+            "version": INVENTORY_FORMAT_VERSION,
+            "captured_at": self.captured_at}
+        inventory.update(self.sections)
+        return inventory
+
+    @classmethod
+    def from_dict(cls, inventory_dict):
+        if inventory_dict.get("version") != INVENTORY_FORMAT_VERSION:
+            raise Exception(
+                "Unsupported inventory format version '%s' (expected "
+                "%s)." % (
+                    inventory_dict.get("version"), INVENTORY_FORMAT_VERSION))
+
+        sections = {
+            section: inventory_dict[section] for section in [
+                INVENTORY_SECTION_SOURCE, INVENTORY_SECTION_DESTINATION,
+                INVENTORY_SECTION_CORIOLIS]}
+        # NOTE: the captured resources are wrapped in place, so that all the
+        # offline clients share them instead of each holding copies:
+        for section_inventory in sections.values():
+            for resources in section_inventory.values():
+                if isinstance(resources, list):
+                    resources[:] = [_wrap(r) for r in resources]
+        return cls(sections, captured_at=inventory_dict["captured_at"])
+
+    def write(self, path):
+        # NOTE: the inventory describes the whole clouds, so it is only made
+        # readable to its owner:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as fd:
+            json.dump(self.to_dict(), fd, sort_keys=True, default=str)
+        LOG.info("Wrote inventory to '%s'.", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fd:
+            return cls.from_dict(json.load(fd))
+
+
+_LOADED_INVENTORIES = {}
+
+
+def load_inventory(path):
+    """ Loads the inventory from the given file, only reading each file
+    once per run. """
+    if path not in _LOADED_INVENTORIES:
+        _LOADED_INVENTORIES[path] = Inventory.load(path)
+        LOG.info(
+            "Working offline from inventory '%s' captured on %s.", path,
+            time.ctime(_LOADED_INVENTORIES[path].captured_at))
+    return _LOADED_INVENTORIES[path]
+
+
+def capture_inventory(source_client, destination_client, coriolis_client,
+                      max_workers=None):
+    """ Captures the inventories of both clouds and of Coriolis. """
+    return Inventory({
+        INVENTORY_SECTION_SOURCE: capture_openstack_inventory(
+            source_client, max_workers=max_workers),
+        INVENTORY_SECTION_DESTINATION: capture_openstack_inventory(
+            destination_client, max_workers=max_workers),
+        INVENTORY_SECTION_CORIOLIS: capture_coriolis_inventory(
+            coriolis_client)})
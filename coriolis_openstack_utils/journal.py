@@ -0,0 +1,90 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" This module defines the execution journal, an append-only local SQLite
+database recording each successfully executed action alongside its result,
+which allows interrupted runs to be resumed at the point of failure.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+JOURNAL_TABLE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS journal ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+    "action_key TEXT NOT NULL, "
+    "action_type TEXT NOT NULL, "
+    "payload TEXT NOT NULL, "
+    "result TEXT, "
+    "completed_at REAL NOT NULL)")
+
+
+def get_action_key(action):
+    """ Returns the key identifying the given action within journals, which
+    is a hash of its type, payload and destination environment (if any). """
+    serialized = json.dumps({
+        "action_type": action.action_type,
+        "payload": action.payload,
+        "destination_env": getattr(action, "destination_env", None)},
+        sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class ExecutionJournal(object):
+    """ Journal of completed actions, backed by a SQLite file.
+    All the entries are loaded on opening, so lookups require no queries.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        # NOTE: the journal may be written to from multiple threads:
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(JOURNAL_TABLE_SCHEMA)
+        self._connection.commit()
+
+        self._results = {}
+        for action_key, result in self._connection.execute(
+                "SELECT action_key, result FROM journal ORDER BY id"):
+            self._results[action_key] = json.loads(result)
+        LOG.info(
+            "Loaded %d completed action(s) from journal '%s'.",
+            len(self._results), path)
+
+    def get_action_key(self, action):
+        return get_action_key(action)
+
+    def lookup(self, action_key):
+        """ Returns a tuple of whether the action with the given key was
+        journaled, and its journaled result. """
+        if action_key in self._results:
+            return True, self._results[action_key]
+        return False, None
+
+    def record(self, action_key, action, result):
+        """ Records the result of the action.
+        NOTE: the key should be computed before the execution of the action,
+        as it may alter its payload or destination environment.
+        """
+        serialized_result = json.dumps(result, default=str)
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO journal (action_key, action_type, payload, "
+                "result, completed_at) VALUES (?, ?, ?, ?, ?)", (
+                    action_key, action.action_type,
+                    json.dumps(action.payload, sort_keys=True, default=str),
+                    serialized_result, time.time()))
+            self._connection.commit()
+            self._results[action_key] = json.loads(serialized_result)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,7 +1,7 @@
 # Copyright 2018 Cloudbase Solutions Srl
 # All Rights Reserved.
 
-import time
+import threading
 
 from keystoneauth1 import loading
 from keystoneauth1 import session as ks_session
@@ -15,6 +15,9 @@ from neutronclient.neutron import client as neutron_client
 from novaclient import client as nova_client
 from swiftclient import client as swift_client
 
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.resource_utils import records
+
 
 LOG = logging.getLogger()
 
@@ -69,15 +72,51 @@ def create_keystone_session(connection_info):
     return ks_session.Session(auth=auth, verify=verify)
 
 
+def limit_session_concurrency(session, max_concurrent_requests):
+    """ Caps the number of requests performed concurrently through the
+    given Keystone session, and thus by all the clients sharing it, however
+    many threads use them.
+    NOTE: the requests issued while already holding a slot (ex: token
+    renewals) do not take another one, so they cannot deadlock.
+    """
+    semaphore = threading.BoundedSemaphore(max_concurrent_requests)
+    holders = threading.local()
+    request = session.request
+
+    def _request(*args, **kwargs):
+        if getattr(holders, "holding", False):
+            return request(*args, **kwargs)
+        with semaphore:
+            holders.holding = True
+            try:
+                return request(*args, **kwargs)
+            finally:
+                holders.holding = False
+
+    session.request = _request
+    return session
+
+
 class OpenStackClient(object):
 
-    def __init__(self, connection_info):
+    def __init__(self, connection_info, page_size=None,
+                 max_concurrent_requests=None):
+        """
+        param page_size: int: number of resources to fetch per request when
+        listing resources page by page.
+        param max_concurrent_requests: int: maximum number of API requests
+        to perform concurrently against the cloud across all threads, or
+        None for no limit.
+        """
         if connection_info is None:
             connection_info = {}
         region_name = connection_info.get("region_name")
 
         self.connection_info = connection_info
+        self.page_size = page_size
         session = create_keystone_session(connection_info)
+        if max_concurrent_requests:
+            limit_session_concurrency(session, max_concurrent_requests)
         self.session = session
 
         identity_api_version = connection_info["identity_api_version"]
@@ -139,51 +178,65 @@ class OpenStackClient(object):
             return self.keystone.tenants.list(user=user_id)
         return []
 
-    def get_projects_list(self):
+    def get_projects_list(self, name=None):
         """ For some credentials, it is not possible to list projects not
         created by the respective user, as such, we impose filtering on the
-        project listing."""
+        project listing.
+        If `name` is given, the listing is filtered by it server-side."""
+        filters = {}
+        if name is not None:
+            filters["name"] = name
         try:
-            return self.keystone.projects.list()
+            projects = self.keystone.projects.list(**filters)
         except KeystoneForbidden:
             user_id = self.session.get_user_id()
-            return self.keystone.projects.list(user=user_id)
-        return []
-
-    def wait_for_project_creation(
-            self, project_name, period=2, tries=30):
-        """ Waits for tenant with specified name to appear. """
-        i = 0
-        project = None
-        projects = None
-        while i < tries:
-            if int(self.connection_info["identity_api_version"]) == 2:
+            projects = self.keystone.projects.list(user=user_id, **filters)
+
+        if name is not None:
+            # NOTE: some listings (ex: per-user) may ignore the filter:
+            projects = [p for p in projects if p.name == name]
+        return projects
+
+    def wait_for_projects_creation(
+            self, project_names, timeout=utils.DEFAULT_WAIT_TIMEOUT):
+        """ Waits for all the tenants with the specified names to appear,
+        checking for all of them with a single listing per poll.
+        Returns a dict mapping the names to the respective projects. """
+        def _probe(pending_names):
+            if (len(pending_names) == 1 and
+                    int(self.connection_info["identity_api_version"]) != 2):
+                projects = self.get_projects_list(
+                    name=list(pending_names)[0])
+            elif int(self.connection_info["identity_api_version"]) == 2:
                 projects = self.get_tenants_list()
             else:
                 projects = self.get_projects_list()
 
-            filtered = [p for p in projects if p.name == project_name]
-            if len(filtered) == 0:
-                LOG.debug(
-                    "Waiting %d seconds for tenant named '%s'",
-                    period, project_name)
-            elif len(filtered) > 1:
-                raise Exception(
-                    "Multiple tenants named '%s' found using conn info"
-                    " '%s'" % (project_name, self.connection_info))
-            elif len(filtered) == 1:
-                LOG.debug("Found tenant named '%s'", project_name)
-                project = filtered[0]
-                break
-
-            time.sleep(period)
-            i = i + 1
+            found = {}
+            for project in projects:
+                if project.name not in pending_names:
+                    continue
+                if project.name in found:
+                    raise Exception(
+                        "Multiple tenants named '%s' found using conn info"
+                        " '%s'" % (project.name, self.connection_info))
+                LOG.debug("Found tenant named '%s'", project.name)
+                found[project.name] = project
+            return found
 
-        if not project:
+        try:
+            return utils.wait_for_all(
+                _probe, project_names, timeout=timeout,
+                description="tenants creation")
+        except utils.WaitTimeoutException as ex:
             raise Exception(
-                "Wait (%d seconds) failed for tenant named '%s' using "
-                "conn info: %s" % (
-                    period * tries, project_name, self.connection_info))
+                "%s using conn info: %s" % (ex, self.connection_info))
+
+    def wait_for_project_creation(
+            self, project_name, timeout=utils.DEFAULT_WAIT_TIMEOUT):
+        """ Waits for tenant with specified name to appear. """
+        return self.wait_for_projects_creation(
+            [project_name], timeout=timeout)[project_name]
 
     def get_project_name(self, project_id):
         project = None
@@ -213,14 +266,56 @@ class OpenStackClient(object):
 
         return filtered[0].id
 
-    def list_project_names(self):
+    def get_project_ids(self, project_names, ignore_missing=False):
+        """ Returns a dict mapping the given project names to their IDs,
+        resolved using a single project listing.
+        param ignore_missing: bool: whether to leave out the names of the
+        missing projects instead of raising.
+        """
         projects = None
         if int(self.connection_info["identity_api_version"]) == 2:
             projects = self.get_tenants_list()
         else:
             projects = self.get_projects_list()
 
-        return [p.name for p in projects]
+        project_names = set(project_names)
+        project_ids = {}
+        for project in projects:
+            if project.name not in project_names:
+                continue
+            if project.name in project_ids:
+                raise Exception(
+                    "Multiple tenants named '%s' found using conn info "
+                    "'%s'" % (project.name, self.connection_info))
+            project_ids[project.name] = project.id
+
+        missing = project_names - set(project_ids)
+        if missing and not ignore_missing:
+            raise Exception(
+                "Cannot locate projects with names %s using conn info "
+                "%s." % (list(missing), self.connection_info))
+
+        return project_ids
+
+    def list_projects(self):
+        """ Lists all the (visible) projects, whatever the identity API
+        version, as `records.ProjectRecord`s. """
+        if int(self.connection_info["identity_api_version"]) == 2:
+            projects = self.get_tenants_list()
+        else:
+            projects = self.get_projects_list()
+        return [records.project_record(project) for project in projects]
+
+    def list_project_names(self):
+        return [p.name for p in self.list_projects()]
+
+    def get_project_names(self, project_ids):
+        """ Returns a dict mapping those of the given project IDs which exist
+        to their names, resolved using a single project listing. """
+        project_ids = set(project_ids)
+        return {
+            project.id: project.name for project in self.list_projects()
+            if project.id in project_ids}
 
     def add_admin_role_to_project(
             self, project_name, username, admin_role_name="admin"):
@@ -278,6 +373,12 @@ class OpenStackClient(object):
 
         return project.id
 
+    def delete_project(self, project_id):
+        if int(self.connection_info["identity_api_version"]) == 2:
+            self.keystone.tenants.delete(project_id)
+        else:
+            self.keystone.projects.delete(project_id)
+
     def delete_project_by_name(self, project_name):
         project_id = self.get_project_id(project_name)
         self.keystone.projects.delete(project_id)
@@ -0,0 +1,316 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" This module defines serializable execution plans.
+A plan records the leaf actions resolved during a drill run (alongside their
+payloads, destination environments, dependencies and whether they were found
+to be already done) so that they may later be applied directly, without
+redoing all the discovery and similarity checks.
+"""
+
+import copy
+import hashlib
+import json
+import time
+
+from oslo_log import log as logging
+
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import constants
+from coriolis_openstack_utils.actions import coriolis_endpoint_actions
+from coriolis_openstack_utils.actions import coriolis_transfer_actions
+from coriolis_openstack_utils.actions import flavor_actions
+from coriolis_openstack_utils.actions import keypair_actions
+from coriolis_openstack_utils.actions import network_actions
+from coriolis_openstack_utils.actions import secgroup_actions
+from coriolis_openstack_utils.actions import tenant_actions
+
+CONF = conf.CONF
+LOG = logging.getLogger(__name__)
+
+PLAN_FORMAT_VERSION = 1
+DEFAULT_PLAN_MAX_AGE = 3600
+PLAN_REFERENCE_KEY = "plan_ref"
+
+ENTRY_STATUS_DONE = "ALREADY DONE"
+ENTRY_STATUS_APPLIED = "APPLIED"
+ENTRY_STATUS_JOURNALED = "JOURNALED"
+
+# NOTE: options which do not affect the outcome of the planned actions:
+FINGERPRINT_EXCLUDED_OPTS = [
+    "password", "new_users_password", "max_concurrent_requests",
+    "page_size"]
+
+PLANNABLE_ACTION_CLASSES = {
+    action_class.action_type: action_class for action_class in [
+        coriolis_endpoint_actions.SourceEndpointCreationAction,
+        coriolis_endpoint_actions.DestinationEndpointCreationAction,
+        coriolis_transfer_actions.MigrationCreationAction,
+        coriolis_transfer_actions.ReplicaCreationAction,
+        flavor_actions.FlavorCreationAction,
+        keypair_actions.KeypairCreationAction,
+        network_actions.NetworkCreationAction,
+        network_actions.SubnetCreationAction,
+        network_actions.RouterCreationAction,
+        network_actions.PortCreationAction,
+        secgroup_actions.SecurityGroupCreationAction,
+        tenant_actions.TenantCreationAction,
+        tenant_actions.UserCreationAction]}
+
+
+def get_config_fingerprint():
+    """ Returns a hash of all the configuration options which influence the
+    resources planned and created by the actions. """
+    config = {}
+    for group_name in [constants.SOURCE_OPT_GROUP_NAME,
+                       constants.DESTINATION_OPT_GROUP_NAME,
+                       constants.CORIOLIS_OPT_GROUP_NAME]:
+        group = getattr(CONF, group_name)
+        config[group_name] = {
+            opt: group[opt] for opt in group
+            if opt not in FINGERPRINT_EXCLUDED_OPTS}
+
+    serialized = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def get_planning_time():
+    """ Returns the time as of which plans are made, which is the time the
+    inventory was captured at when working offline. """
+    offline_inventory = conf.get_inventory()
+    if offline_inventory is not None:
+        return offline_inventory.captured_at
+    return time.time()
+
+
+def get_reference(key):
+    """ Returns a placeholder to be used within the payload of a plan entry
+    in place of the result of the entry with the given key, which will only
+    be known after it gets applied. """
+    return {PLAN_REFERENCE_KEY: key}
+
+
+def _resolve_references(value, results):
+    if isinstance(value, dict):
+        if list(value.keys()) == [PLAN_REFERENCE_KEY]:
+            return results[value[PLAN_REFERENCE_KEY]]
+        return {k: _resolve_references(v, results) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_resolve_references(v, results) for v in value]
+    return value
+
+
+class ExecutionPlan(object):
+    """ Ordered list of plan entries, each of the form:
+    {
+        "key": 0,                   # index of the entry within the plan
+        "action_type": "...",       # type of the action to be executed
+        "payload": {},              # payload of the action
+        "destination_env": None,    # destination env (for transfers)
+        "depends_on": [],           # keys of the prerequisite entries
+        "done": False,              # whether the action was already done
+        "result": None,             # result of the action if already done
+    }
+    Entries may only depend on the entries preceding them, so applying them
+    in order always respects the dependencies.
+    """
+
+    def __init__(self, command, entries=None, created_at=None,
+                 config_fingerprint=None):
+        self.command = command
+        self.entries = entries or []
+        self.created_at = created_at or get_planning_time()
+        self.config_fingerprint = (
+            config_fingerprint or get_config_fingerprint())
+
+    def add_entry(self, action_type, payload, destination_env=None,
+                  depends_on=(), done=False, result=None):
+        if action_type not in PLANNABLE_ACTION_CLASSES:
+            raise ValueError(
+                "Actions of type '%s' cannot be planned." % action_type)
+
+        key = len(self.entries)
+        depends_on = sorted(set(depends_on))
+        for dependency in depends_on:
+            if not 0 <= dependency < key:
+                raise ValueError(
+                    "Plan entry %d cannot depend on entry %s." % (
+                        key, dependency))
+
+        self.entries.append({
+            "key": key,
+            "action_type": action_type,
+            "payload": copy.deepcopy(payload),
+            "destination_env": copy.deepcopy(destination_env),
+            "depends_on": depends_on,
+            "done": done,
+            "result": result})
+        return key
+
+    def get_reference(self, key):
+        if not 0 <= key < len(self.entries):
+            raise ValueError("No plan entry with key %s." % key)
+        return get_reference(key)
+
+    def add_action(self, action, depends_on=(), check=True):
+        done = {"done": False, "result": None}
+        if check:
+            done = action.check_already_done()
+
+        return self.add_entry(
+            action.action_type, action.payload,
+            destination_env=getattr(action, "destination_env", None),
+            depends_on=depends_on, done=done["done"], result=done["result"])
+
+    def to_dict(self):
+        return {
+            "version": PLAN_FORMAT_VERSION,
+            "command": self.command,
+            "created_at": self.created_at,
+            "config_fingerprint": self.config_fingerprint,
+            "entries": self.entries}
+
+    @classmethod
+    def from_dict(cls, plan_dict):
+        if plan_dict.get("version") != PLAN_FORMAT_VERSION:
+            raise Exception(
+                "Unsupported plan format version '%s' (expected %s)." % (
+                    plan_dict.get("version"), PLAN_FORMAT_VERSION))
+
+        return cls(
+            plan_dict["command"], entries=plan_dict["entries"],
+            created_at=plan_dict["created_at"],
+            config_fingerprint=plan_dict["config_fingerprint"])
+
+    def write(self, path):
+        with open(path, 'w') as fd:
+            json.dump(
+                self.to_dict(), fd, indent=2, sort_keys=True, default=str)
+        LOG.info(
+            "Wrote plan with %d entries for command '%s' to '%s'.",
+            len(self.entries), self.command, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as fd:
+            return cls.from_dict(json.load(fd))
+
+    def check_staleness(self, max_age=DEFAULT_PLAN_MAX_AGE):
+        """ Raises if the plan was made using a different configuration, or
+        is older than `max_age` seconds (if set). """
+        if self.config_fingerprint != get_config_fingerprint():
+            raise Exception(
+                "The plan for command '%s' was made with a different "
+                "configuration than the current one. Please recreate it." % (
+                    self.command))
+
+        age = time.time() - self.created_at
+        if max_age and age > max_age:
+            raise Exception(
+                "The plan for command '%s' is %d seconds old, which exceeds "
+                "the maximum age of %d seconds. Please recreate it." % (
+                    self.command, age, max_age))
+
+    def print_operations(self):
+        LOG.info(
+            "###### Plan for command '%s' with %d entries:",
+            self.command, len(self.entries))
+        for entry in self.entries:
+            LOG.info(
+                "%d: %s%s (depends on %s): %s", entry["key"],
+                entry["action_type"],
+                " [%s]" % ENTRY_STATUS_DONE if entry["done"] else "",
+                entry["depends_on"], entry["payload"])
+
+
+def _instantiate_action(entry, results, source_openstack_client=None,
+                        destination_openstack_client=None,
+                        coriolis_client=None):
+    action_class = PLANNABLE_ACTION_CLASSES[entry["action_type"]]
+    kwargs = {
+        "source_openstack_client": source_openstack_client,
+        "destination_openstack_client": destination_openstack_client,
+        "coriolis_client": coriolis_client}
+    if entry.get("destination_env") is not None:
+        kwargs["destination_env"] = copy.deepcopy(entry["destination_env"])
+
+    action = action_class(
+        _resolve_references(entry["payload"], results), **kwargs)
+    # NOTE: all the subactions were planned as separate entries, and the
+    # actions themselves were already checked when the plan was made:
+    action.subactions = []
+    action.set_check_result({"done": False, "result": None})
+    return action
+
+
+def apply_plan(plan, source_openstack_client=None,
+               destination_openstack_client=None, coriolis_client=None,
+               journal=None):
+    """ Executes all the entries of the plan which were not already done.
+    If a `journal.ExecutionJournal` is given, the executed entries are
+    recorded in it and the already journaled ones are skipped. Otherwise, all
+    the executed entries are rolled back on failure.
+    Returns a list of dicts with the "key", "action_type", "status" and
+    "result" of each entry.
+    """
+    results = {}
+    statuses = []
+    applied_actions = []
+    try:
+        for entry in plan.entries:
+            key = entry["key"]
+            if entry["done"]:
+                LOG.debug(
+                    "Plan entry %d (%s) already done, skipping.",
+                    key, entry["action_type"])
+                results[key] = entry["result"]
+                status = ENTRY_STATUS_DONE
+            else:
+                action = _instantiate_action(
+                    entry, results,
+                    source_openstack_client=source_openstack_client,
+                    destination_openstack_client=(
+                        destination_openstack_client),
+                    coriolis_client=coriolis_client)
+                action.journal = journal
+                found = False
+                action_key = None
+                if journal is not None:
+                    action_key = journal.get_action_key(action)
+                    found, results[key] = journal.lookup(action_key)
+
+                if found:
+                    LOG.info(
+                        "Plan entry %d (%s) already journaled, skipping.",
+                        key, entry["action_type"])
+                    status = ENTRY_STATUS_JOURNALED
+                else:
+                    LOG.info(
+                        "Applying plan entry %d (%s).",
+                        key, entry["action_type"])
+                    applied_actions.append(action)
+                    results[key] = action.execute_operations()
+                    if journal is not None:
+                        journal.record(action_key, action, results[key])
+                    status = ENTRY_STATUS_APPLIED
+
+            statuses.append({
+                "key": key,
+                "action_type": entry["action_type"],
+                "status": status,
+                "result": results[key]})
+    except (Exception, KeyboardInterrupt):
+        if journal is not None:
+            LOG.warn(
+                "Error occured while applying plan for command '%s'. "
+                "Rerun with the same journal to resume.", plan.command)
+            raise
+
+        LOG.warn(
+            "Error occured while applying plan for command '%s'. Rolling "
+            "back all changes", plan.command)
+        for action in reversed(applied_actions):
+            action.cleanup()
+        raise
+
+    return statuses
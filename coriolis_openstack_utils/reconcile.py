@@ -0,0 +1,268 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" This module defines the reconcile engine, which loads the tenant-scoped
+resources of both the source and destination in bulk, and matches them by
+their formatted destination names and fingerprints in a single pass.
+Each source resource is determined to either need creating, to already have
+an equivalent on the destination (skip), or to conflict with destination
+resources bearing its name but differing attributes, just like the
+`check_already_done` of the respective actions would, but without any
+per-resource API calls.
+"""
+
+from oslo_log import log as logging
+
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.actions import flavor_actions
+from coriolis_openstack_utils.resource_utils import networks
+from coriolis_openstack_utils.resource_utils import records
+from coriolis_openstack_utils.resource_utils import routers
+from coriolis_openstack_utils.resource_utils import security_groups
+from coriolis_openstack_utils.resource_utils import subnets
+from coriolis_openstack_utils.resource_utils import tags
+
+CONF = conf.CONF
+LOG = logging.getLogger(__name__)
+
+STATUS_CREATE = "create"
+STATUS_SKIP = "skip"
+STATUS_CONFLICT = "conflict"
+
+
+class TenantResources(object):
+    """ The Neutron resources of a tenant (and their subnets and gateway
+    networks), each type of which is listed only once and held as compact
+    records (see `records`).
+    """
+
+    def __init__(self, openstack_client, tenant_id):
+        self.tenant_id = tenant_id
+        self.networks = [
+            records.network_record(net) for net in networks.iter_networks(
+                openstack_client, tenant_id)]
+
+        self.subnets = {}
+        network_ids = [net['id'] for net in self.networks]
+        if network_ids:
+            for subnet in subnets.iter_subnets(
+                    openstack_client, filters={'network_id': network_ids}):
+                self.subnets[subnet['id']] = records.subnet_record(subnet)
+
+        self.routers = [
+            records.router_record(router) for router in routers.iter_routers(
+                openstack_client,
+                filters={'project_id': tenant_id, 'tenant_id': tenant_id})]
+        self.security_groups = [
+            records.security_group_record(secgroup)
+            for secgroup in security_groups.iter_security_groups(
+                openstack_client, tenant_id)]
+
+        # NOTE: the external gateway networks of the routers are usually
+        # outside of the tenant:
+        self.network_names = {net['id']: net['name'] for net in self.networks}
+        gateway_network_ids = set(
+            (router.get('external_gateway_info') or {}).get('network_id')
+            for router in self.routers) - set(self.network_names) - set(
+                [None])
+        for network_id, network in networks.get_networks_by_ids(
+                openstack_client, gateway_network_ids,
+                fields=['id', 'name']).items():
+            self.network_names[network_id] = network['name']
+
+    def get_network_subnets(self, network):
+        return [
+            self.subnets[subnet_id] for subnet_id in network['subnets']
+            if subnet_id in self.subnets]
+
+
+class ReconcileResult(object):
+    """ Outcome of the reconciliation of a source tenant against a
+    destination tenant, holding an entry of the form:
+    {
+        "resource_type": "network",     # see `rollback.RESOURCE_TYPE_*`
+        "source_id": "...",
+        "source_name": "...",
+        "destination_name": "...",      # formatted destination name
+        "status": "create",             # see `STATUS_*`
+        "destination_id": None,         # ID of the equivalent resource
+        "reason": None,                 # reason of the conflict
+        "source": {...},                # the source resource
+    }
+    for each of the reconciled source resources.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, resource_type, source, destination_name, status,
+            destination_id=None, reason=None):
+        self.entries.append({
+            "resource_type": resource_type,
+            "source_id": source.get('id'),
+            "source_name": source.get('name'),
+            "destination_name": destination_name,
+            "status": status,
+            "destination_id": destination_id,
+            "reason": reason,
+            "source": source})
+
+    def get_entries(self, resource_type=None, status=None):
+        return [
+            entry for entry in self.entries
+            if resource_type in (None, entry["resource_type"]) and
+            status in (None, entry["status"])]
+
+    def get_counts(self):
+        """ Returns a dict mapping (resource type, status) tuples to the
+        number of entries with them. """
+        counts = {}
+        for entry in self.entries:
+            key = (entry["resource_type"], entry["status"])
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def raise_on_conflicts(self):
+        conflicts = self.get_entries(status=STATUS_CONFLICT)
+        if conflicts:
+            raise Exception(
+                "Found %d conflicting destination resource(s): %s" % (
+                    len(conflicts), [
+                        "%s '%s': %s" % (
+                            entry["resource_type"],
+                            entry["destination_name"], entry["reason"])
+                        for entry in conflicts]))
+
+
+def _reconcile_by_name(result, resource_type, src_resources, dest_resources,
+                       name_format, check_similarity):
+    """ Matches each source resource against the destination resources
+    tagged with its ID (see `tags`) or else named after it, checking their
+    similarity using `check_similarity(src_resource, dest_resource)`. """
+    dest_by_name = {}
+    dest_by_tag = {}
+    for dest_resource in dest_resources:
+        dest_by_name.setdefault(dest_resource['name'], []).append(
+            dest_resource)
+        for tag in dest_resource.get('tags') or []:
+            dest_by_tag.setdefault(tag, dest_resource)
+
+    for src_resource in src_resources:
+        dest_name = name_format % {"original": src_resource['name']}
+        tagged = dest_by_tag.get(tags.get_source_tag(src_resource['id']))
+        if tagged:
+            result.add(
+                resource_type, src_resource, dest_name, STATUS_SKIP,
+                destination_id=tagged['id'])
+            continue
+
+        candidates = dest_by_name.get(dest_name, [])
+        similar = [
+            dest_resource for dest_resource in candidates
+            if check_similarity(src_resource, dest_resource)]
+        if similar:
+            result.add(
+                resource_type, src_resource, dest_name, STATUS_SKIP,
+                destination_id=similar[0]['id'])
+        elif len(candidates) == 1:
+            result.add(
+                resource_type, src_resource, dest_name, STATUS_CONFLICT,
+                destination_id=candidates[0]['id'],
+                reason="same name but different attributes")
+        elif candidates:
+            result.add(
+                resource_type, src_resource, dest_name, STATUS_CONFLICT,
+                reason="%d resources with the same name" % len(candidates))
+        else:
+            result.add(resource_type, src_resource, dest_name, STATUS_CREATE)
+
+
+def reconcile_tenant(source_client, destination_client, src_tenant_id,
+                     dest_tenant_id, src_flavors=None, dest_flavors=None):
+    """ Reconciles the networks (alongside their subnets), routers and
+    security groups of the source tenant against the ones of the destination
+    tenant, and the given flavors (if any), in a single pass.
+    param src_flavors: list: `records.FlavorRecord`s of the source flavors
+    to reconcile.
+    param dest_flavors: list: `records.FlavorRecord`s of all the
+    destination flavors.
+    Returns a `ReconcileResult`.
+    """
+    LOG.info(
+        "Loading resources of source tenant '%s' and destination tenant "
+        "'%s' for reconciliation.", src_tenant_id, dest_tenant_id)
+    src, dest = utils.run_concurrently(
+        TenantResources, [
+            (source_client, src_tenant_id),
+            (destination_client, dest_tenant_id)], max_workers=2)
+    result = ReconcileResult()
+
+    def _check_network_similarity(src_network, dest_network):
+        return networks.check_network_similarity(
+            src_network, dest_network, source_client, destination_client,
+            src_subnets=src.get_network_subnets(src_network),
+            dest_subnets=dest.get_network_subnets(dest_network))
+
+    _reconcile_by_name(
+        result, rollback.RESOURCE_TYPE_NETWORK, src.networks, dest.networks,
+        CONF.destination.new_network_name_format, _check_network_similarity)
+
+    # NOTE: subnets are matched within the destination networks the source
+    # networks were matched to (if any):
+    matched_networks = {
+        entry["source_id"]: entry["destination_id"]
+        for entry in result.get_entries(
+            resource_type=rollback.RESOURCE_TYPE_NETWORK)}
+    for src_network in src.networks:
+        dest_network_id = matched_networks.get(src_network['id'])
+        dest_network_subnets = []
+        if dest_network_id:
+            dest_network_subnets = [
+                subnet for subnet in dest.subnets.values()
+                if subnet['network_id'] == dest_network_id]
+        _reconcile_by_name(
+            result, rollback.RESOURCE_TYPE_SUBNET,
+            src.get_network_subnets(src_network), dest_network_subnets,
+            CONF.destination.new_subnet_name_format,
+            subnets.check_subnet_similarity)
+
+    network_names = dict(src.network_names)
+    network_names.update(dest.network_names)
+    _reconcile_by_name(
+        result, rollback.RESOURCE_TYPE_ROUTER, src.routers, dest.routers,
+        CONF.destination.new_router_name_format,
+        lambda src_router, dest_router: routers.check_router_similarity(
+            source_client, src_router, destination_client, dest_router,
+            network_names=network_names))
+
+    def _check_secgroup_similarity(src_secgroup, dest_secgroup):
+        dest_rule_fingerprints = set(
+            security_groups.get_rule_fingerprint(rule)
+            for rule in dest_secgroup['security_group_rules'])
+        return all(
+            security_groups.get_rule_fingerprint(rule) in
+            dest_rule_fingerprints
+            for rule in src_secgroup['security_group_rules'])
+
+    _reconcile_by_name(
+        result, rollback.RESOURCE_TYPE_SECGROUP, src.security_groups,
+        dest.security_groups, CONF.destination.new_secgroup_name_format,
+        _check_secgroup_similarity)
+
+    if src_flavors:
+        _reconcile_by_name(
+            result, rollback.RESOURCE_TYPE_FLAVOR, src_flavors,
+            dest_flavors or [], CONF.destination.new_flavor_name_format,
+            lambda src_flavor, dest_flavor: utils.fingerprint(
+                src_flavor, keys=flavor_actions.FLAVOR_RELEVANT_KEYS) == (
+                    utils.fingerprint(
+                        dest_flavor,
+                        keys=flavor_actions.FLAVOR_RELEVANT_KEYS)))
+
+    for (resource_type, status), count in sorted(
+            result.get_counts().items()):
+        LOG.info("Reconciled %d %s(s): %s.", count, resource_type, status)
+
+    return result
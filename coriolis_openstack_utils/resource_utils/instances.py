@@ -2,17 +2,177 @@
 # All Rights Reserved.
 import math
 import datetime
+import re
 
 from oslo_log import log as logging
-from neutronclient.common.exceptions import NotFound
 from glanceclient.common.exceptions import NotFound as ImageNotFound
+from novaclient.exceptions import NotFound as ServerNotFound
 from oslo_utils import units
+from oslo_utils import uuidutils
+
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.resource_utils import pagination
+from coriolis_openstack_utils.resource_utils import records
 
 LOG = logging.getLogger(__name__)
 
+INSTANCE_REFERENCE_TENANT_SEPARATOR = "/"
 
-def find_source_instances_by_name(client, instance_names):
-    """ List all instances from source and return dicts of the form:
+
+class SourceInstanceNameIndex(object):
+    """ Indexes the IDs of all the source instances by name, which are only
+    listed once (on the first lookup) so that instance names may be looked
+    up repeatedly, such as for each chunk of a batch.
+
+    param client: utils.OpenStackClient: client for source
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._instance_ids_by_name = None
+
+    def _get_instance_ids_by_name(self):
+        if self._instance_ids_by_name is None:
+            instance_ids_by_name = {}
+            # NOTE: only the names and IDs of all the instances are listed,
+            # with the details only being fetched for the matching ones:
+            for instance in iter_instances(self._client, detailed=False):
+                instance_ids_by_name.setdefault(
+                    instance.name, []).append(instance.id)
+            self._instance_ids_by_name = instance_ids_by_name
+        return self._instance_ids_by_name
+
+    def lookup(self, instance_names):
+        """ Returns a tuple of a dict mapping each of the given instance
+        names to the list of `records.InstanceRecord`s of the source
+        instances bearing it, and the list of the names no instance was
+        found for. """
+        instance_names = set(instance_names)
+        instance_ids_by_name = self._get_instance_ids_by_name()
+        indexed = {
+            name: instance_ids_by_name[name] for name in instance_names
+            if name in instance_ids_by_name}
+
+        def _get_instance_record(instance_id):
+            return records.instance_record(
+                self._client.nova.servers.get(instance_id))
+
+        details = dict(zip(
+            [instance_id for ids in indexed.values() for instance_id in ids],
+            utils.run_concurrently(
+                _get_instance_record,
+                [(instance_id,) for ids in indexed.values()
+                 for instance_id in ids])))
+        indexed = {
+            name: [details[instance_id] for instance_id in ids]
+            for name, ids in indexed.items()}
+
+        missing = sorted(instance_names - set(indexed))
+        return indexed, missing
+
+
+def index_source_instances_by_name(client, instance_names, name_index=None):
+    """ Lists all instances from source once (unless the given
+    `SourceInstanceNameIndex` already did) and returns a tuple of a dict
+    mapping each of the given instance names to the list of
+    `records.InstanceRecord`s of the source instances bearing it, and the
+    list of the names no instance was found for. """
+    if name_index is None:
+        name_index = SourceInstanceNameIndex(client)
+    return name_index.lookup(instance_names)
+
+
+def get_exact_name_filter(instance_name):
+    """ Returns the Nova 'name' filter only matching the given instance name.
+    NOTE: Nova name filters are regexes, so the name must be escaped. """
+    return '^%s$' % re.escape(instance_name)
+
+
+def parse_instance_reference(instance_ref):
+    """ Parses an instance reference, which may either be an instance ID, a
+    tenant-qualified instance name of the form 'TENANT_NAME/INSTANCE_NAME',
+    or a plain instance name.
+    Returns a tuple of the form (instance_id, tenant_name, instance_name)
+    with only the fields present in the reference set.
+    NOTE: instance names may also contain the separator or look like IDs,
+    so `resolve_source_instances` falls back to looking up the references
+    as plain names when they match no instance otherwise.
+    """
+    if uuidutils.is_uuid_like(instance_ref):
+        return instance_ref, None, None
+    if INSTANCE_REFERENCE_TENANT_SEPARATOR in instance_ref:
+        tenant_name, instance_name = instance_ref.split(
+            INSTANCE_REFERENCE_TENANT_SEPARATOR, 1)
+        return None, tenant_name, instance_name
+    return None, None, instance_ref
+
+
+def resolve_source_instances(client, instance_refs, name_index=None):
+    """ Resolves the given instance references (see
+    `parse_instance_reference`) to source instances, using direct lookups
+    for IDs and tenant-scoped server-side filtering for tenant-qualified
+    names, so only plain instance names require listing all the instances
+    (through the given `SourceInstanceNameIndex`, if any). The IDs and
+    tenant-qualified names matching no instance are looked up as plain
+    instance names as well.
+    Returns a tuple of a dict mapping each reference to the list of
+    `records.InstanceRecord`s of the source instances it matches, and the
+    list of references matching no instance.
+    """
+    resolved = {}
+    tenant_instance_refs = {}
+    instance_names = set()
+    for instance_ref in set(instance_refs):
+        instance_id, tenant_name, instance_name = parse_instance_reference(
+            instance_ref)
+        if instance_id:
+            try:
+                resolved[instance_ref] = [records.instance_record(
+                    client.nova.servers.get(instance_id))]
+            except ServerNotFound:
+                instance_names.add(instance_ref)
+        elif tenant_name:
+            tenant_instance_refs.setdefault(tenant_name, {})[
+                instance_name] = instance_ref
+        else:
+            instance_names.add(instance_name)
+
+    if tenant_instance_refs:
+        tenant_ids = client.get_project_ids(
+            tenant_instance_refs.keys(), ignore_missing=True)
+        for tenant_name, refs in tenant_instance_refs.items():
+            if tenant_name not in tenant_ids:
+                instance_names.update(refs.values())
+                continue
+            for instance_name, instance_ref in refs.items():
+                # NOTE: the exact names are still checked, as the regex
+                # dialect of Nova's database may differ from Python's:
+                found = [
+                    records.instance_record(instance)
+                    for instance in iter_instances(
+                        client, filters={
+                            'project_id': tenant_ids[tenant_name],
+                            'tenant_id': tenant_ids[tenant_name],
+                            'name': get_exact_name_filter(instance_name)})
+                    if instance.name == instance_name]
+                if found:
+                    resolved[instance_ref] = found
+                else:
+                    instance_names.add(instance_ref)
+
+    if instance_names:
+        indexed, _ = index_source_instances_by_name(
+            client, instance_names, name_index=name_index)
+        resolved.update(indexed)
+
+    missing = sorted(set(instance_refs) - set(resolved))
+    return resolved, missing
+
+
+def get_source_instance_info(client, instance):
+    """
+    param instance: records.InstanceRecord: the source instance
+    Returns a dict of the form:
     {
         "instance_name": "",
         "instance_id": "",
@@ -24,107 +184,189 @@ def find_source_instances_by_name(client, instance_names):
         "attached_storage": ["cindervoltype1", "cindervoltype2", ...]
     }
     """
-    instances_list = client.nova.servers.list(
-        search_opts={'all_tenants': True})
-    instance_info_list = []
-    for instance in instances_list:
-        if instance.name in instance_names:
-            instance_info = {}
-            instance_info['instance_name'] = instance.name
-            instance_info['instance_id'] = instance.id
-            instance_info['instance_tenant_id'] = instance.tenant_id
-            instance_info['instance_tenant_name'] = client.get_project_name(
-                instance_info['instance_tenant_id'])
+    instance_info = {}
+    instance_info['instance_name'] = instance.name
+    instance_info['instance_id'] = instance.id
+    instance_info['instance_tenant_id'] = instance.tenant_id
+    instance_info['instance_tenant_name'] = client.get_project_name(
+        instance_info['instance_tenant_id'])
+
+    attached_volumes_ids = [
+        el.id for el in
+        client.nova.volumes.get_server_volumes(instance.id)]
 
-            attached_volumes_ids = [
-                el.id for el in
-                client.nova.volumes.get_server_volumes(instance.id)]
+    attached_volume_types = [
+        client.cinder.volumes.find(id=vol_id).volume_type
+        for vol_id in attached_volumes_ids]
 
-            attached_volume_types = [
-                client.cinder.volumes.find(id=vol_id).volume_type
-                for vol_id in attached_volumes_ids]
+    instance_info['attached_storage'] = list(
+        set(attached_volume_types))
 
-            instance_info['attached_storage'] = list(
-                set(attached_volume_types))
+    ips = set()
+    for iface in client.nova.servers.interface_list(instance.id):
+        ips |= set([ip['ip_address'] for ip in iface.fixed_ips])
 
-            ips = set()
-            for iface in instance.interface_list():
-                ips |= set([ip['ip_address'] for ip in iface.fixed_ips])
+    instance_info['fixed_ips'] = list(ips)
 
-            instance_info['fixed_ips'] = list(ips)
+    # Do we care only about the fixed ips networks?
+    net_names = [
+        n for n, v in instance.networks.items() if set(v) & ips]
+    instance_info['attached_networks'] = net_names
 
-            # Do we care only about the fixed ips networks?
-            net_names = [
-                n for n, v in instance.networks.items() if set(v) & ips]
-            instance_info['attached_networks'] = net_names
+    return instance_info
 
-            instance_info_list.append(instance_info)
 
-    return instance_info_list
+def find_source_instances_by_name(client, instance_names):
+    """ List all instances from source and return dicts of the form returned
+    by `get_source_instance_info` for the ones with the given names. """
+    indexed, _ = index_source_instances_by_name(client, instance_names)
+    return [
+        get_source_instance_info(client, instance)
+        for name_instances in indexed.values()
+        for instance in name_instances]
 
 
-def validate_transfer_options(
-        source_client, destination_client, instance_info, target_env):
-    """
-    Raise error if: unmapped network, inexistent destination network,
-    unmapped storage, inexistent destination storage
-    # TODO: check if all IPs available on destination.
+class TransferValidationContext(object):
+    """ Holds all the batch-wide information required for validating the
+    transfer options of instances, which is only fetched once per batch so
+    that validating each instance requires no further API calls.
 
     param source_client: utils.OpenStackClient: client for source
     param destination_client: utils.OpenStackClient: client for destination
-    param instance_info: dict: output from `find_source_instances_by_name`
     target_env: dict: with "network_map" and "storage_map"
     """
 
-    destination_mapped_networks = set(target_env['network_map'].values())
-    for network in destination_mapped_networks:
-        try:
-            destination_client.neutron.find_resource('network', network)
-        except Exception:
-            ValueError("Invalid destination network %s" % network)
-
-    source_mapped_networks = set(target_env['network_map'].keys())
-    for network in source_mapped_networks:
-        try:
-            source_client.neutron.find_resource('network', network)
-        except NotFound:
-            ValueError("Invalid source network %s" % network)
-
-    instance_networks = set(instance_info['attached_networks'])
-    if not instance_networks.issubset(source_mapped_networks):
-        raise ValueError("%s instance networks are not mapped." % (
-            instance_networks - source_mapped_networks))
-    for network in instance_networks:
-        dest_net = target_env['network_map'][network]
-        try:
-            destination_client.neutron.find_resource('network', dest_net)
-        except NotFound:
-            raise ValueError("Inexistent destination network %s" % dest_net)
-
-    source_volume_types = set([
-        el.name for el in source_client.cinder.volume_types.findall()])
-    destination_volume_types = set([
-        el.name for el in destination_client.cinder.volume_types.findall()])
+    def __init__(self, source_client, destination_client, target_env):
+        self.network_map = target_env['network_map']
+        self.storage_map = target_env.get("storage_map", {})
+
+        def _network_exists(client, network):
+            try:
+                client.neutron.find_resource(
+                    'network', network, fields=['id'])
+                return True
+            except Exception:
+                return False
+
+        source_mapped_networks = sorted(set(self.network_map.keys()))
+        destination_mapped_networks = sorted(set(self.network_map.values()))
+        networks_exist = utils.run_concurrently(
+            _network_exists,
+            [(source_client, net) for net in source_mapped_networks] +
+            [(destination_client, net)
+             for net in destination_mapped_networks])
+        self.source_mapped_networks = set(source_mapped_networks)
+        self.invalid_source_networks = set(
+            net for net, exists in zip(
+                source_mapped_networks, networks_exist) if not exists)
+        self.invalid_destination_networks = set(
+            net for net, exists in zip(
+                destination_mapped_networks,
+                networks_exist[len(source_mapped_networks):])
+            if not exists)
+        if self.invalid_source_networks:
+            LOG.warn("Invalid source network(s) in network map: %s",
+                     self.invalid_source_networks)
+
+        self.source_volume_types = set([
+            el.name for el in source_client.cinder.volume_types.findall()])
+        self.destination_volume_types = set([
+            el.name for el in
+            destination_client.cinder.volume_types.findall()])
+        self.source_mapped_volume_types = set(self.storage_map.keys())
+        destination_mapped_volume_types = set(self.storage_map.values())
+
+        if not destination_mapped_volume_types.issubset(
+                self.destination_volume_types):
+            LOG.info("%s volume types don't exist on destination." %
+                     (destination_mapped_volume_types -
+                      self.destination_volume_types))
+
+        if not self.source_mapped_volume_types.issubset(
+                self.source_volume_types):
+            LOG.info("%s volume types don't exist on source." %
+                     (self.source_mapped_volume_types -
+                      self.source_volume_types))
+
+    def validate_instance(self, instance_info):
+        """ Returns a list of the validation errors for the instance.
+        param instance_info: dict: output from `find_source_instances_by_name`
+        """
+        errors = []
+        instance_networks = set(instance_info['attached_networks'])
+        unmapped_networks = instance_networks - self.source_mapped_networks
+        if unmapped_networks:
+            errors.append("%s instance networks are not mapped." % (
+                unmapped_networks))
+
+        for network in sorted(instance_networks - unmapped_networks):
+            dest_net = self.network_map[network]
+            if dest_net in self.invalid_destination_networks:
+                errors.append("Inexistent destination network %s" % dest_net)
+
+        instance_volume_types = set(instance_info['attached_storage'])
+        if not instance_volume_types.issubset(
+                self.source_mapped_volume_types):
+            LOG.info("%s volume types are not mapped." %
+                     (instance_volume_types -
+                      self.source_mapped_volume_types))
+
+        return errors
+
+
+def validate_batch_transfer_options(
+        source_client, destination_client, instance_infos, target_env,
+        context=None):
+    """
+    Raise error if any of the instances has: unmapped network, inexistent
+    destination network. The errors of all the instances are raised at once.
+    # TODO: check if all IPs available on destination.
 
-    storage_map = target_env.get("storage_map", {})
-    destination_mapped_volume_types = set(storage_map.values())
-    source_mapped_volume_types = set(storage_map.keys())
+    param source_client: utils.OpenStackClient: client for source
+    param destination_client: utils.OpenStackClient: client for destination
+    param instance_infos: list: output from `find_source_instances_by_name`
+    target_env: dict: with "network_map" and "storage_map"
+    param context: TransferValidationContext: context to validate against,
+    which is otherwise built from the clients and `target_env`.
+    """
+    if context is None:
+        context = TransferValidationContext(
+            source_client, destination_client, target_env)
+
+    errors = []
+    invalid_instances_count = 0
+    for instance_info in instance_infos:
+        LOG.info(
+            "Validating configuration for VM: \"%s\"",
+            instance_info['instance_name'])
+        instance_errors = context.validate_instance(instance_info)
+        if instance_errors:
+            invalid_instances_count += 1
+        errors.extend(
+            "VM '%s' (tenant '%s'): %s" % (
+                instance_info['instance_name'],
+                instance_info['instance_tenant_name'], error)
+            for error in instance_errors)
+
+    if errors:
+        raise ValueError(
+            "Invalid transfer options for %d VM(s):\n%s" % (
+                invalid_instances_count, "\n".join(errors)))
 
-    if not destination_mapped_volume_types.issubset(destination_volume_types):
-        LOG.info("%s volume types don't exist on destination." %
-                 (destination_mapped_volume_types -
-                  destination_volume_types))
 
-    if not source_mapped_volume_types.issubset(source_volume_types):
-        LOG.info("%s volume types don't exist on source." %
-                 (source_mapped_volume_types -
-                  source_volume_types))
-    instance_volume_types = set(instance_info['attached_storage'])
+def validate_transfer_options(
+        source_client, destination_client, instance_info, target_env):
+    """
+    Raise error if: unmapped network, inexistent destination network
+    NOTE: prefer `validate_batch_transfer_options` for multiple instances.
 
-    if not instance_volume_types.issubset(source_volume_types):
-        LOG.info("%s volume types are not mapped." %
-                 (instance_volume_types -
-                  source_mapped_volume_types))
+    param source_client: utils.OpenStackClient: client for source
+    param destination_client: utils.OpenStackClient: client for destination
+    param instance_info: dict: output from `find_source_instances_by_name`
+    target_env: dict: with "network_map" and "storage_map"
+    """
+    validate_batch_transfer_options(
+        source_client, destination_client, [instance_info], target_env)
 
 
 def _get_instance_assessment(source_client, instance):
@@ -135,10 +377,10 @@ def _get_instance_assessment(source_client, instance):
     assessment = {}
     assessment['storage'] = {}
     total_size_gb = 0
-    if instance.image:
+    if instance.image_id:
         # Taking in account that the source image might be deleted
         try:
-            image = glance.images.get(instance.image.get('id'))
+            image = glance.images.get(instance.image_id)
             image_size = math.ceil(image.size / units.Gi)
             total_size_gb += image_size
             image_info = {"size_bytes": image.size,
@@ -158,7 +400,7 @@ def _get_instance_assessment(source_client, instance):
                     for volume in volumes]
     assessment["storage"]["volumes"] = volumes_info
 
-    instance_flavor = nova.flavors.get(instance.flavor['id'])
+    instance_flavor = nova.flavors.get(instance.flavor_id)
     total_size_gb += instance_flavor.disk
     flavor_info = {"flavor_name": instance_flavor.name,
                    "flavor_id": instance_flavor.id,
@@ -179,16 +421,13 @@ def _get_instance_assessment(source_client, instance):
 
 
 def get_instances_assessment(source_client, instances_names):
-    nova = source_client.nova
-    instances = []
-    for instance_el in nova.servers.list(search_opts={'all_tenants': True}):
-        if instance_el.name in instances_names:
-            instances.append(instance_el)
-    found_instances = {instance.name for instance in instances}
-
-    if (set(instances_names) - found_instances) != set():
-        raise ValueError("Instances %s have not been found!" %
-                         (set(instances_names) - found_instances))
+    indexed, missing = index_source_instances_by_name(
+        source_client, instances_names)
+    if missing:
+        raise ValueError("Instances %s have not been found!" % set(missing))
+    instances = [
+        instance for name_instances in indexed.values()
+        for instance in name_instances]
 
     assessment_list = []
     for instance in instances:
@@ -235,15 +474,25 @@ def get_migration_assessment(source_client, coriolis, migration_id):
     return assessment_list
 
 
-def list_instances(openstack_client, filters={}):
+def iter_instances(openstack_client, filters=None, page_size=None,
+                   detailed=True):
+    """ Lazily yields the instances of all tenants matching the filters page
+    by page. """
+    filters = dict(filters or {})
     filters['all_tenants'] = True
-    return openstack_client.nova.servers.list(search_opts=filters)
+    return pagination.iter_servers(
+        openstack_client, search_opts=filters, page_size=page_size,
+        detailed=detailed)
+
+
+def list_instances(openstack_client, filters=None):
+    return list(iter_instances(openstack_client, filters=filters))
 
 
 def get_instance_id(openstack_client, tenant_name, instance_name):
     project_id = openstack_client.get_project_id(tenant_name)
     filters = {'tenant_id': project_id, 'project_id': project_id,
-               'name': instance_name}
+               'name': get_exact_name_filter(instance_name)}
     instances = list_instances(openstack_client, filters=filters)
     if not instances:
         raise Exception("Instance named '%s' in tenant named '%s' not "
@@ -2,6 +2,7 @@
 # All Rights Reserved.
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils.resource_utils import pagination
 from coriolis_openstack_utils.resource_utils import subnets
 
 from oslo_log import log as logging
@@ -16,9 +17,98 @@ def get_network(openstack_client, name_or_id):
         'network', name_or_id)
 
 
-def list_networks(openstack_client, tenant_id, filters={}):
-    return openstack_client.neutron.list_networks(
-        tenant_id=tenant_id, project_id=tenant_id, **filters)['networks']
+def iter_networks(openstack_client, tenant_id, filters=None,
+                  page_size=None, fields=None):
+    """ Lazily yields the networks of the tenant page by page. """
+    filters = dict(filters or {})
+    filters.update({'tenant_id': tenant_id, 'project_id': tenant_id})
+    return pagination.iter_neutron_resources(
+        openstack_client, 'networks', filters=filters, page_size=page_size,
+        fields=fields)
+
+
+def list_networks(openstack_client, tenant_id, filters=None, fields=None):
+    return list(iter_networks(
+        openstack_client, tenant_id, filters=filters, fields=fields))
+
+
+def get_networks_by_ids(openstack_client, network_ids, fields=None):
+    """ Returns a dict mapping the given network IDs to their networks,
+    fetched with a single listing. """
+    network_ids = list(set(network_ids))
+    if not network_ids:
+        return {}
+    return {
+        net['id']: net for net in pagination.iter_neutron_resources(
+            openstack_client, 'networks', filters={'id': network_ids},
+            fields=fields)}
+
+
+def get_external_network_ids(openstack_client):
+    """ Returns a dict mapping the names of all the external networks to
+    their IDs (or to None, if the name is ambiguous), fetched with a single
+    listing. """
+    network_ids = {}
+    for net in pagination.iter_neutron_resources(
+            openstack_client, 'networks', filters={'router:external': True},
+            fields=['id', 'name']):
+        if net['name'] in network_ids:
+            network_ids[net['name']] = None
+        else:
+            network_ids[net['name']] = net['id']
+    return network_ids
+
+
+def get_tenant_subnet_index(openstack_client, tenant_id):
+    """ Returns a dict mapping (network_name, subnet_name) tuples to the IDs
+    of the subnets in the given tenant, built from one listing of the
+    tenant's networks and one of its subnets.
+    Names which are not unique within the tenant are mapped to None.
+    """
+    network_names = {
+        net['id']: net['name'] for net in iter_networks(
+            openstack_client, tenant_id, fields=['id', 'name'])}
+
+    index = {}
+    for subnet in subnets.iter_subnets(
+            openstack_client,
+            filters={'tenant_id': tenant_id, 'project_id': tenant_id},
+            fields=['id', 'name', 'network_id']):
+        network_name = network_names.get(subnet['network_id'])
+        if network_name is None:
+            continue
+        key = (network_name, subnet['name'])
+        if key in index:
+            index[key] = None
+        else:
+            index[key] = subnet['id']
+
+    return index
+
+
+def find_subnet_id(openstack_client, network_name, subnet_name):
+    """ Looks up the ID of the subnet with the given name on the networks
+    with the given name regardless of their tenant (ex: shared or admin
+    networks, which are missing from `get_tenant_subnet_index`).
+    Returns None if no such subnet is found, and raises if multiple are.
+    """
+    network_ids = [
+        net['id'] for net in pagination.iter_neutron_resources(
+            openstack_client, 'networks', filters={'name': network_name},
+            fields=['id'])]
+    if not network_ids:
+        return None
+
+    subnet_ids = [
+        subnet['id'] for subnet in subnets.iter_subnets(
+            openstack_client,
+            filters={'network_id': network_ids, 'name': subnet_name},
+            fields=['id'])]
+    if len(subnet_ids) > 1:
+        raise Exception(
+            "Multiple subnets named '%s' in networks named '%s' found: %s" % (
+                subnet_name, network_name, subnet_ids))
+    return subnet_ids[0] if subnet_ids else None
 
 
 def create_network(openstack_client, body):
@@ -76,8 +166,15 @@ def create_network_body(openstack_client, src_network_id, dest_tenant_id,
 
 
 def check_network_similarity(
-        src_network, dest_network, source_client, destination_client):
-
+        src_network, dest_network, source_client, destination_client,
+        src_subnets=None, dest_subnets=None):
+    """ Checks whether the destination network has the same attributes and
+    subnets as the source network.
+    param src_subnets: list: the subnets of the source network, if already
+    loaded (ex: in bulk), else they are fetched one by one.
+    param dest_subnets: list: the subnets of the destination network, if
+    already loaded, else they are fetched one by one.
+    """
     relevant_keys = set([
         'admin_state_up', 'dns_domain', 'mtu',
         'port_security_enabled', 'provider:physical_network'
@@ -109,20 +206,18 @@ def check_network_similarity(
 
     src_relevant_keys = set(src_network.keys()).intersection(relevant_keys)
 
-    src_subnets = [subnets.get_subnet(source_client, subnet_id) for
-                   subnet_id in src_network['subnets']]
-
-    dest_subnets = [subnets.get_subnet(destination_client, subnet_id) for
-                    subnet_id in src_network['subnets']]
+    if src_subnets is None:
+        src_subnets = [subnets.get_subnet(source_client, subnet_id) for
+                       subnet_id in src_network['subnets']]
 
-    similar_subnets = []
-    for src_subnet in src_subnets:
-        for dest_subnet in dest_subnets:
-            if subnets.check_subnet_similarity(src_subnet, dest_subnet):
-                similar_subnets.append(src_subnet)
-                break
+    if dest_subnets is None:
+        dest_subnets = [subnets.get_subnet(destination_client, subnet_id) for
+                        subnet_id in dest_network['subnets']]
 
-    if len(similar_subnets) == len(src_subnets):
+    dest_subnet_fingerprints = set(
+        subnets.get_subnet_fingerprint(subnet) for subnet in dest_subnets)
+    if all(subnets.get_subnet_fingerprint(subnet) in dest_subnet_fingerprints
+           for subnet in src_subnets):
         conflict_keys.add('subnets')
 
     return src_relevant_keys == conflict_keys
@@ -130,7 +225,8 @@ def check_network_similarity(
 
 def delete_network(openstack_client, tenant_id, network_name):
     nets = list_networks(
-        openstack_client, tenant_id, filters={'name': network_name})
+        openstack_client, tenant_id, filters={'name': network_name},
+        fields=['id'])
     nets_len = len(nets)
     if nets_len == 1:
         return openstack_client.neutron.delete_network(nets[0]['id'])
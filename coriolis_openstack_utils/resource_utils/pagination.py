@@ -0,0 +1,64 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" Helpers for lazily listing resources page by page. """
+
+from oslo_log import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 500
+
+
+def get_page_size(openstack_client, page_size=None):
+    """ Returns the given page size, defaulting to the one of the client. """
+    if page_size is None:
+        page_size = getattr(
+            openstack_client, 'page_size', None) or DEFAULT_PAGE_SIZE
+    return page_size
+
+
+def iter_neutron_resources(
+        openstack_client, resource_plural, filters=None, page_size=None,
+        fields=None):
+    """ Yields the Neutron resources of the given type (ex: 'networks')
+    matching the filters, fetching them page by page as they are consumed.
+    NOTE: on deployments without Neutron pagination support, all the
+    resources are returned in a single page.
+    param fields: list: if set, only the given fields of the resources (and
+    their IDs, which are required for pagination) are requested.
+    """
+    filters = dict(filters or {})
+    filters['limit'] = get_page_size(openstack_client, page_size=page_size)
+    if fields:
+        filters['fields'] = sorted(set(fields) | set(['id']))
+    list_method = getattr(
+        openstack_client.neutron, 'list_%s' % resource_plural)
+    for page in list_method(retrieve_all=False, **filters):
+        for resource in page[resource_plural]:
+            yield resource
+
+
+def iter_servers(openstack_client, search_opts=None, page_size=None,
+                 detailed=True):
+    """ Yields the Nova servers matching the search options, fetching them
+    page by page as they are consumed.
+    param detailed: bool: if False, only the IDs and names of the servers
+    are requested (and returned).
+    NOTE: Nova caps the size of the pages to its 'osapi_max_limit', so a
+    page smaller than the requested size is not necessarily the last one;
+    the listing only stops on the first empty page.
+    """
+    page_size = get_page_size(openstack_client, page_size=page_size)
+    marker = None
+    while True:
+        page = openstack_client.nova.servers.list(
+            detailed=detailed, search_opts=search_opts, limit=page_size,
+            marker=marker)
+        if not page:
+            break
+        for server in page:
+            yield server
+
+        marker = page[-1].id
@@ -0,0 +1,304 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+from oslo_log import log as logging
+
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.resource_utils import networks
+from coriolis_openstack_utils.resource_utils import records
+from coriolis_openstack_utils.resource_utils import subnets
+
+CONF = conf.CONF
+LOG = logging.getLogger(__name__)
+
+PORT_RELEVANT_KEYS = [
+    'allowed_address_pairs', 'extra_dhcp_opts',
+    'binding:profile', 'admin_state_up', 'mac_address']
+# NOTE: relevant keys whose values are lists with no meaningful ordering:
+PORT_UNORDERED_KEYS = ['allowed_address_pairs', 'extra_dhcp_opts']
+NEW_PORT_DESCRIPTION_FORMAT = (
+    "Pre-created by the 'coriolis-openstack-utils' for source port with ID"
+    " '%s' for use on a Migrated/Replicated VM.")
+
+# NOTE: bounds the length of the query strings for filters on lists of
+# values, as well as the size of the bulk creation requests:
+LIST_FILTER_CHUNK_SIZE = 50
+BULK_CREATION_CHUNK_SIZE = 50
+
+# NOTE: the only destination network fields required for port recreation:
+DESTINATION_NETWORK_FIELDS = ['id', 'name', 'project_id', 'tenant_id']
+
+
+def _chunks(items, chunk_size):
+    items = list(items)
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def get_port(openstack_client, port_id):
+    return openstack_client.neutron.find_resource_by_id('port', port_id)
+
+
+def list_ports(openstack_client, filters={}):
+    return openstack_client.neutron.list_ports(**filters)['ports']
+
+
+def list_ports_by_mac(openstack_client, network_id, mac_address):
+    """ Lists the ports with the given MAC address on the given network
+    using server-side filtering. """
+    return list_ports(
+        openstack_client,
+        filters={'network_id': network_id, 'mac_address': mac_address})
+
+
+def list_ports_by_values(openstack_client, key, values):
+    """ Lists all the ports whose `key` is any of the given values, using as
+    few requests as the length of the resulting query strings allows. """
+    result = []
+    for chunk in _chunks(set(values), LIST_FILTER_CHUNK_SIZE):
+        result.extend(list_ports(openstack_client, filters={key: chunk}))
+    return result
+
+
+def create_ports(openstack_client, bodies, on_created=None):
+    """ Creates the given ports using Neutron bulk creation requests and
+    returns the resulting ports in the same order as the bodies.
+    param on_created: callable: if set, gets called with the list of the
+    ports created by each bulk request as soon as it succeeds, so that the
+    ports of the previous requests are not lost if a later one fails.
+    """
+    created = []
+    for chunk in _chunks(bodies, BULK_CREATION_CHUNK_SIZE):
+        chunk_ports = openstack_client.neutron.create_port(
+            body={'ports': chunk})['ports']
+        created.extend(chunk_ports)
+        if on_created:
+            on_created(chunk_ports)
+    return created
+
+
+def get_port_fingerprint(port):
+    """ Returns the fingerprint of the port's relevant attributes and IP
+    addresses, regardless of the subnets the addresses are on. """
+    port_info = utils.project(port, PORT_RELEVANT_KEYS)
+    port_info['ip_addresses'] = set(
+        el['ip_address'] for el in port['fixed_ips'])
+    return utils.fingerprint(
+        port_info, unordered_keys=PORT_UNORDERED_KEYS)
+
+
+def check_port_similarity(src_port, dest_port):
+    return get_port_fingerprint(src_port) == get_port_fingerprint(dest_port)
+
+
+def get_destination_port_body(src_port, dest_network, subnet_lookup):
+    """ Returns the body for recreating the source port on the destination
+    network, with each source IP address assigned to the subnet of the
+    destination network which contains it.
+    param subnet_lookup: subnets.SubnetLookup: for the destination network
+    """
+    body = {k: v for k, v in
+            src_port.items() if k in PORT_RELEVANT_KEYS}
+    body['network_id'] = dest_network['id']
+    src_ip_addresses = [el['ip_address'] for el in src_port['fixed_ips']]
+    src_mac_address = src_port['mac_address']
+    if src_ip_addresses:
+        fixed_ips = []
+
+        # iterate through all the IP addresses desired for this interface
+        # and find a suitable subnet for each:
+        for ip_address in src_ip_addresses:
+            try:
+                target_subnet = subnet_lookup.find_subnet_id(ip_address)
+            except ValueError:
+                LOG.warning(
+                    "Improper IP address '%s', ignoring.", ip_address)
+                continue
+
+            if not target_subnet:
+                LOG.warning(
+                    "Could not find suitable subnet for IP address '%s'"
+                    "for NIC with MAC address '%s', ignoring.",
+                    ip_address, src_mac_address)
+                continue
+
+            fixed_ips.append(
+                {"ip_address": ip_address, "subnet_id": target_subnet})
+            body['fixed_ips'] = fixed_ips
+
+        body['project_id'] = (
+            dest_network['project_id'] or dest_network['tenant_id'])
+        body['tenant_id'] = (
+            dest_network['project_id'] or dest_network['tenant_id'])
+        body['description'] = NEW_PORT_DESCRIPTION_FORMAT % src_port['id']
+
+    return body
+
+
+def _get_destination_networks(destination_client, dest_tenant_id,
+                              network_names_or_ids):
+    """ Returns a dict mapping the given network names or IDs to the
+    respective networks of the destination tenant. """
+    network_names_or_ids = set(network_names_or_ids)
+    found = {}
+    for net in networks.iter_networks(
+            destination_client, dest_tenant_id,
+            filters={'name': list(network_names_or_ids)},
+            fields=DESTINATION_NETWORK_FIELDS):
+        if net['name'] in found:
+            raise Exception(
+                "Multiple destination networks named '%s' found in tenant "
+                "'%s'." % (net['name'], dest_tenant_id))
+        found[net['name']] = net
+
+    for name_or_id in network_names_or_ids - set(found):
+        # NOTE: the mapped network may have been referenced by ID:
+        found[name_or_id] = destination_client.neutron.find_resource(
+            'network', name_or_id, project_id=dest_tenant_id,
+            fields=DESTINATION_NETWORK_FIELDS)
+
+    return found
+
+
+def get_destination_tenant_ids(destination_client, src_tenant_names):
+    """ Returns a dict mapping the given source tenant names to the IDs of
+    their destination tenants, only looking up the ones without recorded
+    (and still valid) ID mappings (using a single project listing). """
+    def _resolve(unmapped_names):
+        dest_names = {
+            CONF.destination.new_tenant_name_format % {'original': name}: name
+            for name in unmapped_names}
+        return {
+            dest_names[dest_name]: tenant_id for dest_name, tenant_id in
+            destination_client.get_project_ids(dest_names.keys()).items()}
+
+    return conf.get_id_mapping_store().get_destination_ids_by_names(
+        rollback.RESOURCE_TYPE_TENANT, src_tenant_names, _resolve,
+        validator=destination_client.get_project_names)
+
+
+def replicate_instance_ports(
+        source_client, destination_client, instance_infos, network_map,
+        on_created=None):
+    """ Recreates the Neutron ports of all the given source instances on the
+    destination, resolving all the source ports and destination networks in
+    bulk and creating the missing ports using bulk requests.
+
+    param instance_infos: list: of dicts containing the 'instance_id' and
+    'instance_tenant_name' of each source instance.
+    param network_map: dict: mapping between source network names or IDs and
+    destination network names or IDs.
+    param on_created: callable: if set, gets called with the list of the
+    ports newly created by each bulk request as soon as it succeeds.
+    returns: tuple of a dict mapping each instance ID to the list of its
+    destination ports and the list of ports newly created.
+    """
+    tenant_names = {
+        info['instance_id']: info['instance_tenant_name']
+        for info in instance_infos}
+    src_ports = [
+        records.port_record(port) for port in list_ports_by_values(
+            source_client, 'device_id', tenant_names.keys())]
+    if not src_ports:
+        return {instance_id: [] for instance_id in tenant_names}, []
+
+    src_networks = networks.get_networks_by_ids(
+        source_client, [port['network_id'] for port in src_ports],
+        fields=['name'])
+
+    dest_tenant_ids = get_destination_tenant_ids(
+        destination_client, tenant_names.values())
+
+    # determine the destination network of each source port:
+    ports_dest_network_refs = {}
+    tenants_network_refs = {}
+    for port in src_ports:
+        src_network_id = port['network_id']
+        dest_network_ref = (
+            network_map.get(src_network_id) or
+            network_map.get(src_networks[src_network_id]['name']))
+        if not dest_network_ref:
+            raise Exception(
+                "Network '%s' of source port '%s' is not mapped." % (
+                    src_network_id, port['id']))
+        dest_tenant_id = dest_tenant_ids[tenant_names[port['device_id']]]
+        ports_dest_network_refs[port['id']] = (
+            dest_tenant_id, dest_network_ref)
+        tenants_network_refs.setdefault(dest_tenant_id, set()).add(
+            dest_network_ref)
+
+    dest_networks = {}
+    for dest_tenant_id, network_refs in tenants_network_refs.items():
+        for ref, net in _get_destination_networks(
+                destination_client, dest_tenant_id, network_refs).items():
+            dest_networks[(dest_tenant_id, ref)] = net
+
+    # find any already-existing destination ports:
+    existing_ports = {}
+    for dest_port in list_ports_by_values(
+            destination_client, 'mac_address',
+            [port['mac_address'] for port in src_ports]):
+        existing_ports.setdefault(
+            (dest_port['network_id'], dest_port['mac_address']), []).append(
+                records.port_record(dest_port))
+
+    dest_subnets = {}
+    dest_network_ids = set(net['id'] for net in dest_networks.values())
+    for subnet in subnets.iter_subnets(
+            destination_client,
+            filters={'network_id': list(dest_network_ids)},
+            fields=subnets.SUBNET_LOOKUP_FIELDS):
+        dest_subnets.setdefault(subnet['network_id'], []).append(subnet)
+    subnet_lookups = {
+        network_id: subnets.SubnetLookup(dest_subnets.get(network_id, []))
+        for network_id in dest_network_ids}
+
+    id_mappings = conf.get_id_mapping_store()
+    instance_ports = {instance_id: [] for instance_id in tenant_names}
+    bodies = []
+    bodies_port_ids = []
+    bodies_instance_ids = []
+    for port in src_ports:
+        dest_network = dest_networks[ports_dest_network_refs[port['id']]]
+        port_fingerprint = get_port_fingerprint(port)
+        existing = [
+            dest_port for dest_port in existing_ports.get(
+                (dest_network['id'], port['mac_address']), [])
+            if get_port_fingerprint(dest_port) == port_fingerprint]
+        if existing:
+            LOG.info("Found destination port '%s' with same "
+                     "information as source port '%s'.",
+                     existing[0]['id'], port['id'])
+            instance_ports[port['device_id']].append(existing[0])
+            id_mappings.record(
+                rollback.RESOURCE_TYPE_PORT, port['id'], existing[0]['id'])
+            continue
+
+        bodies.append(get_destination_port_body(
+            port, dest_network, subnet_lookups[dest_network['id']]))
+        bodies_port_ids.append(port['id'])
+        bodies_instance_ids.append(port['device_id'])
+
+    created = []
+    if bodies:
+        LOG.info("Creating %d destination ports: %s", len(bodies), bodies)
+
+        def _on_created(chunk_ports):
+            chunk_ports = [records.port_record(port) for port in chunk_ports]
+            # NOTE: the ports are created in the same order as the bodies:
+            for dest_port in chunk_ports:
+                body_index = len(created)
+                created.append(dest_port)
+                instance_ports[bodies_instance_ids[body_index]].append(
+                    dest_port)
+                id_mappings.record(
+                    rollback.RESOURCE_TYPE_PORT, bodies_port_ids[body_index],
+                    dest_port['id'])
+            if on_created:
+                on_created(chunk_ports)
+
+        create_ports(destination_client, bodies, on_created=_on_created)
+
+    return instance_ports, created
@@ -0,0 +1,99 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+from oslo_log import log as logging
+
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import utils
+
+CONF = conf.CONF
+LOG = logging.getLogger(__name__)
+
+QUOTA_SERVICE_NEUTRON = "neutron"
+QUOTA_SERVICE_CINDER = "cinder"
+QUOTA_SERVICE_NOVA = "nova"
+
+
+def get_new_tenant_quotas():
+    """ Returns a dict mapping each service to the quotas which should be set
+    on newly-migrated tenants. """
+    return {
+        QUOTA_SERVICE_NEUTRON: {
+            k: int(v) for k, v in
+            CONF.destination.new_tenant_neutron_quotas.items()},
+        QUOTA_SERVICE_CINDER: {
+            k: int(v) for k, v in
+            CONF.destination.new_tenant_cinder_quotas.items()},
+        QUOTA_SERVICE_NOVA: {
+            k: int(v) for k, v in
+            CONF.destination.new_tenant_nova_quotas.items()}}
+
+
+def get_quotas(openstack_client, service, tenant_id):
+    if service == QUOTA_SERVICE_NEUTRON:
+        return openstack_client.neutron.show_quota(tenant_id)["quota"]
+    elif service == QUOTA_SERVICE_CINDER:
+        return openstack_client.cinder.quotas.get(tenant_id).to_dict()
+    elif service == QUOTA_SERVICE_NOVA:
+        return openstack_client.nova.quotas.get(tenant_id).to_dict()
+    raise ValueError("Unknown quota service '%s'" % service)
+
+
+def update_quotas(openstack_client, service, tenant_id, quotas):
+    if service == QUOTA_SERVICE_NEUTRON:
+        openstack_client.neutron.update_quota(
+            tenant_id, body={"quota": quotas})
+    elif service == QUOTA_SERVICE_CINDER:
+        openstack_client.cinder.quotas.update(tenant_id, **quotas)
+    elif service == QUOTA_SERVICE_NOVA:
+        openstack_client.nova.quotas.update(tenant_id, **quotas)
+    else:
+        raise ValueError("Unknown quota service '%s'" % service)
+
+
+def apply_service_quotas(openstack_client, service, tenant_id, quotas):
+    """ Updates the quotas of the tenant for the given service, unless they
+    are already set to the given values.
+    Returns True if an update was performed. """
+    if not quotas:
+        return False
+
+    try:
+        current = get_quotas(openstack_client, service, tenant_id)
+    except Exception as ex:
+        LOG.debug(
+            "Could not fetch %s quotas for tenant '%s', updating them "
+            "regardless: %s", service, tenant_id, ex)
+        current = {}
+
+    if all(current.get(k) == v for k, v in quotas.items()):
+        LOG.info(
+            "%s quotas for tenant '%s' already set to %s, skipping.",
+            service.capitalize(), tenant_id, quotas)
+        return False
+
+    LOG.info(
+        "Adding %s quotas for tenant '%s': %s",
+        service.capitalize(), tenant_id, quotas)
+    update_quotas(openstack_client, service, tenant_id, quotas)
+    return True
+
+
+def apply_tenants_quotas(openstack_client, tenant_ids, quotas=None,
+                         max_workers=None):
+    """ Applies the quotas for all services to all the given tenants in one
+    parallel pass.
+    param quotas: dict: quotas for each service, as returned by
+    `get_new_tenant_quotas` (which is the default).
+    """
+    if quotas is None:
+        quotas = get_new_tenant_quotas()
+    if max_workers is None:
+        max_workers = CONF.destination.max_concurrent_requests
+
+    utils.run_concurrently(
+        apply_service_quotas,
+        [(openstack_client, service, tenant_id, service_quotas)
+         for tenant_id in tenant_ids
+         for service, service_quotas in quotas.items()],
+        max_workers=max_workers)
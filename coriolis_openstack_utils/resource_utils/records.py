@@ -0,0 +1,214 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" Compact immutable records holding only the attributes of the cloud
+resources which the tooling makes use of, so that discovered resources can
+be held in bulk without keeping the clients' resource objects (with their
+manager back-references and raw payloads) or the full API dicts alive.
+Nova servers, which are read through their attributes, are recorded as
+named tuples. All other resources are recorded as slotted read-only
+mappings over their API keys, so they may be passed wherever the API dicts
+were being read. All records are built with the `*_record` functions.
+"""
+
+import collections
+import collections.abc
+import re
+
+
+def _get_slot_name(key):
+    return re.sub(r'\W', '_', key)
+
+
+class Record(collections.abc.Mapping):
+    """ Read-only mapping holding the values of the `KEYS` of an API
+    resource in slots. The keys missing from the resource are missing from
+    its record as well. The values may also be read as attributes named
+    after their keys, with non-alphanumerics replaced by underscores.
+    """
+    __slots__ = ()
+    KEYS = ()
+    _SLOTS = {}
+
+    def __init__(self, resource):
+        """ param resource: dict: the API resource """
+        for key, slot in self._SLOTS.items():
+            if key in resource:
+                object.__setattr__(self, slot, resource[key])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            "Cannot set '%s' on read-only %s." % (
+                name, type(self).__name__))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self._SLOTS[key])
+        except (KeyError, TypeError, AttributeError):
+            raise KeyError(key)
+
+    def __iter__(self):
+        for key, slot in self._SLOTS.items():
+            if hasattr(self, slot):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.to_dict())
+
+    def __reduce__(self):
+        return (type(self), (self.to_dict(),))
+
+    def to_dict(self):
+        return dict(self)
+
+
+def _record_type(name, keys):
+    slots = tuple(_get_slot_name(key) for key in keys)
+    return type(name, (Record,), {
+        "__module__": __name__,
+        "__slots__": slots,
+        "KEYS": tuple(keys),
+        "_SLOTS": collections.OrderedDict(zip(keys, slots))})
+
+
+InstanceRecord = collections.namedtuple("InstanceRecord", [
+    "id", "name", "tenant_id", "status", "flavor_id", "image_id",
+    # dict mapping network names to tuples of IP addresses:
+    "networks",
+    # tuple of security group names:
+    "security_groups"])
+
+NetworkRecord = _record_type("NetworkRecord", [
+    "id", "name", "tenant_id", "project_id", "status", "tags", "subnets",
+    "admin_state_up", "dns_domain", "mtu", "port_security_enabled",
+    "provider:physical_network", "provider:network_type", "router:external",
+    "shared", "vlan_transparent", "is_default", "availability_zones"])
+
+SubnetRecord = _record_type("SubnetRecord", [
+    "id", "name", "tenant_id", "project_id", "network_id", "tags",
+    "enable_dhcp", "dns_nameservers", "allocation_pools", "host_routes",
+    "ip_version", "gateway_ip", "cidr", "prefixlen", "ipv6_address_mode",
+    "ipv6_ra_mode", "service_types"])
+
+PortRecord = _record_type("PortRecord", [
+    "id", "name", "tenant_id", "project_id", "network_id", "device_id",
+    "device_owner", "status", "tags", "mac_address", "fixed_ips",
+    "admin_state_up", "allowed_address_pairs", "extra_dhcp_opts",
+    "binding:profile", "security_groups"])
+
+RouterRecord = _record_type("RouterRecord", [
+    "id", "name", "tenant_id", "project_id", "status", "tags",
+    "admin_state_up", "external_gateway_info", "distributed", "ha",
+    "availability_zone_hints", "availability_zones", "routes"])
+
+SecurityGroupRecord = _record_type("SecurityGroupRecord", [
+    "id", "name", "tenant_id", "project_id", "description", "tags",
+    # tuple of SecurityGroupRuleRecords:
+    "security_group_rules"])
+
+SecurityGroupRuleRecord = _record_type("SecurityGroupRuleRecord", [
+    "id", "security_group_id", "direction", "ethertype", "protocol",
+    "port_range_min", "port_range_max", "remote_ip_prefix",
+    "remote_group_id", "description"])
+
+FlavorRecord = _record_type("FlavorRecord", [
+    "id", "name", "ram", "disk", "vcpus", "swap", "rxtx_factor",
+    "OS-FLV-EXT-DATA:ephemeral", "OS-FLV-DISABLED:disabled",
+    "os-flavor-access:is_public"])
+
+ProjectRecord = _record_type("ProjectRecord", [
+    "id", "name", "description", "domain_id", "enabled"])
+
+
+def _to_dict(resource):
+    if hasattr(resource, 'to_dict'):
+        return resource.to_dict()
+    return resource
+
+
+def instance_record(server):
+    """ param server: novaclient Server or InstanceRecord """
+    if isinstance(server, InstanceRecord):
+        return server
+
+    image = getattr(server, 'image', None)
+    flavor = getattr(server, 'flavor', None) or {}
+    return InstanceRecord(
+        id=server.id,
+        name=server.name,
+        tenant_id=getattr(server, 'tenant_id', None),
+        status=getattr(server, 'status', None),
+        flavor_id=flavor.get('id'),
+        # NOTE: instances booted from volume have an empty string as image:
+        image_id=image.get('id') if image else None,
+        networks={
+            net_name: tuple(addresses) for net_name, addresses in
+            (getattr(server, 'networks', None) or {}).items()},
+        security_groups=tuple(
+            secgroup['name'] for secgroup in
+            getattr(server, 'security_groups', None) or []))
+
+
+def network_record(network):
+    """ param network: dict: Neutron network """
+    if isinstance(network, NetworkRecord):
+        return network
+    return NetworkRecord(network)
+
+
+def subnet_record(subnet):
+    """ param subnet: dict: Neutron subnet """
+    if isinstance(subnet, SubnetRecord):
+        return subnet
+    return SubnetRecord(subnet)
+
+
+def port_record(port):
+    """ param port: dict: Neutron port """
+    if isinstance(port, PortRecord):
+        return port
+    return PortRecord(port)
+
+
+def router_record(router):
+    """ param router: dict: Neutron router """
+    if isinstance(router, RouterRecord):
+        return router
+    return RouterRecord(router)
+
+
+def security_group_rule_record(rule):
+    """ param rule: dict: Neutron security group rule """
+    if isinstance(rule, SecurityGroupRuleRecord):
+        return rule
+    return SecurityGroupRuleRecord(rule)
+
+
+def security_group_record(secgroup):
+    """ param secgroup: dict: Neutron security group """
+    if isinstance(secgroup, SecurityGroupRecord):
+        return secgroup
+    if 'security_group_rules' in secgroup:
+        secgroup = dict(secgroup)
+        secgroup['security_group_rules'] = tuple(
+            security_group_rule_record(rule)
+            for rule in secgroup['security_group_rules'])
+    return SecurityGroupRecord(secgroup)
+
+
+def flavor_record(flavor):
+    """ param flavor: novaclient Flavor, dict or FlavorRecord """
+    if isinstance(flavor, FlavorRecord):
+        return flavor
+    return FlavorRecord(_to_dict(flavor))
+
+
+def project_record(project):
+    """ param project: keystoneclient Project/Tenant, dict or
+    ProjectRecord """
+    if isinstance(project, ProjectRecord):
+        return project
+    return ProjectRecord(_to_dict(project))
@@ -1,8 +1,11 @@
 from oslo_log import log as logging
 
 from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import rollback
 from coriolis_openstack_utils.resource_utils import subnets
 from coriolis_openstack_utils.resource_utils import networks
+from coriolis_openstack_utils.resource_utils import pagination
+from coriolis_openstack_utils.resource_utils import records
 
 CONF = conf.CONF
 LOG = logging.getLogger(__name__)
@@ -12,12 +15,31 @@ def get_router(openstack_client, name_or_id):
     return openstack_client.neutron.find_resource('router', name_or_id)
 
 
-def list_routers(openstack_client, filters):
-    return openstack_client.neutron.list_routers(**filters)['routers']
+def iter_routers(openstack_client, filters=None, page_size=None,
+                 fields=None):
+    """ Lazily yields the routers matching the filters page by page. """
+    return pagination.iter_neutron_resources(
+        openstack_client, 'routers', filters=filters, page_size=page_size,
+        fields=fields)
+
+
+def list_routers(openstack_client, filters=None, fields=None):
+    return list(iter_routers(openstack_client, filters=filters, fields=fields))
 
 
 def check_router_similarity(source_client, src_router, destination_client,
-                            dest_router):
+                            dest_router, network_names=None):
+    """ Checks whether the destination router has the same attributes and
+    (mapped) external gateway network as the source router.
+    param network_names: dict: mapping the IDs of the source and destination
+    external networks to their names, if already loaded (ex: in bulk), else
+    the networks are fetched one by one.
+    """
+    def _get_network_name(client, network_id):
+        if network_names and network_id in network_names:
+            return network_names[network_id]
+        return networks.get_network(client, network_id)['name']
+
     relevant_keys = {'admin_state_up', 'external_gateway_info',
                      'distributed', 'ha'}
     conflicting_keys = set()
@@ -34,10 +56,10 @@ def check_router_similarity(source_client, src_router, destination_client,
                 dest_network_id = dest_router.get(
                     k, {}).get('network_id', True)
                 if src_snat == dest_snat:
-                    src_net_name = networks.get_network(
-                        source_client, src_network_id)['name']
-                    dest_net_name = networks.get_network(
-                        destination_client, dest_network_id)['name']
+                    src_net_name = _get_network_name(
+                        source_client, src_network_id)
+                    dest_net_name = _get_network_name(
+                        destination_client, dest_network_id)
                     if (router_network_mapping.get(
                             src_net_name, src_net_name) == dest_net_name):
                         conflicting_keys.add(k)
@@ -49,26 +71,21 @@ def check_router_similarity(source_client, src_router, destination_client,
 
 
 def get_migration_info(source_client, name_or_id):
-    router = get_router(source_client, name_or_id)
+    router = records.router_record(get_router(source_client, name_or_id))
     relevant_keys = {'admin_state_up', 'distributed', 'ha',
                      'availability_zone_hints'}
 
     body = {k: v for k, v in router.items() if k in relevant_keys}
-    body['availability_zone_hints'] += router['availability_zones']
     # eliminate any possible duplicates
     body['availability_zone_hints'] = list(
-        set(body['availability_zone_hints']))
+        set(router.get('availability_zone_hints') or []) |
+        set(router.get('availability_zones') or []))
     ext_gateway_info = router['external_gateway_info']
 
     src_ext_subnet_ids = set()
-    ext_network_names = []
     if ext_gateway_info:
         for fixed_ip in ext_gateway_info['external_fixed_ips']:
             src_ext_subnet_ids.add(fixed_ip['subnet_id'])
-        ext_networks_ids = [subnets.get_subnet(source_client, subnet_id)[
-            'network_id'] for subnet_id in src_ext_subnet_ids]
-        ext_network_names = [networks.get_network(source_client, network_id)[
-            'name'] for network_id in ext_networks_ids]
 
     # mapped with new_subnet_name_format and new_network_name_format
     src_subnet_ids = set()
@@ -79,15 +96,29 @@ def get_migration_info(source_client, name_or_id):
 
     src_subnet_ids = src_subnet_ids - src_ext_subnet_ids
 
-    src_subnets = [subnets.get_subnet(source_client, subnet_id)
-                   for subnet_id in src_subnet_ids]
+    # NOTE: all the subnets and networks are fetched in bulk instead of
+    # being looked up one by one:
+    src_subnets_map = {
+        subnet_id: records.subnet_record(subnet)
+        for subnet_id, subnet in subnets.get_subnets_by_ids(
+            source_client, src_subnet_ids | src_ext_subnet_ids).items()}
+    src_networks_map = networks.get_networks_by_ids(
+        source_client,
+        [subnet['network_id'] for subnet in src_subnets_map.values()],
+        fields=['id', 'name'])
+
+    ext_network_names = [
+        src_networks_map[network_id]['name'] for network_id in set(
+            src_subnets_map[subnet_id]['network_id']
+            for subnet_id in src_ext_subnet_ids)]
 
     # adding both network name and subnet name the chance of a collision on
     # destination is greatly reduced
-    src_subnets = [{'subnet_name': subnet['name'],
-                    'network_name': networks.get_network(
-                        source_client, subnet['network_id'])['name']}
-                   for subnet in src_subnets]
+    src_subnets = [{'subnet_id': subnet_id,
+                    'subnet_name': src_subnets_map[subnet_id]['name'],
+                    'network_name': src_networks_map[
+                        src_subnets_map[subnet_id]['network_id']]['name']}
+                   for subnet_id in src_subnet_ids]
 
     return {'source_name': router['name'],
             'migration_body': body,
@@ -95,7 +126,18 @@ def get_migration_info(source_client, name_or_id):
             'src_subnets': src_subnets}
 
 
-def create_router(destination_client, migr_info):
+def create_router(destination_client, migr_info, subnet_index=None,
+                  external_network_ids=None):
+    """ Creates the router described by the output of `get_migration_info`
+    and attaches it to the destination subnets.
+    param subnet_index: dict: output of `networks.get_tenant_subnet_index`
+    for the destination tenant. Built from the router body's tenant if not
+    provided and any of the source subnets has no recorded ID mapping. The
+    subnets missing from it (ex: on shared networks) are looked up by name.
+    param external_network_ids: dict: output of
+    `networks.get_external_network_ids` for the destination. The gateway
+    networks missing from it are looked up one by one.
+    """
     body = migr_info['migration_body']
     src_router_name = migr_info['source_name']
     new_format = CONF.destination.new_router_name_format
@@ -112,9 +154,11 @@ def create_router(destination_client, migr_info):
         dest_ext_net_names = [external_network_map.get(net_name, net_name)
                               for net_name in src_ext_net_names]
 
-        dest_ext_net_ids = [networks.get_network(
-            destination_client, net_name)['id'] for net_name in
-            dest_ext_net_names]
+        external_network_ids = external_network_ids or {}
+        dest_ext_net_ids = [
+            external_network_ids.get(net_name) or networks.get_network(
+                destination_client, net_name)['id']
+            for net_name in dest_ext_net_names]
         for net_id in dest_ext_net_ids:
             LOG.info(
                 "Adding external network %s gateway to router %s"
@@ -125,19 +169,48 @@ def create_router(destination_client, migr_info):
     new_net_name_format = CONF.destination.new_network_name_format
     new_subnet_name_format = CONF.destination.new_subnet_name_format
 
-    # TODO more efficient way to determine destination subnets?
+    # NOTE: migration infos from older plans lack the source subnet IDs, and
+    # the mapped destination subnets are all checked with a single listing:
+    mapped_subnet_ids = conf.get_id_mapping_store().get_destination_ids(
+        rollback.RESOURCE_TYPE_SUBNET,
+        [subnet['subnet_id'] for subnet in src_subnets
+         if subnet.get('subnet_id')],
+        validator=lambda subnet_ids: {
+            subnet_id: subnet['name'] for subnet_id, subnet in
+            subnets.get_subnets_by_ids(
+                destination_client, subnet_ids).items()})
+
+    if subnet_index is None and len(mapped_subnet_ids) < len(src_subnets):
+        dest_tenant_id = body.get('tenant_id') or body.get('project_id')
+        subnet_index = networks.get_tenant_subnet_index(
+            destination_client, dest_tenant_id)
+
     for subnet in src_subnets:
         dest_net_name = new_net_name_format % {
             "original": subnet['network_name']}
-        dest_net_id = networks.get_network(
-            destination_client, dest_net_name)['id']
-
         dest_subnet_name = new_subnet_name_format % {
             "original": subnet['subnet_name']}
 
-        dest_subnet_id = subnets.list_subnets(
-            destination_client, filters={'network_id': dest_net_id,
-                                         'name': dest_subnet_name})[0]['id']
+        key = (dest_net_name, dest_subnet_name)
+        dest_subnet_id = mapped_subnet_ids.get(subnet.get('subnet_id'))
+        if not dest_subnet_id and key in subnet_index:
+            dest_subnet_id = subnet_index[key]
+            if dest_subnet_id is None:
+                raise Exception(
+                    "Multiple destination subnets named '%s' in networks "
+                    "named '%s' found. Cannot attach to router '%s'." % (
+                        dest_subnet_name, dest_net_name, body['name']))
+        elif not dest_subnet_id:
+            # NOTE: the index only covers the networks of the router's
+            # tenant, so shared or admin networks are looked up globally:
+            dest_subnet_id = networks.find_subnet_id(
+                destination_client, dest_net_name, dest_subnet_name)
+            if not dest_subnet_id:
+                raise Exception(
+                    "Could not find destination subnet '%s' in network '%s' "
+                    "to attach to router '%s'." % (
+                        dest_subnet_name, dest_net_name, body['name']))
+
         LOG.info("Adding interface for subnet '%s' to router '%s' "
                  % (dest_subnet_name, body['name']))
         destination_client.neutron.add_interface_router(
@@ -148,7 +221,7 @@ def create_router(destination_client, migr_info):
 
 def delete_router(openstack_client, name):
     routers = list_routers(
-        openstack_client, filters={'name': name})
+        openstack_client, filters={'name': name}, fields=['id'])
     routers_length = len(routers)
     if routers_length == 1:
         openstack_client.neutron.delete_router(routers[0]['id'])
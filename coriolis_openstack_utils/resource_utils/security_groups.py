@@ -3,17 +3,33 @@
 
 from oslo_log import log as logging
 
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.resource_utils import pagination
 
 LOG = logging.getLogger(__name__)
 
+RULE_RELEVANT_KEYS = [
+    'direction', 'ethertype', 'port_range_min', 'port_range_max', 'protocol',
+    'remote_ip_prefix']
 
-def list_security_groups(openstack_client, tenant_id, filters=None):
-    if not filters:
-        return openstack_client.neutron.list_security_groups(
-            tenant_id=tenant_id, project_id=tenant_id)['security_groups']
-    return openstack_client.neutron.list_security_groups(
-        tenant_id=tenant_id, project_id=tenant_id,
-        **filters)['security_groups']
+
+def iter_security_groups(openstack_client, tenant_id, filters=None,
+                         page_size=None, fields=None):
+    """ Lazily yields the security groups of the tenant page by page.
+    NOTE: listing only the required `fields` avoids fetching all the rules
+    embedded in the security groups.
+    """
+    filters = dict(filters or {})
+    filters.update({'tenant_id': tenant_id, 'project_id': tenant_id})
+    return pagination.iter_neutron_resources(
+        openstack_client, 'security_groups', filters=filters,
+        page_size=page_size, fields=fields)
+
+
+def list_security_groups(openstack_client, tenant_id, filters=None,
+                         fields=None):
+    return list(iter_security_groups(
+        openstack_client, tenant_id, filters=filters, fields=fields))
 
 
 def get_security_group(openstack_client, tenant_id, name):
@@ -60,18 +76,19 @@ def add_rules_to_secgroup(secgroup_name, rules, openstack_client):
         openstack_client.neutron.create_security_group_rule(rule_body)
 
 
+def get_rule_fingerprint(rule):
+    """ Returns the fingerprint of the rule's attributes which are relevant
+    when comparing rules across clouds.
+    NOTE: rules lacking any of the relevant keys (such as the rule bodies
+    built by `get_destination_secgroup_rules_params`) have them set to None,
+    just like Neutron does.
+    """
+    return utils.fingerprint(rule, keys=RULE_RELEVANT_KEYS)
+
+
 def check_rule_similarity(source_rule, destination_rule):
-    conflict_keys = set()
-    relevant_keys = set(['direction', 'ethertype', 'port_range_min',
-                         'port_range_max', 'protocol', 'remote_ip_prefix'])
-    for k in source_rule:
-        if k in relevant_keys:
-            if source_rule[k] == destination_rule.get(k):
-                conflict_keys.add(k)
-    relevant_source_keys = set(
-        source_rule.keys()).intersection(relevant_keys)
-
-    return len(relevant_source_keys) == len(conflict_keys)
+    return get_rule_fingerprint(source_rule) == get_rule_fingerprint(
+        destination_rule)
 
 
 def delete_secgroup(openstack_client, tenant_id, name):
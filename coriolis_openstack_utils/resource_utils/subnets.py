@@ -1,18 +1,110 @@
 # Copyright 2018 Cloudbase Solutions Srl
 # All Rights Reserved.
 
+import bisect
+import ipaddress
+
 from oslo_log import log as logging
 
+from coriolis_openstack_utils import utils
+from coriolis_openstack_utils.resource_utils import pagination
+
 LOG = logging.getLogger(__name__)
 
+# NOTE: the only subnet fields required for building `SubnetLookup`s:
+SUBNET_LOOKUP_FIELDS = ['id', 'cidr', 'network_id']
+
+SUBNET_RELEVANT_KEYS = [
+    'enable_dhcp', 'dns_nameservers', 'allocation_pools', 'host_routes',
+    'ip_version', 'gateway_ip', 'cidr', 'prefixlen', 'ipv6_address_mode',
+    'ipv6_ra_mode', 'service_types']
+# NOTE: relevant keys whose values are lists with no meaningful ordering:
+SUBNET_UNORDERED_KEYS = ['service_types']
+
+
+class SubnetLookup(object):
+    """ Lookup structure matching IP addresses to the subnets containing them
+    in logarithmic time, holding the CIDRs of the subnets as sorted integer
+    intervals for each IP version.
+    NOTE: the subnets are assumed not to overlap, as is the case for the
+    subnets of a single Neutron network.
+    """
+
+    def __init__(self, subnets):
+        intervals = {4: [], 6: []}
+        for subnet in subnets:
+            cidr = ipaddress.ip_network(subnet['cidr'])
+            intervals[cidr.version].append((
+                int(cidr.network_address), int(cidr.broadcast_address),
+                subnet['id']))
+
+        self._starts = {}
+        self._intervals = {}
+        for version, version_intervals in intervals.items():
+            version_intervals.sort()
+            self._intervals[version] = version_intervals
+            self._starts[version] = [
+                interval[0] for interval in version_intervals]
+
+    def find_subnet_id(self, ip_address):
+        """ Returns the ID of the subnet containing the given IP address or
+        None if there is no such subnet.
+        Raises ValueError for improper IP addresses.
+        """
+        addr = ipaddress.ip_address(ip_address)
+        addr_int = int(addr)
+        starts = self._starts[addr.version]
+        i = bisect.bisect_right(starts, addr_int) - 1
+        if i < 0:
+            return None
+
+        _, end, subnet_id = self._intervals[addr.version][i]
+        if addr_int <= end:
+            return subnet_id
+        return None
+
+
+def get_subnet_lookup(openstack_client, network_id, cache=None):
+    """ Returns the `SubnetLookup` for all the subnets of the given network.
+    param cache: dict: if provided, lookups are cached in it by network ID so
+    they can be shared between calls.
+    """
+    if cache is not None and network_id in cache:
+        return cache[network_id]
+
+    lookup = SubnetLookup(iter_subnets(
+        openstack_client, filters={'network_id': network_id},
+        fields=SUBNET_LOOKUP_FIELDS))
+    if cache is not None:
+        cache[network_id] = lookup
+    return lookup
+
 
 def get_subnet(openstack_client, subnet_id):
     return openstack_client.neutron.find_resource_by_id('subnet', subnet_id)
 
 
-def list_subnets(openstack_client, filters={}):
-    return openstack_client.neutron.list_subnets(
-        **filters)['subnets']
+def iter_subnets(openstack_client, filters=None, page_size=None,
+                 fields=None):
+    """ Lazily yields the subnets matching the filters page by page. """
+    return pagination.iter_neutron_resources(
+        openstack_client, 'subnets', filters=filters, page_size=page_size,
+        fields=fields)
+
+
+def list_subnets(openstack_client, filters=None, fields=None):
+    return list(iter_subnets(openstack_client, filters=filters, fields=fields))
+
+
+def get_subnets_by_ids(openstack_client, subnet_ids):
+    """ Returns a dict mapping the given subnet IDs to their subnets,
+    fetched with a single listing. """
+    subnet_ids = list(set(subnet_ids))
+    if not subnet_ids:
+        return {}
+    return {
+        subnet['id']: subnet for subnet in list_subnets(
+            openstack_client, filters={'id': subnet_ids})}
 
 
 def get_body(openstack_client, src_tenant_id, source_name):
@@ -42,30 +134,23 @@ def create_subnet(openstack_client, body):
     return subnet_id
 
 
-def check_subnet_similarity(src_subnet, dest_subnet):
-    relevant_keys = set(['enable_dhcp', 'dns_nameservers', 'allocation_pools',
-                         'host_routes', 'ip_version', 'gateway_ip',
-                         'cidr', 'prefixlen', 'ipv6_address_mode',
-                         'ipv6_ra_mode', 'service_types'])
+def get_subnet_fingerprint(subnet):
+    """ Returns the fingerprint of the subnet's attributes which are
+    relevant when comparing subnets across clouds. """
+    return utils.fingerprint(
+        subnet, keys=SUBNET_RELEVANT_KEYS,
+        unordered_keys=SUBNET_UNORDERED_KEYS)
 
-    conflict_keys = set()
-    src_service_types = set(src_subnet.get('service_types'))
-    dest_service_types = set(dest_subnet.get('service_types'))
-    if src_service_types == dest_service_types:
-        conflict_keys.add('service_types')
 
-    for k in src_subnet:
-        if k in relevant_keys:
-            if src_subnet[k] == dest_subnet.get(k):
-                conflict_keys.add(k)
-    src_relevant_keys = set(src_subnet.keys()).intersection(relevant_keys)
-
-    return len(src_relevant_keys) == len(conflict_keys)
+def check_subnet_similarity(src_subnet, dest_subnet):
+    return get_subnet_fingerprint(src_subnet) == get_subnet_fingerprint(
+        dest_subnet)
 
 
 def delete_subnet(openstack_client, network_id, name):
     src_subnets = list_subnets(
-        openstack_client, filters={'network_id': network_id, 'name': name})
+        openstack_client, filters={'network_id': network_id, 'name': name},
+        fields=['id'])
     len_src_subnets = len(src_subnets)
     if len_src_subnets == 1:
         openstack_client.neutron.delete_subnet(src_subnets[0]['id'])
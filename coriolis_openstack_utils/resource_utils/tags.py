@@ -0,0 +1,65 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" Helpers for the ownership tags the destination Neutron resources get
+stamped with on creation, which hold the ID of the source resource they were
+replicated from, so they may be found again with a single tag-filtered query.
+NOTE: requires the Neutron 'standard-attr-tag' extension. On deployments
+without it, the resources are left untagged and are found by name instead.
+"""
+
+import neutronclient.common.exceptions
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: Neutron tags are limited to 60 characters, which fits UUIDs:
+SOURCE_TAG_FORMAT = "coriolis-src:%s"
+
+
+def get_source_tag(source_id):
+    return SOURCE_TAG_FORMAT % source_id
+
+
+def get_source_tag_filters(source_id):
+    """ Returns the Neutron listing filters for the resources tagged with
+    the given source ID. """
+    return {'tags': get_source_tag(source_id)}
+
+
+def has_source_tag(resource, source_id):
+    return get_source_tag(source_id) in (resource.get('tags') or [])
+
+
+def list_tagged_resources(list_resources, source_id):
+    """ Returns the resources tagged with the given source ID, as listed by
+    `list_resources(filters, fields)` with the tag filters.
+    NOTE: Neutron without tag support either ignores the unknown filter (so
+    the results are checked for the tag) or rejects it, in which case no
+    resources are returned so that the caller falls back to name matching.
+    """
+    try:
+        resources = list_resources(
+            get_source_tag_filters(source_id), ['id', 'tags'])
+    except neutronclient.common.exceptions.BadRequest as ex:
+        LOG.debug(
+            "Listing resources tagged with source ID '%s' is not supported: "
+            "%s", source_id, ex)
+        return []
+    return [
+        resource for resource in resources
+        if has_source_tag(resource, source_id)]
+
+
+def tag_resource(openstack_client, resource_plural, resource_id, source_id):
+    """ Stamps the given Neutron resource (ex: 'networks') with the tag of
+    the source resource. Failures are only logged, as the tags are merely an
+    optimization. """
+    try:
+        openstack_client.neutron.add_tag(
+            resource_plural, resource_id, get_source_tag(source_id))
+    except neutronclient.common.exceptions.NeutronClientException as ex:
+        LOG.warn(
+            "Could not tag destination %s '%s' with source ID '%s': %s",
+            resource_plural, resource_id, source_id, ex)
+
@@ -1,6 +1,8 @@
 # Copyright 2018 Cloudbase Solutions Srl
 # All Rights Reserved.
 
+import keystoneauth1.exceptions.http
+
 from oslo_log import log as logging
 from coriolis_openstack_utils import conf
 
@@ -17,6 +19,18 @@ def get_user(openstack_client, user_id):
     return openstack_client.keystone.users.get(user_id)
 
 
+def get_user_names(openstack_client, user_ids):
+    """ Returns a dict mapping those of the given user IDs which exist to
+    their names. """
+    user_names = {}
+    for user_id in set(user_ids):
+        try:
+            user_names[user_id] = get_user(openstack_client, user_id).name
+        except keystoneauth1.exceptions.http.NotFound:
+            pass
+    return user_names
+
+
 def get_body(openstack_client, user_id):
 
     relevant_keys = {'enabled', 'name', 'email'}
@@ -0,0 +1,258 @@
+# Copyright 2018 Cloudbase Solutions Srl
+# All Rights Reserved.
+
+""" This module defines the rollback engine, which deletes the resources
+recorded as created by the actions during their execution in reverse
+dependency order, running the deletions which are independent of one another
+in parallel.
+"""
+
+import threading
+
+from oslo_log import log as logging
+
+from coriolis_openstack_utils import conf
+from coriolis_openstack_utils import utils
+
+CONF = conf.CONF
+LOG = logging.getLogger(__name__)
+
+RESOURCE_TYPE_MIGRATION = "migration"
+RESOURCE_TYPE_REPLICA = "replica"
+RESOURCE_TYPE_ENDPOINT = "endpoint"
+RESOURCE_TYPE_PORT = "port"
+RESOURCE_TYPE_ROUTER = "router"
+RESOURCE_TYPE_SUBNET = "subnet"
+RESOURCE_TYPE_NETWORK = "network"
+RESOURCE_TYPE_SECGROUP = "security_group"
+RESOURCE_TYPE_FLAVOR = "flavor"
+RESOURCE_TYPE_KEYPAIR = "keypair"
+RESOURCE_TYPE_USER = "user"
+RESOURCE_TYPE_TENANT = "tenant"
+
+# NOTE: the resources of each level may only depend on the resources of the
+# following levels, so the levels are deleted in order:
+DELETION_LEVELS = [
+    [RESOURCE_TYPE_MIGRATION, RESOURCE_TYPE_REPLICA],
+    [RESOURCE_TYPE_ENDPOINT, RESOURCE_TYPE_PORT],
+    [RESOURCE_TYPE_ROUTER],
+    [RESOURCE_TYPE_SUBNET, RESOURCE_TYPE_SECGROUP, RESOURCE_TYPE_FLAVOR,
+     RESOURCE_TYPE_KEYPAIR, RESOURCE_TYPE_USER],
+    [RESOURCE_TYPE_NETWORK],
+    [RESOURCE_TYPE_TENANT]]
+
+ROUTER_INTERFACE_DEVICE_OWNER_PREFIX = "network:router_interface"
+MIGRATION_STATUS_RUNNING = "RUNNING"
+REPLICA_EXECUTION_STATUS_RUNNING = "RUNNING"
+# NOTE: cancelled transfers may only be deleted once in a final state:
+TRANSFER_NON_FINAL_STATUSES = ["PENDING", "RUNNING", "CANCELLING"]
+TRANSFER_CANCEL_TIMEOUT = 1800
+
+
+class CreatedResources(object):
+    """ Thread-safe record of the resources created during the execution of
+    a tree of actions. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resources = []
+
+    def __len__(self):
+        return len(self._resources)
+
+    def record(self, resource_type, resource_id):
+        if not any(resource_type in level for level in DELETION_LEVELS):
+            raise ValueError(
+                "Unknown resource type '%s'." % resource_type)
+
+        with self._lock:
+            self._resources.append((resource_type, resource_id))
+
+    def get_resources(self):
+        with self._lock:
+            return list(self._resources)
+
+    def forget(self, resources):
+        with self._lock:
+            self._resources = [
+                resource for resource in self._resources
+                if resource not in resources]
+
+
+def _is_not_found(ex):
+    # NOTE: the various clients' exceptions hold the HTTP status under
+    # different attribute names:
+    for attr in ['status_code', 'http_status', 'code']:
+        if getattr(ex, attr, None) == 404:
+            return True
+    return False
+
+
+def _delete_migration(destination_client, coriolis_client, migration_id):
+    migration = coriolis_client.migrations.get(migration_id)
+    if migration.status == MIGRATION_STATUS_RUNNING:
+        coriolis_client.migrations.cancel(migration_id)
+
+        def _probe():
+            status = coriolis_client.migrations.get(migration_id).status
+            if status in TRANSFER_NON_FINAL_STATUSES:
+                return None
+            return status
+
+        LOG.info("Waiting for cancelled migration '%s'.", migration_id)
+        utils.wait_for(
+            _probe, timeout=TRANSFER_CANCEL_TIMEOUT,
+            description="cancellation of migration '%s'" % migration_id)
+    coriolis_client.migrations.delete(migration_id)
+
+
+def _delete_replica(destination_client, coriolis_client, replica_id):
+    replica = coriolis_client.replicas.get(replica_id)
+    running = [
+        execution for execution in replica.executions
+        if execution.status == REPLICA_EXECUTION_STATUS_RUNNING]
+    for execution in running:
+        coriolis_client.replica_executions.cancel(replica_id, execution.id)
+
+    if running:
+        def _probe():
+            executions = coriolis_client.replicas.get(replica_id).executions
+            if [execution for execution in executions
+                    if execution.status in TRANSFER_NON_FINAL_STATUSES]:
+                return None
+            return True
+
+        LOG.info(
+            "Waiting for cancelled executions of replica '%s'.", replica_id)
+        utils.wait_for(
+            _probe, timeout=TRANSFER_CANCEL_TIMEOUT,
+            description="cancellation of replica '%s' executions" % (
+                replica_id))
+    coriolis_client.replicas.delete(replica_id)
+
+
+def _delete_endpoint(destination_client, coriolis_client, endpoint_id):
+    coriolis_client.endpoints.delete(endpoint_id)
+
+
+def _delete_port(destination_client, coriolis_client, port_id):
+    destination_client.neutron.delete_port(port_id)
+
+
+def _delete_router(destination_client, coriolis_client, router_id):
+    # NOTE: routers cannot be deleted while interfaces are attached:
+    neutron = destination_client.neutron
+    for port in neutron.list_ports(device_id=router_id)['ports']:
+        if port['device_owner'].startswith(
+                ROUTER_INTERFACE_DEVICE_OWNER_PREFIX):
+            neutron.remove_interface_router(
+                router_id, {'port_id': port['id']})
+    neutron.remove_gateway_router(router_id)
+    neutron.delete_router(router_id)
+
+
+def _delete_subnet(destination_client, coriolis_client, subnet_id):
+    destination_client.neutron.delete_subnet(subnet_id)
+
+
+def _delete_network(destination_client, coriolis_client, network_id):
+    destination_client.neutron.delete_network(network_id)
+
+
+def _delete_secgroup(destination_client, coriolis_client, secgroup_id):
+    destination_client.neutron.delete_security_group(secgroup_id)
+
+
+def _delete_flavor(destination_client, coriolis_client, flavor_id):
+    destination_client.nova.flavors.delete(flavor_id)
+
+
+def _delete_keypair(destination_client, coriolis_client, keypair_id):
+    # NOTE: keypairs are identified by their name and owning user (if any):
+    keypair_name, user_id = keypair_id
+    if user_id:
+        destination_client.nova.keypairs.delete(keypair_name, user_id=user_id)
+    else:
+        destination_client.nova.keypairs.delete(keypair_name)
+
+
+def _delete_user(destination_client, coriolis_client, user_id):
+    destination_client.keystone.users.delete(user_id)
+
+
+def _delete_tenant(destination_client, coriolis_client, tenant_id):
+    destination_client.delete_project(tenant_id)
+
+
+RESOURCE_DELETERS = {
+    RESOURCE_TYPE_MIGRATION: _delete_migration,
+    RESOURCE_TYPE_REPLICA: _delete_replica,
+    RESOURCE_TYPE_ENDPOINT: _delete_endpoint,
+    RESOURCE_TYPE_PORT: _delete_port,
+    RESOURCE_TYPE_ROUTER: _delete_router,
+    RESOURCE_TYPE_SUBNET: _delete_subnet,
+    RESOURCE_TYPE_NETWORK: _delete_network,
+    RESOURCE_TYPE_SECGROUP: _delete_secgroup,
+    RESOURCE_TYPE_FLAVOR: _delete_flavor,
+    RESOURCE_TYPE_KEYPAIR: _delete_keypair,
+    RESOURCE_TYPE_USER: _delete_user,
+    RESOURCE_TYPE_TENANT: _delete_tenant}
+
+
+def rollback(created_resources, destination_openstack_client=None,
+             coriolis_client=None, max_workers=None):
+    """ Deletes all the given created resources level by level, in parallel
+    within each level. Resources which are already gone are ignored.
+    Deletion failures do not stop the rollback of the rest of their level,
+    but the following levels (whose resources may still be in use by the
+    ones which failed) are left in place. The failures are all raised
+    together at the end, and the resources left in place stay recorded.
+    param created_resources: CreatedResources: the resources to delete.
+    """
+    if max_workers is None:
+        max_workers = CONF.destination.max_concurrent_requests
+    # NOTE: the mappings to deleted resources must not be used anymore:
+    id_mappings = conf.get_id_mapping_store()
+
+    def _delete(resource_type, resource_id):
+        LOG.info("Deleting %s '%s'.", resource_type, resource_id)
+        try:
+            RESOURCE_DELETERS[resource_type](
+                destination_openstack_client, coriolis_client, resource_id)
+        except Exception as ex:
+            if _is_not_found(ex):
+                LOG.debug(
+                    "%s '%s' already deleted.", resource_type, resource_id)
+                id_mappings.forget_destination(resource_type, resource_id)
+                return None
+            LOG.warn(
+                "Failed to delete %s '%s': %s", resource_type, resource_id,
+                ex)
+            return "%s '%s': %s" % (resource_type, resource_id, ex)
+        id_mappings.forget_destination(resource_type, resource_id)
+
+    resources = created_resources.get_resources()
+    deleted = []
+    errors = []
+    for level in DELETION_LEVELS:
+        level_resources = [
+            resource for resource in resources if resource[0] in level]
+        if not level_resources:
+            continue
+        level_errors = utils.run_concurrently(
+            _delete, level_resources, max_workers=max_workers)
+        for resource, error in zip(level_resources, level_errors):
+            if error:
+                errors.append(error)
+            else:
+                deleted.append(resource)
+        if errors:
+            LOG.warn(
+                "Not rolling back the resources depending on the ones which "
+                "failed to be deleted.")
+            break
+
+    created_resources.forget(deleted)
+    if errors:
+        raise Exception(
+            "Failed to roll back the following resources: %s" % errors)
@@ -1,36 +1,225 @@
 # Copyright 2018 Cloudbase Solutions Srl
 # All Rights Reserved.
 
+import collections.abc
+import hashlib
+import json
+import random
+import time
+
+from concurrent import futures
 
 from oslo_log import log as logging
 
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_WAIT_TIMEOUT = 120
+DEFAULT_WAIT_INITIAL_DELAY = 0.5
+DEFAULT_WAIT_MAX_DELAY = 10
+DEFAULT_WAIT_BACKOFF_FACTOR = 2
+DEFAULT_WAIT_JITTER = 0.25
+DEFAULT_MAX_CONCURRENT_REQUESTS = 8
+
+# NOTE: any key containing one of these is considered to hold a secret:
+SECRET_KEY_MARKERS = ["password", "secret", "token", "private_key"]
+REDACTED_VALUE = "<redacted>"
+
+
+class WaitTimeoutException(Exception):
+    pass
+
+
+class _Missing(object):
+    """ Placeholder for values missing from either side of a diff. """
+
+    def __repr__(self):
+        return "<missing>"
+
+
+MISSING = _Missing()
+
+
+def _get_sort_key(canonical_value):
+    return json.dumps(canonical_value, sort_keys=True, default=str)
+
+
+def canonicalize(value, unordered_keys=(), _key=None):
+    """ Returns a canonical and hashable form of the given value, in which
+    dicts become tuples of (key, value) pairs sorted by key, and lists become
+    tuples. Sets, as well as the lists held under any of the
+    `unordered_keys`, become sorted tuples so their ordering is irrelevant.
+    NOTE: mappings (ex: `records`) are canonicalized just like dicts.
+    """
+    if isinstance(value, collections.abc.Mapping):
+        return tuple(sorted(
+            (str(k), canonicalize(v, unordered_keys=unordered_keys, _key=k))
+            for k, v in value.items()))
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [
+            canonicalize(v, unordered_keys=unordered_keys) for v in value]
+        if isinstance(value, (set, frozenset)) or _key in unordered_keys:
+            items.sort(key=_get_sort_key)
+        return tuple(items)
+
+    return value
+
+
+def project(resource, keys):
+    """ Returns a dict with the given keys of the resource, with the ones
+    missing from it set to None. """
+    return {key: resource.get(key) for key in keys}
+
+
+def fingerprint(value, keys=None, unordered_keys=()):
+    """ Returns a stable hash of the canonical form of the value (see
+    `canonicalize`), optionally only considering the given `keys` of it.
+    Two values with the same fingerprint are structurally equal, so
+    fingerprints may be precomputed and compared in place of the values.
+    """
+    if keys is not None:
+        value = project(value, keys)
+    serialized = json.dumps(
+        canonicalize(value, unordered_keys=unordered_keys), default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+def redact_secrets(value):
+    """ Returns a copy of the given value with the values of all the
+    (nested) keys which may hold secrets (see `SECRET_KEY_MARKERS`)
+    replaced, so it may be safely logged or written to disk. """
+    if isinstance(value, dict):
+        return {
+            k: REDACTED_VALUE if any(
+                marker in str(k).lower() for marker in SECRET_KEY_MARKERS)
+            else redact_secrets(v)
+            for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [redact_secrets(v) for v in value]
+    return value
+
+
+def structural_diff(old, new, unordered_keys=(), _path=()):
+    """ Returns a list of (path, old_value, new_value) tuples for each
+    difference between the given values, found in a single pass over them.
+    Paths are tuples of the keys leading to the differing values within
+    nested dicts, and values missing on either side are set to `MISSING`.
+    """
+    if isinstance(old, collections.abc.Mapping) and isinstance(
+            new, collections.abc.Mapping):
+        diffs = []
+        for key in sorted(set(old) | set(new), key=str):
+            path = _path + (key,)
+            if key not in old:
+                diffs.append((path, MISSING, new[key]))
+            elif key not in new:
+                diffs.append((path, old[key], MISSING))
+            else:
+                diffs.extend(structural_diff(
+                    old[key], new[key], unordered_keys=unordered_keys,
+                    _path=path))
+        return diffs
+
+    key = _path[-1] if _path else None
+    if canonicalize(old, unordered_keys=unordered_keys, _key=key) != (
+            canonicalize(new, unordered_keys=unordered_keys, _key=key)):
+        return [(_path, old, new)]
+    return []
+
 
 def check_dict_equals(dict1, dict2):
     """ Recursively checks whether two dicts are equal. """
-    LOG.debug("Comparing dicts:\n%s\n%s", dict1, dict2)
-
     if (type(dict1), type(dict2)) != (dict, dict):
-        LOG.debug("Bad types:\n%s\n%s", dict1, dict2)
+        LOG.debug("Bad types: %s, %s", type(dict1), type(dict2))
         return False
 
-    keys1 = set(dict1)
-    keys2 = set(dict2)
-    if keys1 != keys2:
-        LOG.debug("Different key sets for:\n%s\n%s", dict1, dict2)
-        return False
+    return canonicalize(dict1) == canonicalize(dict2)
+
+
+def _get_backoff_delays(initial_delay, max_delay, backoff_factor, jitter):
+    """ Yields exponentially increasing delays, each randomly spread by up to
+    `jitter` (as a fraction of the delay) to avoid synchronized polling. """
+    delay = initial_delay
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * backoff_factor, max_delay)
+
+
+def wait_for_all(
+        probe, keys, timeout=DEFAULT_WAIT_TIMEOUT,
+        initial_delay=DEFAULT_WAIT_INITIAL_DELAY,
+        max_delay=DEFAULT_WAIT_MAX_DELAY,
+        backoff_factor=DEFAULT_WAIT_BACKOFF_FACTOR,
+        jitter=DEFAULT_WAIT_JITTER, description="conditions"):
+    """ Waits for several conditions at once, checking all the ones still
+    pending with a single call to `probe` on each poll.
+    Polls are spaced with exponential backoff and jitter until the deadline.
+
+    param probe: callable: takes the set of pending keys and returns a dict
+    mapping the keys whose conditions are satisfied to their results.
+    param keys: iterable: keys of the conditions to wait for.
+    param timeout: number of seconds after which to give up.
+    returns: dict mapping each of the keys to its result.
+    raises: WaitTimeoutException if some conditions are still pending at the
+    deadline.
+    """
+    pending = set(keys)
+    results = {}
+    deadline = time.monotonic() + timeout
+    delays = _get_backoff_delays(
+        initial_delay, max_delay, backoff_factor, jitter)
+    while pending:
+        done = probe(set(pending))
+        results.update(done)
+        pending = pending - set(done)
+        if not pending:
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WaitTimeoutException(
+                "Timed out after %s seconds waiting for %s: %s" % (
+                    timeout, description, sorted(pending)))
+
+        delay = min(next(delays), remaining)
+        LOG.debug(
+            "Waiting %.2f seconds for %s: %s", delay, description,
+            sorted(pending))
+        time.sleep(delay)
+
+    return results
+
+
+def wait_for(probe, description="condition", **kwargs):
+    """ Waits until `probe` returns a value other than None and returns it.
+    Accepts the same keyword arguments as `wait_for_all`.
+    """
+    def _probe(pending):
+        result = probe()
+        if result is None:
+            return {}
+        return {description: result}
+
+    return wait_for_all(
+        _probe, [description], description=description, **kwargs)[
+            description]
+
 
-    for key in keys1:
-        e1 = dict1[key]
-        e2 = dict2[key]
+def run_concurrently(
+        func, args_list, max_workers=DEFAULT_MAX_CONCURRENT_REQUESTS):
+    """ Calls `func(*args)` for each of the given argument tuples using a pool
+    of at most `max_workers` threads.
+    Returns the results in the order of the arguments. If any of the calls
+    fail, the first exception is raised after all the calls have finished.
+    """
+    args_list = list(args_list)
+    if not args_list:
+        return []
 
-        if dict in (type(e1), type(e2)):
-            if not check_dict_equals(e1, e2):
-                return False
-        else:
-            if not e1 == e2:
-                return False
+    workers = max(1, min(max_workers, len(args_list)))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(func, *args) for args in args_list]
+        futures.wait(jobs)
 
-    return True
+    return [job.result() for job in jobs]